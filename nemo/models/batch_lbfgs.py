@@ -0,0 +1,140 @@
+import torch
+
+
+class BatchLBFGS(torch.optim.Optimizer):
+    """
+    L-BFGS with Armijo backtracking line search, run independently for every sample of a batch.
+
+    All parameters share the sample dimension as their leading dimension, a parameter shared by the samples must be
+    expanded to one copy per sample, and the closure returns the loss of every sample, [n, ]. The losses of different
+    samples must not depend on each other. Each call of the closure evaluates the whole batch, the line search stops
+    once every sample has accepted a step.
+
+    Use it through cfg.inference.optimizer, e.g. class_name: nemo.models.batch_lbfgs.BatchLBFGS, with far fewer epochs
+    than Adam and a scheduler that keeps the lr constant.
+    """
+
+    def __init__(self, params, lr=1.0, history_size=10, max_ls=8, c1=1e-4, shrink=0.5, tolerance_change=1e-6, tolerance_loss=1e-5, curvature_eps=1e-10):
+        defaults = dict(lr=lr, history_size=history_size, max_ls=max_ls, c1=c1, shrink=shrink, tolerance_change=tolerance_change,
+                        tolerance_loss=tolerance_loss, curvature_eps=curvature_eps)
+        super().__init__(params, defaults)
+
+        if len(self.param_groups) != 1:
+            raise ValueError("BatchLBFGS doesn't support per-parameter options (parameter groups)")
+        self._params = self.param_groups[0]['params']
+
+    def _gather_flat(self, n):
+        return torch.cat([p.detach().reshape(n, -1) for p in self._params], dim=1)
+
+    def _gather_flat_grad(self, n):
+        views = []
+        for p in self._params:
+            views.append(torch.zeros_like(p).reshape(n, -1) if p.grad is None else p.grad.reshape(n, -1))
+        return torch.cat(views, dim=1)
+
+    def _set_flat(self, n, x):
+        offset = 0
+        for p in self._params:
+            numel = p.numel() // n
+            p.copy_(x[:, offset:offset + numel].view_as(p))
+            offset += numel
+
+    def _evaluate(self, closure, n=None):
+        loss = closure()
+        loss = loss.detach().reshape(-1).to(self._params[0].dtype)
+        n = loss.shape[0] if n is None else n
+        if any(p.shape[0] != n for p in self._params):
+            raise ValueError(f"BatchLBFGS expects the leading dimension of every parameter to be the {n} samples, got {[tuple(p.shape) for p in self._params]}")
+        return loss, self._gather_flat_grad(n)
+
+    @torch.no_grad()
+    def step(self, closure):
+        """
+        closure: callable, re-evaluates the model with gradients and returns the loss of each sample, [n, ]
+        return: the loss of each sample before the step
+        """
+        closure = torch.enable_grad()(closure)
+        group = self.param_groups[0]
+        state = self.state[self._params[0]]
+
+        # The loss and gradient at the accepted point of the previous step are reused,
+        # unless the parameters were changed from outside
+        if 'x' in state and torch.equal(state['x'], self._gather_flat(state['x'].shape[0])):
+            loss, grad = state['loss'], state['grad']
+        else:
+            loss, grad = self._evaluate(closure)
+            state['old_s'], state['old_y'], state['rho'] = [], [], []
+            state['gamma'] = None
+            state['done'] = torch.zeros(loss.shape[0], dtype=torch.bool, device=loss.device)
+
+        n = loss.shape[0]
+        x = self._gather_flat(n)
+        old_s, old_y, rho = state['old_s'], state['old_y'], state['rho']
+
+        # Two-loop recursion, history entries with rho = 0 are skipped for that sample
+        d = -grad
+        alphas = []
+        for s, y, r in zip(reversed(old_s), reversed(old_y), reversed(rho)):
+            a = r * torch.sum(s * d, dim=1)
+            d = d - a[:, None] * y
+            alphas.append(a)
+        if state['gamma'] is None:
+            # First iteration, scale the step by the gradient as torch.optim.LBFGS does
+            t = group['lr'] * torch.clamp(1. / grad.abs().sum(dim=1), max=1.)
+        else:
+            d = d * state['gamma'][:, None]
+            t = torch.full((n, ), group['lr'], dtype=x.dtype, device=x.device)
+        for s, y, r, a in zip(old_s, old_y, rho, reversed(alphas)):
+            be = r * torch.sum(y * d, dim=1)
+            d = d + s * (a - be)[:, None]
+
+        # Fall back to steepest descent where the direction is not a descent direction
+        gd = torch.sum(grad * d, dim=1)
+        not_descent = gd >= 0
+        d[not_descent] = -grad[not_descent]
+        gd = torch.sum(grad * d, dim=1)
+
+        # Samples with a zero gradient or that already converged do not move
+        accepted = (gd == 0) | state['done']
+        x_new, loss_new, grad_new = x.clone(), loss.clone(), grad.clone()
+
+        for _ in range(group['max_ls']):
+            # Samples whose step became negligible have converged, they stay where they are
+            accepted |= torch.max((t[:, None] * d).abs(), dim=1)[0] < group['tolerance_change']
+            if bool(accepted.all()):
+                break
+            x_trial = torch.where(accepted[:, None], x_new, x + t[:, None] * d)
+            self._set_flat(n, x_trial)
+            loss_trial, grad_trial = self._evaluate(closure, n)
+
+            ok = ~accepted & (loss_trial <= loss + group['c1'] * t * gd)
+            x_new[ok] = x_trial[ok]
+            loss_new[ok] = loss_trial[ok]
+            grad_new[ok] = grad_trial[ok]
+            accepted |= ok
+            t = torch.where(accepted, t, t * group['shrink'])
+
+        # Samples that found no decrease stay where they were, they and the samples whose relative decrease
+        # fell below tolerance_loss are not searched again
+        state['done'] |= ~accepted | (loss - loss_new <= group['tolerance_loss'] * loss.abs())
+        self._set_flat(n, x_new)
+
+        s = x_new - x
+        y = grad_new - grad
+        ys = torch.sum(y * s, dim=1)
+        valid = ys > group['curvature_eps']
+        if bool(valid.any()):
+            old_s.append(s * valid[:, None])
+            old_y.append(y * valid[:, None])
+            rho.append(torch.where(valid, 1. / ys.clamp(min=group['curvature_eps']), torch.zeros_like(ys)))
+            gamma = ys / torch.sum(y * y, dim=1).clamp(min=group['curvature_eps'])
+            state['gamma'] = torch.where(valid, gamma, torch.ones_like(gamma) if state['gamma'] is None else state['gamma'])
+            if len(old_s) > group['history_size']:
+                old_s.pop(0)
+                old_y.pop(0)
+                rho.pop(0)
+
+        state['x'] = x_new
+        state['loss'] = loss_new
+        state['grad'] = grad_new
+        return loss
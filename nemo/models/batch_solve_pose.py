@@ -8,21 +8,19 @@
 import numpy as np
 import torch
 from pytorch3d.renderer import camera_position_from_spherical_angles
+from nemo.models.clutter import score_clutter
 from nemo.utils import construct_class_by_name
 from nemo.utils import camera_position_to_spherical_angle
+from nemo.utils import get_param_steps
 from nemo.utils.general import tensor_linspace
 import time
 
 try:
     from VoGE.Renderer import GaussianRenderer, GaussianRenderSettings, interpolate_attr
-    from VoGE.Utils import Batchifier
     enable_voge = True
 except:
     enable_voge=False
 
-if not enable_voge:
-    from TorchBatchifier import Batchifier
-
 
 def loss_fg_only(obj_s, clu_s=None, reduce_method=lambda x: torch.mean(x)):
     return torch.ones(1, device=obj_s.device) - reduce_method(obj_s)
@@ -40,24 +38,36 @@ def object_loss_fg_bg(obj_s, clu_s, object_height, object_width, reduce_method=l
         reduce_method(torch.max(obj_s, clu_s)) - reduce_method(clu_s)
     )
 
-def get_pre_render_samples(inter_module, azum_samples, elev_samples, theta_samples, distance_samples=[5], device='cpu',):
+@torch.no_grad()
+def render_templates(inter_module, cam_pos, theta, batch_size=36):
+    """
+    Rasterize the feature maps of a set of poses in chunks.
+    cam_pos: [n, 3]
+    theta: [n, ]
+    return: [n, c, h, w]
+    """
+    n = cam_pos.shape[0]
+    out_maps = None
+    for start in range(0, n, batch_size):
+        end = min(start + batch_size, n)
+        projected_map = inter_module(cam_pos[start:end], theta[start:end])
+        if out_maps is None:
+            out_maps = torch.empty((n, *projected_map.shape[1:]), dtype=projected_map.dtype, device=projected_map.device)
+        out_maps[start:end] = projected_map
+    return out_maps
+
+
+def get_pre_render_samples(inter_module, azum_samples, elev_samples, theta_samples, distance_samples=[5], device='cpu', batch_size=36):
     with torch.no_grad():
-        get_c = []
-        get_theta = []
-        get_samples = [[azum_, elev_, theta_, distance_] for azum_ in azum_samples for elev_ in elev_samples for theta_ in theta_samples for distance_ in distance_samples]
-        out_maps = []
-        for sample_ in get_samples:
-            theta_ = torch.ones(1, device=device) * sample_[2]
-            C = camera_position_from_spherical_angles(sample_[3], sample_[1], sample_[0], degrees=False, device=device)
-
-            projected_map = inter_module(C, theta_)
-            out_maps.append(projected_map)
-            get_c.append(C.detach())
-            get_theta.append(theta_)
-
-        get_c = torch.stack(get_c, ).squeeze(1)
-        get_theta = torch.cat(get_theta)
-        out_maps = torch.stack(out_maps)
+        # Ordered as azimuth -> elevation -> theta -> distance, the last one changes fastest
+        get_samples = np.stack(np.meshgrid(azum_samples, elev_samples, theta_samples, distance_samples, indexing='ij'), axis=-1).reshape(-1, 4)
+        get_samples = torch.tensor(get_samples, dtype=torch.float32, device=device)
+
+        get_c = camera_position_from_spherical_angles(get_samples[:, 3], get_samples[:, 1], get_samples[:, 0], degrees=False, device=device)
+        get_theta = get_samples[:, 2].contiguous()
+
+        # [n, 1, c, h, w]
+        out_maps = render_templates(inter_module, get_c, get_theta, batch_size=batch_size).unsqueeze(1)
 
     return out_maps, get_c, get_theta
 
@@ -90,6 +100,41 @@ def align_no_centered(maps_source, distance_source, principal_source, maps_targe
     return torch.nn.functional.grid_sample(maps_source, grids, padding_mode=padding_mode)
 
 
+@torch.no_grad()
+def score_templates(samples_maps, predicted_maps, clutter_scores=None, tile_size=32):
+    """
+    Loss of every template on every image, computed as a per-pixel batched matmul over tiles of templates.
+    samples_maps: [n, c, h, w]
+    predicted_maps: [b, c, h, w]
+    clutter_scores: [b, h, w]
+    return: [n, b]
+    """
+    n, c = samples_maps.shape[0:2]
+    b = predicted_maps.shape[0]
+
+    # [b, c, h, w] -> [p, c, b]
+    predicted_maps = predicted_maps.reshape(b, c, -1).permute(2, 1, 0).contiguous()
+    if clutter_scores is not None:
+        # [b, h, w] -> [p, 1, b]
+        clutter_scores = clutter_scores.reshape(b, -1).T.unsqueeze(1).contiguous()
+        clutter_mean = torch.mean(clutter_scores, dim=0)
+
+    get_loss = torch.empty((n, b), dtype=predicted_maps.dtype, device=predicted_maps.device)
+    for start in range(0, n, tile_size):
+        end = min(start + tile_size, n)
+        # [t, c, h, w] -> [p, t, c]
+        tile = samples_maps[start:end].to(predicted_maps.device).reshape(end - start, c, -1).permute(2, 0, 1)
+
+        # [p, t, c] x [p, c, b] -> [p, t, b]
+        object_score = torch.bmm(tile, predicted_maps)
+        if clutter_scores is None:
+            get_loss[start:end] = 1 - torch.mean(object_score, dim=0)
+        else:
+            object_score = torch.maximum(object_score, clutter_scores, out=object_score)
+            get_loss[start:end] = 1 - (torch.mean(object_score, dim=0) - clutter_mean)
+    return get_loss
+
+
 def get_init_pos_rendered(samples_maps, samples_pos, samples_theta, predicted_maps, clutter_scores=None, batch_size=32):
     """
     samples_pos: [n, 3]
@@ -98,71 +143,117 @@ def get_init_pos_rendered(samples_maps, samples_pos, samples_theta, predicted_ma
     predicted_map: [b, c, h, w]
     clutter_score: [b, h, w]
     """
-    n = samples_maps.shape[0]
-    if clutter_scores is None:
-        def cal_sim(projected_map, predicted_map, clutter_map):
-            object_score = torch.einsum('nchw,nchw->nhw', projected_map, predicted_map)
-            return loss_fg_only(object_score, reduce_method=lambda x: torch.mean(x, dim=(1, 2)))
-
-    else:
-        def cal_sim(projected_map, predicted_map, clutter_map):
-            object_score = torch.einsum('nchw,nchw->nhw', projected_map, predicted_map)
-            return loss_fg_bg(object_score, clutter_map, reduce_method=lambda x: torch.mean(x, dim=(1, 2)))
-
-    batchifier = Batchifier(batch_size=batch_size, batch_args=('projected_map', 'predicted_map') + (tuple() if clutter_scores is None else ('clutter_map', )), target_dims=(0, 1))
-
     with torch.no_grad():
-        # [n, b, c, h, w] -> [n, b]
-        target_shape = (n, *predicted_maps.shape)
-        get_loss = batchifier(cal_sim)(projected_map=samples_maps.expand(*target_shape).contiguous(),
-                                       predicted_map=predicted_maps[None].expand(*target_shape).contiguous(), 
-                                       clutter_map=clutter_scores[None].expand(n, *clutter_scores.shape).contiguous(), )
+        # [n, b]
+        get_loss = score_templates(samples_maps, predicted_maps, clutter_scores, tile_size=batch_size)
 
         # [b]
-        use_indexes = torch.min(get_loss, dim=0)[1]
+        min_loss, use_indexes = torch.min(get_loss, dim=0)
 
     # [n, 3] -> [b, 3]
-    return torch.gather(samples_pos, dim=0, index=use_indexes.view(-1, 1).expand(-1, 3)), torch.gather(samples_theta, dim=0, index=use_indexes), torch.min(get_loss, dim=0)[0]
+    return torch.gather(samples_pos, dim=0, index=use_indexes.view(-1, 1).expand(-1, 3)), torch.gather(samples_theta, dim=0, index=use_indexes), min_loss
 
 
 def get_init_pos_rendered_dim0(samples_maps, samples_pos, samples_theta, predicted_maps, clutter_scores=None, batch_size=32):
     """
     samples_pos: [n, 3]
     samples_theta: [n, ]
-    samples_map: [n, c, h, w]
+    samples_map: [n, 1, c, h, w]
     predicted_map: [b, c, h, w]
     clutter_score: [b, h, w]
     """
-    n = samples_maps.shape[0]
-    if clutter_scores is None:
-        def cal_sim(projected_map, predicted_map, clutter_map):
-            object_score = torch.einsum('nchw,chw->nhw', projected_map, predicted_map)
-            return loss_fg_only(object_score, reduce_method=lambda x: torch.mean(x, dim=(1, 2)))
+    return get_init_pos_rendered(samples_maps.squeeze(1), samples_pos, samples_theta, predicted_maps, clutter_scores=clutter_scores, batch_size=batch_size)
 
-    else:
-        def cal_sim(projected_map, predicted_map, clutter_map):
-            object_score = torch.einsum('nchw,chw->nhw', projected_map, predicted_map)
-            return loss_fg_bg(object_score, clutter_map, reduce_method=lambda x: torch.mean(x, dim=(1, 2)))
 
-    batchifier = Batchifier(batch_size=batch_size, batch_args=('projected_map', ), target_dims=(0, ))
+@torch.no_grad()
+def score_paired_templates(inter_module, cam_pos, theta, image_index, predicted_maps, clutter_scores=None, batch_size=36):
+    """
+    Render each pose and score it only against its own image.
+    cam_pos: [m, 3]
+    theta: [m, ]
+    image_index: [m, ], index of the image in predicted_maps each pose belongs to
+    predicted_maps: [b, c, h, w]
+    clutter_scores: [b, h, w]
+    return: [m, ]
+    """
+    m = cam_pos.shape[0]
+    get_loss = torch.empty(m, dtype=predicted_maps.dtype, device=predicted_maps.device)
+    for start in range(0, m, batch_size):
+        end = min(start + batch_size, m)
+        # [t, c, h, w]
+        projected_map = inter_module(cam_pos[start:end], theta[start:end])
+        # [t, h, w]
+        object_score = torch.sum(projected_map * predicted_maps[image_index[start:end]], dim=1)
+        if clutter_scores is None:
+            get_loss[start:end] = loss_fg_only(object_score, reduce_method=lambda x: torch.mean(x, dim=(1, 2)))
+        else:
+            get_loss[start:end] = loss_fg_bg(object_score, clutter_scores[image_index[start:end]], reduce_method=lambda x: torch.mean(x, dim=(1, 2)))
+    return get_loss
+
+
+def get_init_pos_hierarchical(inter_module, samples_maps, samples_pos, samples_theta, predicted_maps, clutter_scores=None, steps=None, top_k=3, levels=2, factor=3, batch_size=32, render_batch_size=36):
+    """
+    Coarse-to-fine initialization. The pre-rendered grid is scored once, then the neighbourhoods of the top_k
+    poses of each image are searched with on-demand renderings, each level shrinking the grid spacing by factor.
+    samples_pos: [n, 3]
+    samples_theta: [n, ]
+    samples_map: [n, 1, c, h, w]
+    predicted_map: [b, c, h, w]
+    clutter_score: [b, h, w]
+    steps: (azimuth, elevation, theta, distance) spacing of the pre-rendered grid, see get_param_steps
+    """
+    device = predicted_maps.device
+    b = predicted_maps.shape[0]
 
     with torch.no_grad():
-        # [n, b, c, h, w] -> [n, b]
-        get_loss = []
+        # [n, b]
+        get_loss = score_templates(samples_maps.squeeze(1), predicted_maps, clutter_scores, tile_size=batch_size)
+        k = min(top_k, get_loss.shape[0])
 
-        for i in range(predicted_maps.shape[0]):
-            # [n]
-            get_loss.append(batchifier(cal_sim)(projected_map=samples_maps.squeeze(1), predicted_map=predicted_maps[i], clutter_map=clutter_scores[None, i]))
+        # [b, k]
+        cand_loss, cand_index = torch.topk(get_loss.T, k, dim=1, largest=False)
+        cand_pos = samples_pos[cand_index.view(-1)].to(device)
+        cand_theta = samples_theta[cand_index.view(-1)].to(device)
 
-        # b * [n, ] -> [n, b]
-        get_loss = torch.stack(get_loss).T
+        # Offsets in units of the current spacing, axes with a single sample are not searched. The candidates themselves
+        # are kept with their loss, the zero offset is not rendered again
+        steps = torch.tensor(steps, dtype=torch.float32, device=device)
+        unit = torch.arange(factor, dtype=torch.float32, device=device) - (factor - 1) / 2
+        offsets = torch.stack(torch.meshgrid(*[unit if s > 0 else unit.new_zeros(1) for s in steps], indexing='ij'), dim=-1).view(-1, 4)
+        offsets = offsets[torch.any(offsets != 0, dim=1)]
+        n_off = offsets.shape[0]
 
-        # [b]
-        use_indexes = torch.min(get_loss, dim=0)[1]
+        for level in range(levels if n_off > 0 else 0):
+            steps = steps / factor
 
-    # [n, 3] -> [b, 3]
-    return torch.gather(samples_pos, dim=0, index=use_indexes.view(-1, 1).expand(-1, 3)), torch.gather(samples_theta, dim=0, index=use_indexes), torch.min(get_loss, dim=0)[0]
+            distance, elevation, azimuth = camera_position_to_spherical_angle(cand_pos)
+            # [b * k, 4] -> [b * k, n_off, 4]
+            params = torch.stack([azimuth, elevation, cand_theta, distance], dim=1)
+            params = params[:, None] + offsets[None] * steps
+            params[..., 1] = params[..., 1].clamp(-np.pi / 2 + 1e-3, np.pi / 2 - 1e-3)
+            params = params.view(-1, 4)
+
+            pos = camera_position_from_spherical_angles(params[:, 3], params[:, 1], params[:, 0], degrees=False, device=device)
+            image_index = torch.arange(b, device=device).repeat_interleave(k * n_off)
+
+            # [b * k * n_off] -> [b, k * n_off]
+            this_loss = score_paired_templates(inter_module, pos, params[:, 2].contiguous(), image_index, predicted_maps, clutter_scores, batch_size=render_batch_size).view(b, -1)
 
+            # [b, k + k * n_off], the candidates compete with their neighbours
+            all_loss = torch.cat([cand_loss.view(b, k), this_loss], dim=1)
+            all_pos = torch.cat([cand_pos.view(b, k, 3), pos.view(b, k * n_off, 3)], dim=1).view(-1, 3)
+            all_theta = torch.cat([cand_theta.view(b, k), params[:, 2].view(b, k * n_off)], dim=1).view(-1)
+
+            cand_loss, this_index = torch.topk(all_loss, k, dim=1, largest=False)
+            this_index = (this_index + torch.arange(b, device=device)[:, None] * k * (1 + n_off)).view(-1)
+            cand_pos = all_pos[this_index]
+            cand_theta = all_theta[this_index]
+
+        # [b, k] -> [b]
+        min_loss, use_indexes = torch.min(cand_loss, dim=1)
+        use_indexes = use_indexes + torch.arange(b, device=device) * k
+
+    return cand_pos[use_indexes], cand_theta[use_indexes], min_loss
 
 
 def get_init_pos(inter_module, samples_pos, samples_theta, predicted_maps, clutter_scores=None, reset_distance=None):
@@ -191,6 +282,125 @@ def get_init_pos(inter_module, samples_pos, samples_theta, predicted_maps, clutt
     return torch.gather(samples_pos, dim=0, index=use_indexes.view(-1, 1).expand(-1, 3)), torch.gather(samples_theta, dim=0, index=use_indexes), torch.min(torch.stack(out_scores), dim=0)[0]
 
 
+def refine_pose(cfg, feature_map, inter_module, clutter_score, init_C, init_theta, init_principal, optimize_principal=False, mesh_index=None):
+    """
+    Refine the poses of a batch by gradient descent on the similarity of the rendered and predicted feature maps, with
+    cfg.inference.optimizer and the optional cfg.inference.early_stopping.
+    feature_map: [b, c, h, w]
+    clutter_score: [b, h, w]
+    init_C: [b, 3]
+    init_theta: [b, ]
+    init_principal: [b, 2] or [1, 2]
+    mesh_index: [b, ], the mesh of inter_module rendered for each sample, None if inter_module holds a single mesh
+    return: C [b, 3], theta [b, ], principals [b, 2], object_score [b, h, w], iterations [b, ], optimizer epochs of each
+        sample, renders [b, ], closure calls that rendered each sample, several per epoch with a line search
+    """
+    b = feature_map.shape[0]
+
+    C = torch.nn.Parameter(init_C, requires_grad=True)
+    theta = torch.nn.Parameter(init_theta, requires_grad=True)
+    if optimize_principal:
+        # Each sample moves its own principal point, a shared one would couple the samples
+        principals = torch.nn.Parameter(init_principal.expand(b, -1).clone(), requires_grad=True)
+        optim = construct_class_by_name(**cfg.inference.optimizer, params=[C, theta, principals])
+    else:
+        principals = init_principal.expand(b, -1) if init_principal.shape[0] == 1 else init_principal
+        optim = construct_class_by_name(**cfg.inference.optimizer, params=[C, theta])
+
+    scheduler_kwargs = {"optimizer": optim}
+    scheduler = construct_class_by_name(**cfg.inference.scheduler, **scheduler_kwargs)
+
+    early_stopping = cfg.inference.get('early_stopping', None)
+    if early_stopping is not None and not early_stopping.get('enabled', True):
+        early_stopping = None
+    if early_stopping is not None:
+        patience = early_stopping.get('patience', 10)
+        loss_tol = early_stopping.get('loss_tol', 1e-4)
+        param_tol = early_stopping.get('param_tol', 1e-2)
+        last_loss = torch.full((b, ), float('inf'), device=feature_map.device)
+        stable_steps = torch.zeros(b, dtype=torch.long, device=feature_map.device)
+        converged = torch.zeros(b, dtype=torch.bool, device=feature_map.device)
+        frozen_params = [(p_, p_.detach().clone()) for p_ in (C, theta, principals) if isinstance(p_, torch.nn.Parameter) and p_.shape[0] == b]
+
+    # Only the samples still being optimized are rendered, converged ones are dropped from the batch
+    active = torch.arange(b, device=feature_map.device)
+    iterations = torch.zeros(b, dtype=torch.long, device=feature_map.device)
+    renders = torch.zeros(b, dtype=torch.long, device=feature_map.device)
+
+    def render_score(index):
+        # The principal point is passed with the cameras, the cameras of inter_module are not modified
+        if init_principal.shape[0] == b or optimize_principal:
+            principal_point = principals[index]
+        else:
+            principal_point = None
+
+        # [a, c, h, w]
+        projected_map = inter_module(
+            C[index],
+            theta[index],
+            mode=cfg.inference.inter_mode,
+            blur_radius=cfg.inference.blur_radius,
+            principal_point=principal_point,
+            **({} if mesh_index is None else dict(mesh_index=mesh_index[index])),
+        )
+
+        # [a, c, h, w] -> [a, h, w]
+        return torch.sum(projected_map * feature_map[index], dim=1)
+
+    def closure():
+        optim.zero_grad()
+        renders[active] += 1
+        this_score = render_score(active)
+
+        # [a, ], scaled by the full batch size to keep the gradients of the batch mean loss
+        this_loss = loss_fg_bg(this_score, clutter_score[active], reduce_method=lambda x: torch.mean(x, dim=(1, 2))) / b
+        this_loss.sum().backward()
+
+        # Per-sample losses for optimizers that search along each sample, see BatchLBFGS
+        full_loss = torch.zeros(b, device=feature_map.device)
+        full_loss[active] = this_loss.detach()
+        return full_loss
+
+    for epo in range(cfg.inference.epochs):
+        iterations[active] += 1
+        if early_stopping is not None:
+            prev_params = [p_.detach()[active].view(active.shape[0], -1) for p_ in (C, theta)]
+
+        # [b, ], loss before the step
+        step_loss = optim.step(closure) * b
+
+        if (epo + 1) % (cfg.inference.epochs // 3) == 0:
+            scheduler.step()
+
+        if early_stopping is not None:
+            with torch.no_grad():
+                # The optimizer state keeps moving converged samples, put them back
+                for p_, f_ in frozen_params:
+                    p_[converged] = f_[converged]
+
+                param_delta = torch.max(torch.cat([(p_.detach()[active].view(active.shape[0], -1) - q_).abs() for p_, q_ in zip((C, theta), prev_params)], dim=1), dim=1)[0]
+                loss_delta = (step_loss[active] - last_loss[active]).abs()
+                last_loss[active] = step_loss[active]
+
+                stable = (loss_delta < loss_tol) & (param_delta < param_tol)
+                stable_steps[active] = torch.where(stable, stable_steps[active] + 1, torch.zeros_like(stable_steps[active]))
+
+                newly_converged = active[stable_steps[active] >= patience]
+                converged[newly_converged] = True
+                for p_, f_ in frozen_params:
+                    f_[newly_converged] = p_.detach()[newly_converged]
+
+                active = active[~converged[active]]
+                if active.shape[0] == 0:
+                    break
+
+    # The last closure call may have rendered a rejected line search trial, score the poses that are returned
+    with torch.no_grad():
+        object_score = render_score(torch.arange(b, device=feature_map.device))
+
+    return C, theta, principals, object_score, iterations, renders
+
+
 def solve_pose(
     cfg,
     feature_map,
@@ -211,18 +421,7 @@ def solve_pose(
 
     # Step 1: Pre-compute foreground and background features
     start_time = time.time()
-    clutter_score = None
-    if not isinstance(clutter_bank, list):
-        clutter_bank = [clutter_bank]
-    for cb in clutter_bank:
-        _score = (
-            torch.nn.functional.conv2d(feature_map, cb.unsqueeze(2).unsqueeze(3))
-            .squeeze(1)
-        )
-        if clutter_score is None:
-            clutter_score = _score
-        else:
-            clutter_score = torch.max(clutter_score, _score)
+    clutter_score = score_clutter(feature_map, clutter_bank)
 
     end_time = time.time()
     pred["pre_compute_time"] = end_time - start_time
@@ -230,6 +429,19 @@ def solve_pose(
     # Step 2: Search for initializations
     start_time = end_time
 
+    if 'hierarchical' in cfg.inference.get('init_mode', '3d_batch'):
+        def init_search(**kwargs_):
+            # Neighbourhoods are rendered centered like the pre-rendered grid, with the cameras of the rasterizer
+            return get_init_pos_hierarchical(inter_module=inter_module, 
+                                             steps=get_param_steps(cfg), 
+                                             top_k=cfg.inference.get('hierarchical_top_k', 3), 
+                                             levels=cfg.inference.get('hierarchical_levels', 2), 
+                                             factor=cfg.inference.get('hierarchical_factor', 3), 
+                                             render_batch_size=cfg.inference.get('pre_render_batch_size', 36), 
+                                             **kwargs_)
+    else:
+        init_search = get_init_pos_rendered_dim0
+
     # 3 DoF or 4 DoF
     if dof == 3 or dof == 4:
         # Not centered images
@@ -238,15 +450,14 @@ def solve_pose(
             t_feature_map = align_no_centered(maps_source=feature_map, principal_source=principal, maps_target_shape=(maps_target_shape[0, 0], maps_target_shape[0, 1]), principal_target=maps_target_shape.flip(1) / 2, **kwargs)
             t_clutter_score = align_no_centered(maps_source=clutter_score[:, None], principal_source=principal, maps_target_shape=(maps_target_shape[0, 0], maps_target_shape[0, 1]), principal_target=maps_target_shape.flip(1) / 2, **kwargs).squeeze(1)
             init_principal = principal.float()
-            inter_module.rasterizer.cameras._N = feature_map.shape[0]
         # Centered images
         else:
-            init_principal = inter_module.rasterizer.cameras.principal_point
+            init_principal = inter_module.rasterizer.cameras.principal_point.clone()
             t_feature_map = feature_map
             t_clutter_score = clutter_score
 
         if pre_render:
-            init_C, init_theta, _ = get_init_pos_rendered_dim0(samples_maps=feature_pre_rendered, 
+            init_C, init_theta, _ = init_search(samples_maps=feature_pre_rendered, 
                                                     samples_pos=cam_pos_pre_rendered, 
                                                     samples_theta=theta_pre_rendered, 
                                                     predicted_maps=t_feature_map, 
@@ -276,7 +487,7 @@ def solve_pose(
                 t_feature_map = align_no_centered(maps_source=feature_map, principal_source=principal_, maps_target_shape=(maps_target_shape[0, 0], maps_target_shape[0, 1]), principal_target=maps_target_shape.flip(1) / 2, distance_source=distance_source, distance_target=distance_source, padding_mode='border')
                 t_clutter_score = align_no_centered(maps_source=clutter_score[:, None], principal_source=principal_, maps_target_shape=(maps_target_shape[0, 0], maps_target_shape[0, 1]), principal_target=maps_target_shape.flip(1) / 2, distance_source=distance_source, distance_target=distance_source, padding_mode='border').squeeze(1)
 
-                this_C, this_theta, this_loss = get_init_pos_rendered_dim0(samples_maps=feature_pre_rendered, 
+                this_C, this_theta, this_loss = init_search(samples_maps=feature_pre_rendered, 
                                                         samples_pos=cam_pos_pre_rendered, 
                                                         samples_theta=theta_pre_rendered, 
                                                         predicted_maps=t_feature_map, 
@@ -291,8 +502,6 @@ def solve_pose(
             init_C = torch.gather(torch.stack(all_init_C), dim=0, index=use_indexes.view(1, -1, 1).expand(-1, -1, 3)).squeeze(0)
             init_theta = torch.gather(torch.stack(all_init_theta), dim=0, index=use_indexes.view(1, -1)).squeeze(0)
             init_principal = torch.gather(principal, dim=0, index=use_indexes.view(-1, 1).expand(-1, 2)).float()
-            
-            inter_module.rasterizer.cameras._N = feature_map.shape[0]
 
     end_time = time.time()
     pred["pre_rendering_time"] = end_time - start_time
@@ -303,41 +512,19 @@ def solve_pose(
     if principal is not None and dof == 3:
         init_C = init_C / init_C.pow(2).sum(-1).pow(.5)[..., None] * kwargs.get('distance_source')[..., None].float()
 
-    C = torch.nn.Parameter(init_C, requires_grad=True)
-    theta = torch.nn.Parameter(init_theta, requires_grad=True)
-    if dof == 6 or cfg.get('optimize_translation', False):
-        principals = torch.nn.Parameter(init_principal, requires_grad=True)
-        inter_module.rasterizer.cameras.principal_point = principals
-        optim = construct_class_by_name(**cfg.inference.optimizer, params=[C, theta, principals])
-    else:
-        principals = init_principal.expand(b, -1) if init_principal.shape[0] == 1 else init_principal
-        inter_module.rasterizer.cameras.principal_point = init_principal
-        optim = construct_class_by_name(**cfg.inference.optimizer, params=[C, theta])
-
-    scheduler_kwargs = {"optimizer": optim}
-    scheduler = construct_class_by_name(**cfg.inference.scheduler, **scheduler_kwargs)
-    
-    for epo in range(cfg.inference.epochs):
-        # [b, c, h, w]
-        projected_map = inter_module(
-            C,
-            theta,
-            mode=cfg.inference.inter_mode,
-            blur_radius=cfg.inference.blur_radius,
-        )
-
-        # [b, c, h, w] -> [b, h, w]
-        object_score = torch.sum(projected_map * feature_map, dim=1)
-        
-        loss = loss_fg_bg(object_score, clutter_score, )
-        loss.backward()
-        optim.step()
-        optim.zero_grad()
-
-        if (epo + 1) % (cfg.inference.epochs // 3) == 0:
-            scheduler.step()
+    C, theta, principals, object_score, iterations, renders = refine_pose(
+        cfg, 
+        feature_map, 
+        inter_module, 
+        clutter_score, 
+        init_C, 
+        init_theta, 
+        init_principal, 
+        optimize_principal=dof == 6 or cfg.get('optimize_translation', False),
+    )
 
     distance_preds, elevation_preds, azimuth_preds = camera_position_to_spherical_angle(C)
+    end_time = time.time()
     pred["optimization_time"] = end_time - start_time
 
     preds = []
@@ -367,6 +554,149 @@ def solve_pose(
                     this_principal[1].item(),
                 ],
                 "score": this_loss.item(),}]
-        preds.append(dict(final=refined, **{k: pred[k] / b for k in pred.keys()}))
+        preds.append(dict(final=refined, iterations=iterations[i].item(), renders=renders[i].item(), **{k: pred[k] / b for k in pred.keys()}))
+
+    return preds
+
+
+def solve_pose_multi_category(
+    cfg,
+    feature_map,
+    inter_module,
+    clutter_bank,
+    cam_pos_pre_rendered,
+    theta_pre_rendered,
+    feature_pre_rendered,
+    device="cuda",
+    top_k=None,
+    category_prior=None,
+    **kwargs
+):
+    """
+    Pose of every category for a batch of centered images, solved together. inter_module holds the meshes of all
+    categories and renders each pose with the mesh given by mesh_index, so the initializations and the refinement of
+    all categories share one feature map and one optimization.
+
+    With top_k, the categories are first ranked by a cheap score, the initialization loss of the best template or, with
+    category_prior, that prior. Only the top_k categories of each image are refined, the others are rejected.
+    feature_map: [b, c, h, w]
+    cam_pos_pre_rendered, theta_pre_rendered: [n, 3], [n, ], poses of the pre-rendered templates, shared by all categories
+    feature_pre_rendered: list of [n, 1, c, h, w], the templates of each category
+    top_k: number of categories refined per image, None to refine all of them
+    category_prior: [b, n_cate], higher is better, e.g. MultiCategoryScorer, ranks the categories instead of the
+        initialization loss, the templates are then only scored for the categories kept
+    return: list of b dicts, final is the pose of the best category (lowest score), category_index its index, and
+        category_scores and category_poses the score and the pose of each category, inf and None for rejected ones.
+        cascade_scores are the scores of the first stage (lower is better), cascade_threshold the worst one kept.
+    """
+    b, c, hm_h, hm_w = feature_map.size()
+    n_cate = len(feature_pre_rendered)
+    pred = {}
+
+    # Step 1: Pre-compute foreground and background features
+    start_time = time.time()
+    clutter_score = score_clutter(feature_map, clutter_bank)
+
+    end_time = time.time()
+    pred["pre_compute_time"] = end_time - start_time
+
+    # Step 2: Rank the categories, then search for initializations of the categories kept
+    start_time = end_time
+    cascade = top_k is not None and top_k < n_cate
+
+    # [n_cate, b]
+    if category_prior is not None:
+        stage_scores = -category_prior.T.to(feature_map.device)
+        keep = torch.ones((n_cate, b), dtype=torch.bool, device=feature_map.device)
+        if cascade:
+            keep[:] = False
+            keep.scatter_(0, torch.topk(stage_scores, top_k, dim=0, largest=False)[1], True)
+    else:
+        stage_scores = None
+        keep = torch.ones((n_cate, b), dtype=torch.bool, device=feature_map.device)
+
+    init_C = torch.zeros((n_cate, b, 3), dtype=feature_map.dtype, device=feature_map.device)
+    init_theta = torch.zeros((n_cate, b), dtype=feature_map.dtype, device=feature_map.device)
+    init_loss = torch.full((n_cate, b), float('inf'), dtype=feature_map.dtype, device=feature_map.device)
+    for idx, samples_maps in enumerate(feature_pre_rendered):
+        images = torch.nonzero(keep[idx]).squeeze(1)
+        if images.shape[0] == 0:
+            continue
+        init_C[idx, images], init_theta[idx, images], init_loss[idx, images] = get_init_pos_rendered_dim0(
+            samples_maps=samples_maps, 
+            samples_pos=cam_pos_pre_rendered, 
+            samples_theta=theta_pre_rendered, 
+            predicted_maps=feature_map[images], 
+            clutter_scores=clutter_score[images], 
+            batch_size=cfg.get('batch_size_no_grad', 144),
+        )
+
+    if stage_scores is None:
+        stage_scores = init_loss
+        if cascade:
+            keep[:] = False
+            keep.scatter_(0, torch.topk(stage_scores, top_k, dim=0, largest=False)[1], True)
+    stage_threshold = torch.where(keep, stage_scores, torch.full_like(stage_scores, -float('inf'))).max(dim=0)[0]
+
+    # Pairs of (category, image) kept, category-major
+    mesh_index, pair_image = torch.nonzero(keep, as_tuple=True)
+    init_principal = inter_module.rasterizer.cameras.principal_point.clone()
+
+    end_time = time.time()
+    pred["pre_rendering_time"] = end_time - start_time
+
+    # Step 3: Refine all categories kept with a single pose optimization
+    start_time = end_time
+    C, theta, principals, object_score, iterations, renders = refine_pose(
+        cfg, 
+        feature_map[pair_image], 
+        inter_module, 
+        clutter_score[pair_image], 
+        init_C[mesh_index, pair_image], 
+        init_theta[mesh_index, pair_image], 
+        init_principal, 
+        optimize_principal=cfg.get('optimize_translation', False),
+        mesh_index=mesh_index,
+    )
+
+    with torch.no_grad():
+        # [n_cate, b], rejected categories keep an infinite loss
+        pair_loss = torch.full((n_cate, b), float('inf'), dtype=feature_map.dtype, device=feature_map.device)
+        pair_loss[mesh_index, pair_image] = loss_fg_bg(object_score, clutter_score[pair_image], reduce_method=lambda x: torch.mean(x, dim=(1, 2)))
+        best_category = torch.min(pair_loss, dim=0)[1]
+
+    distance_preds, elevation_preds, azimuth_preds = camera_position_to_spherical_angle(C)
+    end_time = time.time()
+    pred["optimization_time"] = end_time - start_time
+
+    poses = [[None] * n_cate for _ in range(b)]
+    pair_iterations = [[0] * n_cate for _ in range(b)]
+    pair_renders = [[0] * n_cate for _ in range(b)]
+    for k, (j, i) in enumerate(zip(mesh_index.tolist(), pair_image.tolist())):
+        poses[i][j] = {
+            "azimuth": azimuth_preds[k].item(),
+            "elevation": elevation_preds[k].item(),
+            "theta": theta[k].item(),
+            "distance": distance_preds[k].item(),
+            "principal": [principals[k][0].item(), principals[k][1].item()],
+            "score": pair_loss[j, i].item(),
+        }
+        pair_iterations[i][j] = iterations[k].item()
+        pair_renders[i][j] = renders[k].item()
+
+    preds = []
+    for i in range(b):
+        category_index = best_category[i].item()
+        preds.append(dict(
+            final=[poses[i][category_index]], 
+            category_index=category_index, 
+            category_scores=pair_loss[:, i].tolist(), 
+            category_poses=poses[i], 
+            cascade_scores=stage_scores[:, i].tolist(), 
+            cascade_threshold=stage_threshold[i].item(), 
+            iterations=pair_iterations[i], 
+            renders=pair_renders[i], 
+            **{k: pred[k] / b for k in pred.keys()}
+        ))
 
     return preds
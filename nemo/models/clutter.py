@@ -0,0 +1,36 @@
+import torch
+
+from nemo.models.vertex_index import spherical_kmeans
+from nemo.utils import normalize_features
+
+
+def build_clutter_bank(clutter, num_components=1, n_iter=10, seed=0):
+    """
+    Clutter vectors used at inference, computed once when the model is built.
+
+    clutter: [n, c], clutter features saved in the checkpoint memory
+    num_components: 1 for the normalized mean clutter feature, more for a mixture of clutter features clustered with
+        spherical k-means, a pixel is then scored against its closest component
+    return: [K, c]
+    """
+    if num_components <= 1 or clutter.shape[0] <= 1:
+        return normalize_features(torch.mean(clutter, dim=0)).unsqueeze(0)
+    centroids, _ = spherical_kmeans(clutter, min(num_components, clutter.shape[0]), n_iter=n_iter, seed=seed)
+    return centroids
+
+
+def score_clutter(feature_map, clutter_bank):
+    """
+    Similarity of each pixel to the clutter, the max over all clutter components with a single matmul.
+
+    feature_map: [b, c, h, w]
+    clutter_bank: [K, c] or [c, ], or a list of them
+    return: [b, h, w]
+    """
+    b, c, h, w = feature_map.shape
+    if isinstance(clutter_bank, (list, tuple)):
+        clutter_bank = torch.cat([cb.view(-1, c) for cb in clutter_bank], dim=0)
+
+    # [K, c] x [b, c, hw] -> [b, K, hw]
+    score = torch.matmul(clutter_bank.view(-1, c), feature_map.reshape(b, c, h * w))
+    return score.max(dim=1)[0].view(b, h, w)
@@ -0,0 +1,63 @@
+import torch
+
+
+def _chunk_logits(features, memory, mask, temperature, start, end):
+    logits = torch.matmul(features[start:end], memory.transpose(0, 1)) / temperature
+    if mask is not None:
+        logits = logits - (mask.rows(start, end) if hasattr(mask, 'rows') else mask[start:end]).type(logits.dtype)
+    return logits
+
+
+class _ChunkedCoKeLoss(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, features, memory, target, mask, temperature, chunk_size):
+        lse = features.new_empty(features.shape[0])
+        target_logits = features.new_empty(features.shape[0])
+        for start in range(0, features.shape[0], chunk_size):
+            end = min(start + chunk_size, features.shape[0])
+            logits = _chunk_logits(features, memory, mask, temperature, start, end)
+            lse[start:end] = torch.logsumexp(logits, dim=1)
+            target_logits[start:end] = torch.gather(logits, 1, target[start:end, None]).squeeze(1)
+
+        ctx.save_for_backward(features, memory, target, lse)
+        ctx.mask = mask
+        ctx.temperature = temperature
+        ctx.chunk_size = chunk_size
+        return lse - target_logits
+
+    @staticmethod
+    def backward(ctx, grad_loss):
+        features, memory, target, lse = ctx.saved_tensors
+        grad_features = torch.zeros_like(features) if ctx.needs_input_grad[0] else None
+        grad_memory = torch.zeros_like(memory) if ctx.needs_input_grad[1] else None
+
+        # The logits are recomputed chunk by chunk instead of being kept from the forward
+        for start in range(0, features.shape[0], ctx.chunk_size):
+            end = min(start + ctx.chunk_size, features.shape[0])
+            logits = _chunk_logits(features, memory, ctx.mask, ctx.temperature, start, end)
+            # d loss / d logits = softmax - one_hot(target)
+            grad_logits = torch.exp(logits - lse[start:end, None])
+            grad_logits[torch.arange(end - start, device=grad_logits.device), target[start:end]] -= 1
+            grad_logits *= grad_loss[start:end, None] / ctx.temperature
+
+            if grad_features is not None:
+                grad_features[start:end] = torch.matmul(grad_logits, memory)
+            if grad_memory is not None:
+                grad_memory += torch.matmul(grad_logits.transpose(0, 1), features[start:end])
+        return grad_features, grad_memory, None, None, None, None
+
+
+def coke_loss(features, memory, target, mask=None, temperature=1., chunk_size=4096):
+    """
+    CoKe cross entropy of each feature, the same as
+        CrossEntropyLoss(reduction='none')(features @ memory^T / temperature - mask, target)
+    computed chunk_size rows at a time. Neither the (S, N) similarity nor the mask is built for all rows at once, and the
+    backward recomputes the logits of each chunk instead of saving them.
+
+    features: [S, c], features of the visible vertices
+    memory: [N, c], feature bank, vertex features followed by the clutter features
+    target: [S, ], index of the vertex of each feature in the memory
+    mask: [S, N] weight mask, CoKeMask of MaskCreater(..., lazy=True), or None
+    return: [S, ]
+    """
+    return _ChunkedCoKeLoss.apply(features, memory, target.long(), mask, temperature, chunk_size)
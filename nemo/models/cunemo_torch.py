@@ -0,0 +1,157 @@
+"""
+PyTorch implementation of the CuNeMo kernels in cu_layers/, used when the extension is not built or the tensors are on
+CPU. The functions take the same arguments as their CuNeMo counterparts and return the same values, the indexes are
+returned as long instead of int32.
+"""
+import torch
+
+
+def get_vert_shifts(indexs, mesh_n_list):
+    """
+    indexs: (N, M), mesh of each instance in each image, -1 for padding
+    mesh_n_list: list or (L, ), number of verts of each mesh in the bank
+    return: number of verts (N, M) and first padded vertex (N, M) of each instance
+    """
+    if not torch.is_tensor(mesh_n_list):
+        mesh_n_list = torch.Tensor(mesh_n_list).type(indexs.dtype).to(indexs.device)
+    valid_mask = torch.logical_not(indexs < 0).type(indexs.dtype)
+    verts_num = valid_mask * torch.gather(mesh_n_list[None].expand(indexs.shape[0], -1).type(indexs.dtype), dim=1, index=indexs.long().clamp(min=0))
+    sample_shifts = torch.cumsum(verts_num, dim=1) - verts_num
+    return verts_num, sample_shifts
+
+
+def gather_idx(sample_indexs, mesh_n_list, K_padded):
+    """
+    Mesh of each padded vertex when the meshes of sample_indexs are concatenated on each image, _GatherIdx of CuNeMo.
+
+    sample_indexs: (N, M), mesh of each instance in each image, -1 for padding
+    mesh_n_list: list or (L, ), number of verts of each mesh in the bank
+    return: object_idx, source_vert_idx, verts_start, num_verts, each (N, K_padded), zeros past the last mesh
+    """
+    sample_indexs = sample_indexs.long()
+    mesh_n_list = torch.as_tensor(mesh_n_list, device=sample_indexs.device).long()
+    verts_num, sample_shifts = get_vert_shifts(sample_indexs, mesh_n_list)
+    input_valid = sample_shifts[:, -1] + verts_num[:, -1]
+    bank_shifts = torch.cumsum(mesh_n_list, dim=0) - mesh_n_list
+
+    # The instance of vertex k is the last one starting at or before k
+    k = torch.arange(K_padded, device=sample_indexs.device)[None].expand(sample_indexs.shape[0], -1).contiguous()
+    slot = (torch.searchsorted(sample_shifts.contiguous(), k, right=True) - 1).clamp(min=0)
+    valid = (k < input_valid[:, None]).long()
+
+    object_idx = torch.gather(sample_indexs, 1, slot).clamp(min=0) * valid
+    source_vert_idx = (k - torch.gather(sample_shifts, 1, slot)) * valid
+    verts_start = bank_shifts[object_idx] * valid
+    num_verts = torch.gather(verts_num, 1, slot) * valid
+    return object_idx, source_vert_idx, verts_start, num_verts
+
+
+def mask_weight(object_idx, source_vert_idx, verts_start, verts_end, verts_dist_weight, weight_x, weight_c, clutter_start, total_v):
+    """
+    _MaskWeight of CuNeMo.
+
+    object_idx, source_vert_idx, verts_start, verts_end: (S, )
+    verts_dist_weight: (N_obj, V_padded, V_padded)
+    return: (S, total_v), verts_dist_weight[object_idx, source_vert_idx] on the columns verts_start to verts_end,
+        weight_c from clutter_start on and weight_x elsewhere
+    """
+    object_idx, source_vert_idx = object_idx.long(), source_vert_idx.long()
+    verts_start, verts_end = verts_start.long()[:, None], verts_end.long()[:, None]
+    n, v = object_idx.shape[0], verts_dist_weight.shape[-1]
+
+    out = torch.full((n, total_v), weight_x, dtype=torch.float32, device=verts_dist_weight.device)
+    out[:, clutter_start:] = weight_c
+
+    # Only the V_padded columns from verts_start of each row are read from verts_dist_weight
+    target = torch.arange(v, device=out.device)[None].expand(n, -1)
+    valid = target < verts_end - verts_start
+    row = torch.arange(n, device=out.device)[:, None].expand(-1, v)
+    out[row[valid], (verts_start + target)[valid]] = verts_dist_weight[object_idx, source_vert_idx].type(torch.float32)[valid]
+    return out
+
+
+def get_mask(verts_dist_weight, sample_indexs, mesh_n_list, total_size, K_padded, weight_x, weight_c, mask_sel=None, n_noise=0):
+    """
+    get_mask of CuNeMo, CoKe weight mask of the padded vertices of each image.
+
+    verts_dist_weight: (N_obj, V_padded, V_padded)
+    sample_indexs: (N, M)
+    mask_sel: (N, K_padded), rows to keep
+    return: weight mask (S, total_size), vertex index in the bank (S, )
+    """
+    if not torch.is_tensor(mesh_n_list):
+        mesh_n_list = torch.Tensor(mesh_n_list).type(torch.int32).to(verts_dist_weight.device)
+    assert verts_dist_weight.dim() == 3
+    object_idx, source_vert_idx, verts_start, num_verts = gather_idx(sample_indexs, mesh_n_list, K_padded)
+
+    if mask_sel is None:
+        object_idx, source_vert_idx, verts_start, num_verts = [t.view(-1) for t in (object_idx, source_vert_idx, verts_start, num_verts)]
+    else:
+        object_idx, source_vert_idx, verts_start, num_verts = [t[mask_sel] for t in (object_idx, source_vert_idx, verts_start, num_verts)]
+
+    out_weight = mask_weight(object_idx, source_vert_idx, verts_start, verts_start + num_verts, verts_dist_weight, weight_x, weight_c, total_size - n_noise, total_size)
+    vert_index = (torch.cumsum(mesh_n_list, dim=0) - mesh_n_list).long()[object_idx] + source_vert_idx
+    return out_weight, vert_index
+
+
+def gather_features(features, weights, sample_indexs, mesh_n_list):
+    """
+    gather_features of CuNeMo, weighted sum of the features of each vertex of the bank over the images, differentiable
+    with respect to the features and the weights.
+
+    features: (N, K, C), features of the meshes of sample_indexs concatenated on each image
+    weights: (N, K), weight of each feature
+    sample_indexs: (N, M), mesh of each instance in each image, -1 for padding
+    mesh_n_list: list or (L, ), number of verts of each mesh in the bank
+    return: gathered features (sum(mesh_n_list), C), gathered weights (sum(mesh_n_list), )
+    """
+    if not torch.is_tensor(mesh_n_list):
+        mesh_n_list = torch.Tensor(mesh_n_list).type(torch.int32).to(features.device)
+    assert features.dim() == 3 and weights.dim() == 2 and sample_indexs.dim() == 2
+    assert -1 <= sample_indexs.max() < mesh_n_list.shape[0]
+    total_verts = int(mesh_n_list.sum())
+
+    object_idx, source_vert_idx, verts_start, num_verts = gather_idx(sample_indexs, mesh_n_list, features.shape[1])
+    valid = (num_verts > 0).view(-1)
+    forward_mapping = (verts_start + source_vert_idx).view(-1)[valid]
+    weights = weights.reshape(-1)[valid]
+
+    gathered_features = torch.zeros((total_verts, features.shape[2]), dtype=features.dtype, device=features.device)
+    gathered_features = gathered_features.index_add(0, forward_mapping, features.reshape(-1, features.shape[2])[valid] * weights[:, None])
+    gathered_weights = torch.zeros(total_verts, dtype=weights.dtype, device=weights.device).index_add(0, forward_mapping, weights)
+    return gathered_features, gathered_weights
+
+
+if __name__ == '__main__':
+    # Hand computed cases, the meshes of the bank have 3 and 2 verts
+    mesh_n_list = [3, 2]
+    sample_indexs = torch.Tensor([[1, 0], [0, -1]]).type(torch.int32)
+
+    verts_num, sample_shifts = get_vert_shifts(sample_indexs, mesh_n_list)
+    assert verts_num.tolist() == [[2, 3], [3, 0]] and sample_shifts.tolist() == [[0, 2], [0, 3]]
+
+    object_idx, source_vert_idx, verts_start, num_verts = gather_idx(sample_indexs, mesh_n_list, 6)
+    assert object_idx.tolist() == [[1, 1, 0, 0, 0, 0], [0, 0, 0, 0, 0, 0]]
+    assert source_vert_idx.tolist() == [[0, 1, 0, 1, 2, 0], [0, 1, 2, 0, 0, 0]]
+    assert verts_start.tolist() == [[3, 3, 0, 0, 0, 0], [0, 0, 0, 0, 0, 0]]
+    assert num_verts.tolist() == [[2, 2, 3, 3, 3, 0], [3, 3, 3, 0, 0, 0]]
+
+    # Within a mesh the weight is 10 * source + target, 1 for the other mesh and 2 for the 2 clutter columns
+    verts_dist_weight = torch.zeros((2, 3, 3))
+    verts_dist_weight[:] = (10 * torch.arange(3)[:, None] + torch.arange(3)[None]).type(torch.float32)
+    mask_sel = torch.Tensor([[1, 0, 0, 0, 1, 0], [0, 1, 0, 0, 0, 0]]).type(torch.bool)
+    weight, vert_index = get_mask(verts_dist_weight, sample_indexs, mesh_n_list, 7, 6, 1., 2., mask_sel=mask_sel, n_noise=2)
+    assert weight.tolist() == [[1, 1, 1, 0, 1, 2, 2], [20, 21, 22, 1, 1, 2, 2], [10, 11, 12, 1, 1, 2, 2]]
+    assert vert_index.tolist() == [3, 2, 1]
+
+    # Bank vertex 0 is seen in both images, vertex 4 (second vertex of mesh 1) only in the first one
+    features = torch.arange(12, dtype=torch.float32).view(2, 6, 1).requires_grad_()
+    weights = torch.Tensor([[1, 2, 1, 1, 1, 1], [3, 1, 1, 5, 5, 5]]).requires_grad_()
+    gathered_features, gathered_weights = gather_features(features, weights, sample_indexs, mesh_n_list)
+    assert gathered_features.view(-1).tolist() == [2 + 3 * 6, 3 + 7, 4 + 8, 0, 2]
+    assert gathered_weights.tolist() == [4, 2, 2, 1, 2]
+
+    (gathered_features.sum() + gathered_weights.sum()).backward()
+    assert features.grad.view(-1).tolist() == [1, 2, 1, 1, 1, 0, 3, 1, 1, 0, 0, 0]
+    assert weights.grad.tolist() == [[1, 2, 3, 4, 5, 0], [7, 8, 9, 0, 0, 0]]
+    print('CuNeMo PyTorch fallback matches the hand computed cases')
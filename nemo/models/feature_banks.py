@@ -3,16 +3,23 @@ import math
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from nemo.models import cunemo_torch
 from nemo.utils.pascal3d_utils import CATEGORIES
 
 try:
-    from CuNeMo import get_mask
-    from CuNeMo import gather_features
+    from CuNeMo import gather_features as cuda_gather_features
     enable_cunemo = True
 except:
     enable_cunemo = False
 
 
+def gather_features(features, weights, sample_indexs, mesh_n_list):
+    # CuNeMo kernel for cuda tensors when the extension is built, the PyTorch implementation otherwise
+    if enable_cunemo and features.is_cuda:
+        return cuda_gather_features(features, weights=weights, sample_indexs=sample_indexs, mesh_n_list=mesh_n_list)
+    return cunemo_torch.gather_features(features, weights, sample_indexs, mesh_n_list)
+
+
 def one_hot(y, max_size=None):
     if not max_size:
         max_size = int(torch.max(y).item() + 1)
@@ -35,6 +42,133 @@ def fun_label_onehot(img_label, count_label):
     return ret
 
 
+def scatter_vertex_features(x, y, visible, n_pos):
+    """
+    Visible features summed per vertex with index_add_, the same as bmm(one_hot(y, n_pos)^T, x * visible) summed over
+    the batch, without the [n, k, n_pos] one-hot.
+
+    x: [n, k, d], features
+    y: [n, k], vertex index of each feature
+    visible: [n, k], visibility of each feature, used as its weight
+    return: summed features [n_pos, d], visible count of each vertex [n_pos, ]
+    """
+    weights = visible.type(x.dtype).reshape(-1)
+    index = y.reshape(-1).type(torch.long)
+    summed = torch.zeros((n_pos, x.shape[-1]), dtype=x.dtype, device=x.device)
+    summed.index_add_(0, index, x.reshape(-1, x.shape[-1]) * weights[:, None])
+    counts = torch.zeros(n_pos, dtype=x.dtype, device=x.device).index_add_(0, index, weights)
+    return summed, counts
+
+
+def radius_neighbours(points, thr, groups=None):
+    """
+    Pairs of points closer than thr, found by hashing the points into a grid of cells of size thr, so only the points
+    of the 3^D cells around each point are compared instead of all pairs.
+
+    points: (P, D)
+    thr: float, distance threshold, pairs with distance <= thr are returned, every point is its own neighbour
+    groups: (P, ), only points of the same group are paired, e.g. the image of each keypoint
+    return: CSR neighbour list, neighbour_ptr (P + 1, ) and neighbour_idx (nnz, ), the neighbours of point i are
+        neighbour_idx[neighbour_ptr[i]:neighbour_ptr[i + 1]]
+    """
+    n, d = points.shape
+    device = points.device
+    if groups is None:
+        groups = torch.zeros(n, dtype=torch.long, device=device)
+
+    cell = torch.floor(points / (thr if thr > 0 else 1.)).long()
+    # Shifted by one so that the cells around each point are never negative
+    cell = cell - cell.min(dim=0)[0] + 1 if n > 0 else cell
+    size = cell.max(dim=0)[0] + 2 if n > 0 else torch.ones(d, dtype=torch.long, device=device)
+
+    def cell_key(c):
+        key = groups.long()
+        for i in range(d):
+            key = key * size[i] + c[:, i]
+        return key
+
+    sorted_key, order = torch.sort(cell_key(cell))
+    src, dst = [], []
+    for offset in torch.cartesian_prod(*[torch.arange(-1, 2, device=device)] * d).view(-1, d):
+        key = cell_key(cell + offset)
+        lo = torch.searchsorted(sorted_key, key)
+        counts = torch.searchsorted(sorted_key, key, right=True) - lo
+        this_src = torch.repeat_interleave(torch.arange(n, device=device), counts)
+        # Position of each candidate in the run of points of that cell
+        within = torch.arange(this_src.shape[0], device=device) - torch.repeat_interleave(torch.cumsum(counts, dim=0) - counts, counts)
+        this_dst = order[torch.repeat_interleave(lo, counts) + within]
+
+        close = (points[this_src] - points[this_dst]).pow(2).sum(-1).pow(.5) <= thr
+        src.append(this_src[close])
+        dst.append(this_dst[close])
+
+    src, dst = torch.cat(src), torch.cat(dst)
+    order = torch.argsort(src * max(n, 1) + dst)
+    neighbour_ptr = torch.cat([torch.zeros(1, dtype=torch.long, device=device), torch.cumsum(torch.bincount(src, minlength=n), dim=0)])
+    return neighbour_ptr, dst[order]
+
+
+class CoKeMask():
+    """
+    Rows of the CoKe weight mask of MaskCreater, built a chunk of rows at a time so the whole (S, N_verts_total + N_noise)
+    mask never has to be allocated. Row s is kappa_pos on its own vertex, kappa_near on the neighbours of that vertex and
+    0 on the other vertices of its mesh, kappa_clutter on the clutter columns and kappa_class on the vertices of the other
+    meshes. The neighbours are read from a CSR neighbour list and written by index.
+    """
+    def __init__(self, neighbour_ptr, neighbour_idx, neighbour_row, source_vert_idx, verts_start, num_verts, kappas, clutter_start, total_size):
+        """
+        neighbour_ptr, neighbour_idx: CSR neighbour list, neighbour indexes are vertex indexes in the mesh
+        neighbour_row: (S, ), row of the neighbour list of each mask row
+        source_vert_idx, verts_start, num_verts: (S, ), vertex in its mesh, first column and number of columns of that
+            mesh in the bank of each row
+        kappas: dict, {'pos', 'near', 'clutter', 'class'}
+        """
+        self.neighbour_ptr = neighbour_ptr
+        self.neighbour_idx = neighbour_idx
+        self.neighbour_row = neighbour_row.long()
+        self.source_vert_idx = source_vert_idx.long()
+        self.verts_start = verts_start.long()
+        self.num_verts = num_verts.long()
+        self.kappas = kappas
+        self.clutter_start = clutter_start
+        self.total_size = total_size
+
+    def __len__(self):
+        return self.neighbour_row.shape[0]
+
+    @property
+    def shape(self):
+        return (len(self), self.total_size)
+
+    def rows(self, start, end):
+        """
+        return: (end - start, N_verts_total + N_noise), rows start to end of the weight mask
+        """
+        n = end - start
+        device = self.neighbour_row.device
+        verts_start, verts_end = self.verts_start[start:end, None], self.verts_start[start:end, None] + self.num_verts[start:end, None]
+
+        out = torch.full((n, self.total_size), self.kappas['class'], dtype=torch.float32, device=device)
+        out[:, self.clutter_start:] = self.kappas['clutter']
+        columns = torch.arange(self.total_size, device=device)[None]
+        out.masked_fill_((columns >= verts_start) & (columns < verts_end), 0)
+
+        neighbour_row = self.neighbour_row[start:end]
+        # Rows past the last mesh of their image have no vertex of their own
+        has_vert = self.num_verts[start:end] > 0
+        counts = (self.neighbour_ptr[neighbour_row + 1] - self.neighbour_ptr[neighbour_row]) * has_vert
+        row = torch.repeat_interleave(torch.arange(n, device=device), counts)
+        within = torch.arange(row.shape[0], device=device) - torch.repeat_interleave(torch.cumsum(counts, dim=0) - counts, counts)
+        neighbours = self.neighbour_idx[self.neighbour_ptr[neighbour_row][row] + within]
+        out[row, verts_start[row, 0] + neighbours] = self.kappas['near']
+
+        row = torch.nonzero(has_vert).squeeze(1)
+        out[row, verts_start[row, 0] + self.source_vert_idx[start:end][row]] = self.kappas['pos']
+        return out
+
+    def dense(self):
+        return self.rows(0, len(self))
+
 
 class MaskCreater():
     def __init__(self, dist_thr, kappas, n_noise, verts_ori=None, device='cpu'):
@@ -44,30 +178,26 @@ class MaskCreater():
         n_noise: int
         verts_ori: list of tensor, [(K, 3), ] verts locations
         """
-        if verts_ori is not None:
-            with torch.no_grad():
-                vert_max_num = max([v.shape[0] for v in verts_ori])
-                self.vert_sum_num = sum([v.shape[0] for v in verts_ori])
-                
-                out_vert_dist = []
-                assert isinstance(verts_ori, list)
-                for vv in verts_ori:
-                    get_vert_ = torch.cat([vv, torch.zeros((vert_max_num - vv.shape[0], 3), dtype=vv.dtype, device=vv.device)], dim=0)
-                    vert_dist = (get_vert_[:, None] - get_vert_[None]).pow(2).sum(-1).pow(.5)
-                    out_vert_dist.append(vert_dist)
-                vert_dists = torch.stack(out_vert_dist)
-            self.verts_dist_weight = (vert_dists <= dist_thr).to(device).type(torch.float32) * kappas['near'] + torch.eye(vert_max_num).to(device).type(torch.float32).unsqueeze(dim=0) * (kappas['pos'] - kappas['near'])
-            self.mesh_n_list = [v.shape[0] for v in verts_ori]
-        else:
-            self.verts_dist_weight = None
-
         self.kappas = {'pos':0, 'near':1e5, 'clutter': 5, 'class':1e5}
         self.kappas.update(kappas)
         self.dist_thr = dist_thr
         self.n_noise = n_noise
         self.device = device
 
-    def __call__(self, sample_indexs=None, K_padded=None, vis_mask=None, kps=None, dtype_template=None):
+        if verts_ori is not None:
+            assert isinstance(verts_ori, list)
+            self.mesh_n_list = [v.shape[0] for v in verts_ori]
+            self.vert_sum_num = sum(self.mesh_n_list)
+            # Near vertices of every vertex of the bank, in the vertex indexes of its mesh
+            verts = torch.cat([v.type(torch.float32) for v in verts_ori], dim=0).to(device)
+            groups = torch.repeat_interleave(torch.arange(len(verts_ori), device=device), torch.tensor(self.mesh_n_list, device=device))
+            bank_shifts = torch.cumsum(torch.tensor(self.mesh_n_list, device=device), dim=0) - torch.tensor(self.mesh_n_list, device=device)
+            self.neighbour_ptr, neighbour_idx = radius_neighbours(verts, dist_thr, groups=groups)
+            self.neighbour_idx = neighbour_idx - torch.repeat_interleave(bank_shifts[groups], self.neighbour_ptr[1:] - self.neighbour_ptr[:-1])
+        else:
+            self.neighbour_ptr, self.neighbour_idx = None, None
+
+    def __call__(self, sample_indexs=None, K_padded=None, vis_mask=None, kps=None, dtype_template=None, lazy=False):
         """
         Usable combinations: 
         One object per image:
@@ -83,39 +213,32 @@ class MaskCreater():
         kps: (B, K_padded, 2) project keypoints locations
         dtype_template: (B, K_padded) or (B, K_padded, N_verts_total + N_noise) reference for tensor shape
 
+        lazy: return the weight mask as a CoKeMask, whose rows are only built when they are used, requires vis_mask
+
         return:
         weight_mask: (S, N_verts_total + N_noise), the weight matrix
         vert_index: (S, ), type=long, index label for computing coke loss
         """
-        if kps is not None:
-            # assert self.verts_dist_weight is None, 'Ethier keypoint location of verts is specificed!'
-            # (b, k, k)
-            vert_dists = (kps[:, None] - kps[:, :, None]).pow(2).sum(-1).pow(.5)
-            verts_dist_weight = (vert_dists <= self.dist_thr).to(self.device).type(torch.float32) * self.kappas['near'] + torch.eye(kps.shape[1]).to(self.device).type(torch.float32).unsqueeze(dim=0) * (self.kappas['pos'] - self.kappas['near'])
-        else:
-            verts_dist_weight = self.verts_dist_weight
-            
         if sample_indexs is None:
             # CoKe loss only -> for pose
-            if verts_dist_weight.dim() == 2:
-                verts_dist_weight = verts_dist_weight[None]
-            get = torch.cat([verts_dist_weight, torch.ones(verts_dist_weight.shape[0: 2] + (self.n_noise, ), device=verts_dist_weight.device) * self.kappas['clutter']], dim=2)
-            if get.shape[0] == 1:
-                assert dtype_template is not None
-                b_ = dtype_template.shape[0]
-                get = get.expand(b_, -1, -1).contiguous()
+            if kps is not None:
+                # Near keypoints of each keypoint in its image, row b * K + k of the neighbour list
+                b_, n_verts = kps.shape[0], kps.shape[1]
+                groups = torch.arange(b_, device=kps.device).repeat_interleave(n_verts)
+                neighbour_ptr, neighbour_idx = radius_neighbours(kps.reshape(-1, kps.shape[2]).type(torch.float32), self.dist_thr, groups=groups)
+                neighbour_ptr, neighbour_idx = neighbour_ptr.to(self.device), neighbour_idx.to(self.device) % n_verts
             else:
-                b_ = get.shape[0]
-            
-            vert_index = torch.arange(verts_dist_weight.shape[1], device=self.device)[None].long().expand(b_, -1).contiguous()
-
-            if vis_mask is not None:
-                return get[vis_mask], vert_index[vis_mask]
-            else:
-                return get.view(-1), vert_index.view(-1)
+                b_ = dtype_template.shape[0] if dtype_template is not None else vis_mask.shape[0]
+                n_verts = self.vert_sum_num
+                neighbour_ptr, neighbour_idx = self.neighbour_ptr, self.neighbour_idx
+
+            if vis_mask is None:
+                vis_mask = torch.ones((b_, n_verts), dtype=torch.bool, device=self.device)
+            image_idx, vert_index = torch.nonzero(vis_mask.to(self.device), as_tuple=True)
+            mask = CoKeMask(neighbour_ptr, neighbour_idx, image_idx * n_verts + vert_index if kps is not None else vert_index,
+                            vert_index, torch.zeros_like(vert_index), torch.full_like(vert_index, n_verts),
+                            self.kappas, n_verts, n_verts + self.n_noise)
         else:
-            if not enable_cunemo:
-                raise Exception("Multi class in same batch requires CuNeMo (located at ./cu_layers)")
             assert kps is None, 'Current only support verts based distance constrin'
             # Classification & CoKe -> for multiple class of instance in same batch
             
@@ -125,9 +248,18 @@ class MaskCreater():
             if K_padded is None:
                 assert dtype_template is not None
                 K_padded = dtype_template.shape[1]
-            total_size = self.vert_sum_num + self.n_noise
+            if vis_mask is None:
+                vis_mask = torch.ones((sample_indexs.shape[0], K_padded), dtype=torch.bool, device=sample_indexs.device)
+
+            owners = cunemo_torch.gather_idx(sample_indexs, self.mesh_n_list, K_padded)
+            object_idx, source_vert_idx, verts_start, num_verts = [t[vis_mask].to(self.device) for t in owners]
+            vert_index = verts_start + source_vert_idx
+            mask = CoKeMask(self.neighbour_ptr, self.neighbour_idx, vert_index, source_vert_idx, verts_start, num_verts,
+                            self.kappas, self.vert_sum_num, self.vert_sum_num + self.n_noise)
 
-            return get_mask(verts_dist_weight, sample_indexs, self.mesh_n_list, total_size, K_padded, self.kappas['class'], self.kappas['clutter'], mask_sel=vis_mask, n_noise=self.n_noise)
+        if lazy:
+            return mask, vert_index.long()
+        return mask.dense(), vert_index.long()
 
 
 class FeatureBankNeMo(nn.Module):
@@ -139,18 +271,23 @@ class FeatureBankNeMo(nn.Module):
         num_noise=-1,  # n clutter per image
         max_groups=-1,  # n image contains clutter saved
         momentum=0.5,
+        update_mode='batch_mean',  # batch_mean: vertex features averaged over the batch, visible_mean: over the images the vertex is visible in
         **kwargs
     ):
         super().__init__()
 
         stdv = 1.0 / math.sqrt(input_size / 3)
 
-        self.memory_pos = torch.rand(num_pos, input_size).mul_(2 * stdv).add_(-stdv)
-        self.memory_neg = torch.rand(num_noise * max_groups if max_groups > 0 else 0, input_size).mul_(2 * stdv).add_(-stdv)
+        memory_pos = torch.rand(num_pos, input_size).mul_(2 * stdv).add_(-stdv)
+        memory_neg = torch.rand(num_noise * max_groups if max_groups > 0 else 0, input_size).mul_(2 * stdv).add_(-stdv)
 
-        self.memory_pos.requires_grad = False
-        self.memory_neg.requires_grad = False
+        # Vertex features followed by the clutter ring buffer, allocated once and updated in place
+        self._memory = torch.cat([memory_pos, memory_neg], dim=0)
+        self._memory.requires_grad = False
+        self._pending = []
+        self._normalized = False
 
+        self.num_pos = num_pos
         self.num_noise = num_noise
 
         self.lru = 0
@@ -161,29 +298,46 @@ class FeatureBankNeMo(nn.Module):
 
         self.kwargs = kwargs
         self.momentum = momentum
-    
-    def forward(self, x, visible, x_to_bank=None, object_labels=None, vis_mask=None):
+        assert update_mode in ('batch_mean', 'visible_mean'), f'Unknown update_mode {update_mode}'
+        self.update_mode = update_mode
+
+    def apply_update(self):
+        """
+        Write the memory update of the last forward. The update is deferred because the similarities of that forward
+        keep the memory for their backward, so it is applied by the next forward or when the memory is read.
+        """
+        for index, rows in self._pending:
+            self._memory.index_copy_(0, index, rows)
+        self._pending = []
+
+    def forward(self, x, visible, x_to_bank=None, object_labels=None, vis_mask=None, compute_similarity=True):
         """
         x (B, K, C): extracted vertex features
         visible (B, K): vertex visibility, should handle the padded vertex -> padded vertex vis = False
         x_to_bank (B, K, C) or (M, C): can be directly pass to banks, otherwise x_to_bank is reduce_function(x)
         object_labels (B, N_obj_per_img): indicates object class in each image, -1 for padding
         vis_mask: (B, K_padded)
+        compute_similarity: False to only update the bank, when the loss is computed from the memory (coke_loss)
 
         return:
-        similarity (S, N_verts_total + N_noise)
+        similarity (S, N_verts_total + N_noise), None if not compute_similarity
         noise_similarity (B, N_noise, N_verts_total)
         """
+        self.apply_update()
+        memory_pos = self._memory[0:self.num_pos]
+
         if self.num_noise == 0:
             t_ = x
             noise_similarity = torch.zeros(1)
         else:   
             t_ = x[:, 0:(x.shape[1] - self.num_noise), :]
             noise_similarity = torch.matmul(
-                x[:, -self.num_noise:, :], torch.transpose(self.memory_pos, 0, 1)
+                x[:, -self.num_noise:, :], torch.transpose(memory_pos, 0, 1)
             )
         
-        similarity = torch.matmul(t_.view(-1) if vis_mask is None else t_[vis_mask], torch.transpose(self.memory, 0, 1))
+        similarity = None
+        if compute_similarity:
+            similarity = torch.matmul(t_.view(-1) if vis_mask is None else t_[vis_mask], torch.transpose(self._memory, 0, 1))
 
         with torch.no_grad():
             if x_to_bank is None:
@@ -194,26 +348,38 @@ class FeatureBankNeMo(nn.Module):
             if x_to_bank.dim() == 3:
                 # Average reducation
                 if object_labels is None:
-                    x_to_bank = torch.mean(x_to_bank * visible.type(x.dtype)[..., None], dim=0)
+                    x_to_bank = torch.sum(x_to_bank * visible.type(x.dtype)[..., None], dim=0)
+                    x_vis_count = torch.sum(visible.type(x.dtype), dim=0)
                 else:
                     x_to_bank, x_vis_count = gather_features(x_to_bank, weights=visible.type(torch.float32), sample_indexs=object_labels.type(torch.int32), mesh_n_list=self.kwargs.get('mesh_n_list'))
+                if self.update_mode == 'visible_mean':
+                    x_to_bank = x_to_bank / x_vis_count.view(-1, 1).type(x_to_bank.dtype).clamp(min=1)
+                else:
                     x_to_bank = x_to_bank / b_
 
-            # Assume x is aligned to banked features
-            self.memory_pos = F.normalize(self.memory_pos * self.momentum + x_to_bank * (1 - self.momentum), dim=1, p=2, )
+            # Assume x is aligned to banked features. Rows not seen in the batch would only be renormalized, once the
+            # bank is normalized only the rows seen are updated
+            if self._normalized:
+                index = torch.nonzero(torch.any(x_to_bank != 0, dim=1)).squeeze(1)
+            else:
+                index = torch.arange(self.num_pos, device=x_to_bank.device)
+                self._normalized = True
+            self._pending.append((
+                index,
+                F.normalize(memory_pos[index] * self.momentum + x_to_bank[index] * (1 - self.momentum), dim=1, p=2, ),
+            ))
 
             if self.num_noise > 0:
-                if x.shape[0] * self.num_noise > self.memory_neg.shape[0]:
-                    self.memory_neg = x[:, -self.num_noise:, :].contiguous().view(-1, x.shape[2])[0:self.memory_neg.shape[0]]
+                n_neg = self._memory.shape[0] - self.num_pos
+                noise = x[:, -self.num_noise:, :].contiguous().view(-1, x.shape[2])
+                if x.shape[0] * self.num_noise > n_neg:
+                    start, noise = 0, noise[0:n_neg]
                 else:
-                    self.memory_neg = torch.cat(
-                        [
-                            self.memory_neg[0:self.lru * self.num_noise, :],
-                            x[:, -self.num_noise:, :].contiguous().view(-1, x.shape[2]),
-                            self.memory_neg[(self.lru + x.shape[0]) * self.num_noise ::,:],
-                        ],
-                        dim=0,
-                    )[:self.max_lru * self.num_noise]
+                    # Clutter features past the end of the buffer are dropped, the cursor then wraps around
+                    start = self.lru * self.num_noise
+                    noise = noise[0:n_neg - start]
+                if noise.shape[0] > 0:
+                    self._pending.append((torch.arange(self.num_pos + start, self.num_pos + start + noise.shape[0], device=noise.device), noise))
 
             self.lru += x.shape[0]
             self.lru = self.lru % self.max_lru
@@ -223,13 +389,22 @@ class FeatureBankNeMo(nn.Module):
 
     def cuda(self, device=None):
         super().cuda(device)
-        self.memory_pos = self.memory_pos.cuda(device)
-        self.memory_neg = self.memory_neg.cuda(device)
+        self.apply_update()
+        self._memory = self._memory.cuda(device)
         return self
 
     @property
     def memory(self):
-        return torch.cat((self.memory_pos, self.memory_neg), dim=0)
+        self.apply_update()
+        return self._memory
+
+    @property
+    def memory_pos(self):
+        return self.memory[0:self.num_pos]
+
+    @property
+    def memory_neg(self):
+        return self.memory[self.num_pos:]
 
 
 class NearestMemoryManager(nn.Module):
@@ -245,8 +420,13 @@ class NearestMemoryManager(nn.Module):
         max_groups=-1,
         num_noise=-1,
         classification=False,
+        update_mode='batch_mean',
         **kwargs
     ):
+        """
+        update_mode: batch_mean to average the features of a vertex over the batch as in released checkpoints,
+            visible_mean to average them over the images the vertex is visible in
+        """
         super().__init__()
         self.nLem = output_size
         self.K = K
@@ -254,8 +434,10 @@ class NearestMemoryManager(nn.Module):
         self.register_buffer("params", torch.tensor([K, T, -1, momentum]))
         stdv = 1.0 / math.sqrt(input_size / 3)
 
+        # Vertex features followed by the clutter ring buffer, allocated once and updated in place
         self.memory = torch.rand(output_size, input_size).mul_(2 * stdv).add_(-stdv)
         self.memory.requires_grad = False
+        self._normalized = False
 
         self.lru = 0
         if max_groups > 0:
@@ -269,6 +451,8 @@ class NearestMemoryManager(nn.Module):
             self.num_noise = num_noise
 
         self.num_pos = num_pos
+        assert update_mode in ('batch_mean', 'visible_mean'), f'Unknown update_mode {update_mode}'
+        self.update_mode = update_mode
 
         # For classification
         self.classification = classification
@@ -284,6 +468,25 @@ class NearestMemoryManager(nn.Module):
             ) 
         self.accumulate_num.requires_grad = False
 
+    @property
+    def memory(self):
+        self.apply_update()
+        return self._memory
+
+    @memory.setter
+    def memory(self, value):
+        self._memory = value
+        self._pending = []
+
+    def apply_update(self):
+        """
+        Write the memory update of the last forward. The update is deferred because the similarities of that forward
+        keep the memory for their backward, so it is applied by the next forward or when the memory is read.
+        """
+        for index, rows in self._pending:
+            self._memory.index_copy_(0, index, rows)
+        self._pending = []
+
     # x: feature: [128, 128], y: indexes [128] -- a batch of data's index directly from the dataloader.
     def forward(self, x, y, visible, img_label=None):
         n_pos = self.num_pos  # 1024 
@@ -319,17 +522,16 @@ class NearestMemoryManager(nn.Module):
                     x[:, n_pos:, :], torch.transpose(self.memory[0:n_pos, :], 0, 1)
                 )
 
-        n_class = n_pos // group_size
-
         with torch.set_grad_enabled(False):
-            # [n, k, k]
-            y_onehot = one_hot(y, n_class).view(x.shape[0], -1, n_class)
-
             y_idx = y.type(torch.long)
 
             # update memory keypoints
             # [n, k, d]
-            if self.classification:
+            if self.update_mode == 'visible_mean':
+                # y is the row of each feature in the memory, including the category offset for classification
+                get, counts = scatter_vertex_features(x[:, 0:y.shape[1], :], y, visible, n_pos)
+                get = get / counts.clamp(min=1)[:, None]
+            elif self.classification:
                 count_label = torch.bincount(img_label, minlength=len(CATEGORIES))
                 label_weight_onehot = fun_label_onehot(img_label, count_label)
                 get = torch.matmul(label_weight_onehot.transpose(0, 1), (x[:, 0:self.single_cate_pos, :] * visible.type(x.dtype).view(*visible.shape, 1)).view(x.shape[0], -1))
@@ -349,55 +551,39 @@ class NearestMemoryManager(nn.Module):
             else:
                 clutter_start = n_pos
 
+            # Rows not seen in the batch would only be renormalized, once the memory is normalized only the rows seen
+            # are updated
+            memory = self._memory
+            if self._normalized:
+                index = torch.nonzero(torch.any(get != 0, dim=1)).squeeze(1)
+            else:
+                index = torch.arange(n_pos, device=get.device)
+            self._pending.append((
+                index,
+                F.normalize(memory[index] * momentum + get[index] * (1 - momentum), dim=1, p=2),
+            ))
 
             if n_neg > 0:
+                noise = x[:, clutter_start::, :].contiguous().view(-1, x.shape[2])
                 if x.shape[0] > (self.nLem - n_pos) / n_neg:
-                    self.memory = F.normalize(
-                        torch.cat(
-                            [
-                                self.memory[0:n_pos, :] * momentum
-                                + get * (1 - momentum),
-                                x[:, clutter_start::, :]
-                                .contiguous()
-                                .view(-1, x.shape[2])[0 : self.memory.shape[0] - n_pos],
-                            ],
-                            dim=0,
-                        ),
-                        dim=1,
-                        p=2,
-                    )
+                    start, noise = 0, noise[0 : memory.shape[0] - n_pos]
                 else:
-                    neg_parts = torch.cat(
-                        [
-                            self.memory[
-                                n_pos : n_pos + self.lru * n_neg * x.shape[0], :
-                            ],
-                            x[:, clutter_start::, :].contiguous().view(-1, x.shape[2]),
-                            self.memory[
-                                n_pos + (self.lru + 1) * n_neg * x.shape[0] : :, :
-                            ],
-                        ],
-                        dim=0,
-                    )
-
-                    self.memory = F.normalize(
-                        torch.cat(
-                            [
-                                self.memory[0:n_pos, :] * momentum
-                                + get * (1 - momentum),
-                                neg_parts,
-                            ],
-                            dim=0,
-                        ),
-                        dim=1,
-                        p=2,
-                    )
-            else:
-                self.memory = F.normalize(
-                    self.memory[0:n_pos, :] * momentum + get * (1 - momentum),
-                    dim=1,
-                    p=2,
-                )
+                    # Written at the LRU cursor, a batch that does not fit before the end of the buffer wraps around
+                    if (self.lru + 1) * n_neg * x.shape[0] > memory.shape[0] - n_pos:
+                        self.lru = 0
+                    start = self.lru * n_neg * x.shape[0]
+                self._pending.append((
+                    torch.arange(n_pos + start, n_pos + start + noise.shape[0], device=noise.device),
+                    F.normalize(noise, dim=1, p=2),
+                ))
+            elif memory.shape[0] > n_pos:
+                self._memory = memory[0:n_pos]
+
+            if not self._normalized:
+                # The initial memory is random, the first update normalizes all of it. A new tensor is allocated,
+                # the similarities of this forward keep the old one for their backward
+                self._memory = F.normalize(self._memory, dim=1, p=2)
+                self._normalized = True
 
             self.accumulate_num += torch.sum(
                 (visible > 0)
@@ -444,42 +630,16 @@ class NearestMemoryManager(nn.Module):
                 x[:, n_pos:, :], torch.transpose(self.memory[0:n_pos, :], 0, 1)
             )
 
-        n_class = n_pos // group_size
-
         with torch.set_grad_enabled(False):
-            # [n, k, k]
-            y_onehot = one_hot(y, n_class).view(x.shape[0], -1, n_class)
-
-            if not group_size == 1:
-                # [n, k, k * g]
-                y_onehot = (
-                    y_onehot.unsqueeze(2)
-                    .expand(-1, -1, group_size)
-                    .contiguous()
-                    .view(x.shape[0], -1, n_pos)
-                )
-                visible = (
-                    visible.unsqueeze(2)
-                    .expand(-1, -1, group_size)
-                    .contiguous()
-                    .view(x.shape[0], -1, n_pos)
-                )
-
-                y_idx = torch.argmax(
-                    similarity[:, :, 0:n_pos] + y_onehot * 2, dim=2
-                ).type(torch.long)
-            else:
-                y_idx = y.type(torch.long)
+            y_idx = y.type(torch.long)
 
             # update memory keypoints
-            # [n, k, d]
-            get = torch.bmm(
-                torch.transpose(y_onehot, 1, 2),
-                x[:, 0:n_pos, :] * visible.type(x.dtype).view(*visible.shape, 1),
-            )
-
             # [k, d]
-            get = torch.mean(get, dim=0)  # / torch.sum(visible, dim=0).view(-1, 1)
+            get, counts = scatter_vertex_features(x[:, 0:n_pos, :], y, visible, n_pos)
+            if self.update_mode == 'visible_mean':
+                get = get / counts.clamp(min=1)[:, None]
+            else:
+                get = get / x.shape[0]
 
             self.accumulate_num += torch.sum(
                 visible.type(self.accumulate_num.dtype), dim=0
@@ -510,20 +670,16 @@ class NearestMemoryManager(nn.Module):
             # print(visible.shape)
 
             # update memory keypoints
-            # [n, k, k]
-            idx_onehot = one_hot(y, n_pos).view(x.shape[0], -1, n_pos)
-
             # [k, d]
-            get = torch.bmm(
-                torch.transpose(idx_onehot, 1, 2),
-                x[:, 0:n_pos, :] * visible.type(x.dtype).view(*visible.shape, 1),
-            )
-            get = torch.sum(get, dim=0)
+            get, counts = scatter_vertex_features(x[:, 0:n_pos, :], y, visible, n_pos)
 
-            self.memory[0:n_pos, :].copy_(self.memory[0:n_pos, :] + get)
-            self.accumulate_num += torch.sum(
-                visible.type(self.accumulate_num.dtype), dim=0
-            )
+            self.memory[0:n_pos, :].add_(get)
+            if self.update_mode == 'visible_mean':
+                self.accumulate_num += counts.type(self.accumulate_num.dtype)
+            else:
+                self.accumulate_num += torch.sum(
+                    visible.type(self.accumulate_num.dtype), dim=0
+                )
 
     def compute_feature_dist(self, x, vis, loss_foo=torch.nn.functional.mse_loss):
         return (loss_foo(F.normalize(x, p=2, dim=-1), self.memory[0:x.shape[0], None], reduce=False).sum(-1)[..., :vis.shape[-1]] * vis).mean()
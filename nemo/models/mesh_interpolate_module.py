@@ -29,6 +29,25 @@ from nemo.utils import (
 )
 
 
+def get_cached_cameras(module, principal_point=None):
+    """
+    Cameras and keyword arguments to render with a principal point per image. The cameras of the rasterizer are never
+    modified, a clone with the batch size is cached per batch size, so one module can render for several threads.
+
+    principal_point: [n, 2], or None for the principal point of the rasterizer cameras
+    return: dict of keyword arguments for the rasterizer
+    """
+    if principal_point is None:
+        return {}
+    n = principal_point.shape[0]
+    cameras = module._cameras_cache.get(n)
+    if cameras is None:
+        cameras = module.rasterizer.cameras.clone()
+        cameras._N = n
+        module._cameras_cache[n] = cameras
+    return dict(cameras=cameras, principal_point=principal_point)
+
+
 def MeshInterpolateModule(*args, **kwargs):
     rasterizer = kwargs.get('rasterizer')
     if isinstance(rasterizer, MeshRasterizer):
@@ -57,6 +76,7 @@ class MeshInterpolateModuleVoGE(nn.Module):
         self.rasterizer = rasterizer
         self.post_process = post_process
         self.off_set_mesh = off_set_mesh
+        self._cameras_cache = {}
 
     def update_memory(self, memory_bank, ):
         self.memory = memory_bank
@@ -68,6 +88,7 @@ class MeshInterpolateModuleVoGE(nn.Module):
             device = args[0]
         super(MeshInterpolateModuleVoGE, self).to(device)
         self.rasterizer.cameras = self.rasterizer.cameras.to(device)
+        self._cameras_cache = {}
         self.memory = self.memory.to(device)
         self.meshes = self.meshes.to(device)
         return self
@@ -75,14 +96,14 @@ class MeshInterpolateModuleVoGE(nn.Module):
     def cuda(self, device=None):
         return self.to(torch.device("cuda"))
 
-    def forward(self, campos, theta, deform_verts=None, **kwargs):
+    def forward(self, campos, theta, deform_verts=None, principal_point=None, **kwargs):
         R, T = campos_to_R_T(campos, theta, device=campos.device, )
 
         if self.off_set_mesh:
             meshes = self.meshes.offset_verts(deform_verts)
         else:
             meshes = self.meshes
-        get = forward_interpolate_voge(R, T, meshes, self.memory.repeat(R.shape[0], 1), rasterizer=self.rasterizer, )
+        get = forward_interpolate_voge(R, T, meshes, self.memory.repeat(R.shape[0], 1), rasterizer=self.rasterizer, **get_cached_cameras(self, principal_point))
 
         if self.post_process is not None:
             get = self.post_process(get)
@@ -128,8 +149,10 @@ class MeshInterpolateModuleMesh(nn.Module):
         self.rasterizer = rasterizer
         self.post_process = post_process
         self.off_set_mesh = off_set_mesh
+        self._cameras_cache = {}
 
     def update_memory(self, memory_bank, faces=None):
+        self._padded = None
         if type(memory_bank) == list:
             if faces is None:
                 faces = self.faces
@@ -156,22 +179,44 @@ class MeshInterpolateModuleMesh(nn.Module):
             device = args[0]
         super().to(device)
         self.rasterizer.cameras = self.rasterizer.cameras.to(device)
+        self._cameras_cache = {}
         self.face_memory = self.face_memory.to(device)
         self.meshes = self.meshes.to(device)
+        self._padded = None
         return self
 
+    def get_padded(self):
+        """
+        Verts [n_mesh, V, 3], faces [n_mesh, F, 3] padded with -1, valid face mask [n_mesh, F] and face memory
+        [n_mesh, F, 3, c] of the meshes, built once so that rendering some of the meshes is a gather.
+        """
+        if self._padded is None:
+            faces = self.meshes.faces_padded()
+            valid = torch.arange(faces.shape[1], device=faces.device)[None] < self.meshes.num_faces_per_mesh()[:, None]
+            face_memory = self.face_memory.new_zeros(faces.shape[0:2] + self.face_memory.shape[1:])
+            face_memory[valid] = self.face_memory
+            self._padded = (self.meshes.verts_padded(), faces, valid, face_memory)
+        return self._padded
+
     def update_rasterizer(self, rasterizer):
         device = self.rasterizer.cameras.device
         self.rasterizer = rasterizer
         self.rasterizer.cameras = self.rasterizer.cameras.to(device)
+        self._cameras_cache = {}
 
     def cuda(self, device=None):
         return self.to(torch.device("cuda"))
 
     def forward(
-        self, campos, theta, blur_radius=0, deform_verts=None, mode="bilinear", **kwargs
+        self, campos, theta, blur_radius=0, deform_verts=None, mode="bilinear", principal_point=None, mesh_index=None, **kwargs
     ):
+        """
+        principal_point: [n, 2], principal point of each camera, defaults to that of the rasterizer cameras
+        mesh_index: [n, ] or int, with several meshes, the mesh rendered by each camera (or by all of them), e.g. the
+            category of each pose when the meshes of all categories are held by one module
+        """
         R, T = campos_to_R_T(campos, theta, device=campos.device, **kwargs)
+        camera_kwargs = get_cached_cameras(self, principal_point)
 
         if self.off_set_mesh:
             meshes = self.meshes.offset_verts(deform_verts)
@@ -179,7 +224,27 @@ class MeshInterpolateModuleMesh(nn.Module):
             meshes = self.meshes
 
         n_cam = campos.shape[0]
-        if n_cam > 1 and self.n_mesh > 1:
+        if mesh_index is not None:
+            verts, faces, valid, face_memory = self.get_padded()
+            if self.off_set_mesh:
+                verts = meshes.verts_padded()
+            if isinstance(mesh_index, int):
+                mesh_index = [mesh_index] * n_cam
+            mesh_index = torch.as_tensor(mesh_index, device=faces.device).long()
+            # Padded faces of -1 are dropped when the meshes are packed, the valid faces are gathered in the same
+            # row-major order straight from the padded face memory
+            rows, cols = torch.nonzero(valid[mesh_index], as_tuple=True)
+            get = forward_interpolate(
+                R,
+                T,
+                Meshes(verts=verts[mesh_index], faces=faces[mesh_index]),
+                face_memory[mesh_index[rows], cols],
+                rasterizer=self.rasterizer,
+                blur_radius=blur_radius,
+                mode=mode,
+                **camera_kwargs,
+            )
+        elif n_cam > 1 and self.n_mesh > 1:
             get = forward_interpolate(
                 R,
                 T,
@@ -188,6 +253,7 @@ class MeshInterpolateModuleMesh(nn.Module):
                 rasterizer=self.rasterizer,
                 blur_radius=blur_radius,
                 mode=mode,
+                **camera_kwargs,
             )
         elif n_cam > 1 and self.n_mesh == 1:
             get = forward_interpolate(
@@ -200,6 +266,7 @@ class MeshInterpolateModuleMesh(nn.Module):
                 rasterizer=self.rasterizer,
                 blur_radius=blur_radius,
                 mode=mode,
+                **camera_kwargs,
             )
         else:
             get = forward_interpolate(
@@ -210,6 +277,7 @@ class MeshInterpolateModuleMesh(nn.Module):
                 rasterizer=self.rasterizer,
                 blur_radius=blur_radius,
                 mode=mode,
+                **camera_kwargs,
             )
 
         if self.post_process is not None:
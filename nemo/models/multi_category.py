@@ -0,0 +1,150 @@
+import torch
+import torch.nn as nn
+
+from nemo.models.clutter import build_clutter_bank
+from nemo.models.vertex_index import VertexIndex
+from nemo.utils import construct_class_by_name
+from nemo.utils import load_off
+
+
+def get_bbox_mask(bbox, size, down_sample_rate=8):
+    """
+    Mask of the feature map cells covered by each bounding box, with the same rounding as cropping the feature map
+    with feature_map[..., h0 // down_sample_rate : h1 // down_sample_rate, w0 // ... : w1 // ...].
+
+    bbox: [b, 4], (h0, h1, w0, w1) in image pixels
+    size: (H, W) of the feature map
+    return: bool mask, [b, H, W]
+    """
+    bbox = torch.div(torch.as_tensor(bbox), down_sample_rate, rounding_mode='floor').long()
+    rows = torch.arange(size[0], device=bbox.device)
+    cols = torch.arange(size[1], device=bbox.device)
+    mask_h = (rows[None] >= bbox[:, 0:1]) & (rows[None] < bbox[:, 1:2])
+    mask_w = (cols[None] >= bbox[:, 2:3]) & (cols[None] < bbox[:, 3:4])
+    return mask_h[:, :, None] & mask_w[:, None, :]
+
+
+def load_category_bank(checkpoint, mesh_path, device='cpu'):
+    """
+    Split the memory of a NeMo checkpoint into the vertex features and the clutter feature, as NeMo._build_inference.
+
+    checkpoint: path or loaded checkpoint dict
+    return: feature bank [V, c], clutter feature [c, ]
+    """
+    if isinstance(checkpoint, str):
+        checkpoint = torch.load(checkpoint, map_location=device)
+    xvert, _ = load_off(mesh_path, to_torch=True)
+    num_verts = int(xvert.shape[0])
+
+    memory = checkpoint['memory'].detach().to(device)
+    return memory[0:num_verts], build_clutter_bank(memory[num_verts:])[0]
+
+
+class MultiCategoryScorer:
+    """
+    Score feature maps against the feature banks of several categories at once, for classification with a backbone
+    shared by all categories.
+
+    The vertex features of all categories are padded to the largest mesh and stacked with the clutter features, so a
+    single matmul gives every vertex and clutter similarity of a feature map. The score of a category is
+    NeMo.fast_inference: the maximum of its best vertex and its clutter similarity, averaged over the bounding box. With
+    several clutter components, the clutter similarity is that of the closest one as in score_clutter.
+    With index_cfg (inference.vertex_index) the best vertex of each category is looked up in a VertexIndex instead.
+    """
+
+    def __init__(self, feature_banks, clutter_banks, categories, down_sample_rate=8, batch_size=8, index_cfg=None):
+        """
+        feature_banks: list of [V_i, c], vertex features of each category
+        clutter_banks: list of [c, ] or [K, c], clutter features of each category
+        """
+        self.categories = list(categories)
+        self.down_sample_rate = down_sample_rate
+        self.batch_size = batch_size
+
+        n_cate = len(feature_banks)
+        max_verts = max(f.shape[0] for f in feature_banks)
+        c = feature_banks[0].shape[1]
+
+        bank = feature_banks[0].new_zeros((n_cate, max_verts, c))
+        self.pad_mask = torch.ones((n_cate, max_verts), dtype=torch.bool, device=bank.device)
+        for i, f in enumerate(feature_banks):
+            bank[i, 0:f.shape[0]] = f
+            self.pad_mask[i, 0:f.shape[0]] = False
+
+        # Categories with fewer clutter components repeat their first one, which leaves the max unchanged
+        clutter_banks = [cb.view(-1, c) for cb in clutter_banks]
+        self.num_clutter = max(cb.shape[0] for cb in clutter_banks)
+        clutter = torch.stack([torch.cat([cb, cb[0:1].expand(self.num_clutter - cb.shape[0], -1)], dim=0) for cb in clutter_banks])
+
+        # [n_cate * max_verts + n_cate * K, c]
+        self.bank = torch.cat([bank.view(-1, c), clutter.view(-1, c)], dim=0)
+        self.max_verts = max_verts
+
+        self.vertex_indices = None
+        if index_cfg is not None and index_cfg.get('enabled', True):
+            self.vertex_indices = [VertexIndex.from_config(f, index_cfg) for f in feature_banks]
+
+    @classmethod
+    def from_checkpoints(cls, categories, checkpoint, mesh_path, device='cuda:0', **kwargs):
+        """
+        checkpoint, mesh_path: paths, formatted with the category name if they contain {:s}
+        """
+        feature_banks, clutter_banks = [], []
+        for cate in categories:
+            feature_bank, clutter_bank = load_category_bank(
+                checkpoint.format(cate), mesh_path.format(cate) if '{:s}' in mesh_path else mesh_path, device=device
+            )
+            feature_banks.append(feature_bank)
+            clutter_banks.append(clutter_bank)
+        return cls(feature_banks, clutter_banks, categories, **kwargs)
+
+    def to(self, device):
+        self.bank = self.bank.to(device)
+        self.pad_mask = self.pad_mask.to(device)
+        if self.vertex_indices is not None:
+            self.vertex_indices = [index.to(device) for index in self.vertex_indices]
+        return self
+
+    @torch.no_grad()
+    def __call__(self, feature_map, bbox):
+        """
+        feature_map: [b, c, H, W], output of net.module.forward_test
+        bbox: [b, 4], (h0, h1, w0, w1) in image pixels
+        return: similarity of each image to each category, [b, n_cate]
+        """
+        b, c, H, W = feature_map.shape
+        n_cate = len(self.categories)
+        mask = get_bbox_mask(bbox.to(feature_map.device), (H, W), self.down_sample_rate).view(b, 1, H * W)
+        bank = self.bank.to(feature_map.dtype)
+
+        scores = []
+        for i in range(0, b, self.batch_size):
+            predicted_map = feature_map[i:i + self.batch_size].reshape(-1, c, H * W)
+            if self.vertex_indices is not None:
+                object_score = torch.stack([index.max_similarity_map(predicted_map) for index in self.vertex_indices], dim=1)
+                clutter_score = torch.matmul(bank[n_cate * self.max_verts:], predicted_map)
+                clutter_score = clutter_score.view(-1, n_cate, self.num_clutter, H * W).max(dim=2)[0]
+            else:
+                # [N, c] x [b', c, HW] -> [b', N, HW]
+                sim = torch.matmul(bank, predicted_map)
+                vertex_sim = sim[:, 0:n_cate * self.max_verts].view(-1, n_cate, self.max_verts, H * W)
+                vertex_sim = vertex_sim.masked_fill(self.pad_mask[None, :, :, None], float('-inf'))
+                object_score = vertex_sim.max(dim=2)[0]
+                clutter_score = sim[:, n_cate * self.max_verts:].view(-1, n_cate, self.num_clutter, H * W).max(dim=2)[0]
+            similarity = torch.maximum(object_score, clutter_score)
+
+            m = mask[i:i + self.batch_size]
+            scores.append(torch.sum(similarity * m, dim=2) / torch.sum(m, dim=2))
+        return torch.cat(scores, dim=0)
+
+
+def build_shared_backbone(backbone, checkpoint, device='cuda:0'):
+    """
+    Backbone of a NeMo checkpoint in eval mode, wrapped as in NeMo._build_inference.
+    """
+    if isinstance(checkpoint, str):
+        checkpoint = torch.load(checkpoint, map_location=device)
+    net = nn.DataParallel(construct_class_by_name(**backbone)).to(device)
+    net.load_state_dict(checkpoint['state'])
+    net.eval()
+    return net
@@ -10,18 +10,25 @@ from pytorch3d.structures import Meshes
 from pytorch3d.transforms import Transform3d
 
 from nemo.models.base_model import BaseModel
+from nemo.models.clutter import build_clutter_bank
+from nemo.models.clutter import score_clutter
+from nemo.models.coke_loss import coke_loss
 from nemo.models.feature_banks import StaticLatentMananger, MaskCreater
 from nemo.models.mesh_interpolate_module import MeshInterpolateModule
+from nemo.models.multi_category import get_bbox_mask
 from nemo.models.solve_pose import pre_compute_kp_coords
 from nemo.models.solve_pose import solve_pose
 from nemo.models.batch_solve_pose import get_pre_render_samples
 from nemo.models.batch_solve_pose import solve_pose as batch_solve_pose
+from nemo.models.template_cache import get_template_cache_key
+from nemo.models.template_cache import get_pre_render_samples_cached
+from nemo.models.vertex_index import VertexIndex
 from nemo.models.project_kp import func_multi_select
 
 from nemo.utils import center_crop_fun
 from nemo.utils import construct_class_by_name, get_obj_by_name
+from nemo.utils import get_abs_path
 from nemo.utils import get_param_samples
-from nemo.utils import normalize_features
 from nemo.utils import pose_error, iou, pre_process_mesh_pascal, load_off
 from nemo.utils.pascal3d_utils import IMAGE_SIZES, CATEGORIES
 from nemo.utils.meshloader import MeshLoader
@@ -30,6 +37,24 @@ from nemo.models.project_kp import PackedRaster
 from PIL import Image
 
 
+def resize_masks(masks, size):
+    """
+    Nearest neighbour resize of a batch of masks with a single cv2 call, the batch is resized as channels.
+
+    masks: [b, h, w]
+    size: (H, W)
+    return: [b, H, W]
+    """
+    b = masks.shape[0]
+    resized = []
+    # cv2 supports at most 512 channels
+    for i in range(0, b, 512):
+        chunk = np.ascontiguousarray(masks[i:i + 512].transpose(1, 2, 0))
+        chunk = cv2.resize(chunk, dsize=(size[1], size[0]), interpolation=cv2.INTER_NEAREST)
+        resized.append(chunk.reshape(size[0], size[1], -1).transpose(2, 0, 1))
+    return np.concatenate(resized, axis=0)
+
+
 class NeMo(BaseModel):
     def __init__(
         self,
@@ -177,15 +202,28 @@ class NeMo(BaseModel):
         else:
             kpvis_bool = kpvis
 
-        feature_similarity, noise_similarity = self.memory_bank(features, kpvis, object_labels=labels, vis_mask=kpvis_bool)
-
-        feature_similarity /= self.training_params.T
-        mask_distance_legal, y_idx = self.training_mask_creater(sample_indexs=labels, 
-                                                                vis_mask=kpvis_bool, 
-                                                                kps=None if self.training_params.remove_near_mode == 'vert' else kp, 
-                                                                dtype_template=kpvis_bool)
-        # import ipdb; ipdb.set_trace()
-        loss_main = nn.CrossEntropyLoss(reduction="none").to(self.ext_gpu)(feature_similarity - mask_distance_legal, y_idx)
+        if self.training_params.get('fused_loss', False):
+            # The memory before this step's update, the bank applies the update on its next forward
+            memory = self.memory_bank.memory
+            _, noise_similarity = self.memory_bank(features, kpvis, object_labels=labels, vis_mask=kpvis_bool, compute_similarity=False)
+            mask_distance_legal, y_idx = self.training_mask_creater(sample_indexs=labels, 
+                                                                    vis_mask=kpvis_bool, 
+                                                                    kps=None if self.training_params.remove_near_mode == 'vert' else kp, 
+                                                                    dtype_template=kpvis_bool,
+                                                                    lazy=True)
+            vertex_features = features[:, 0:features.shape[1] - self.num_noise][kpvis_bool]
+            loss_main = coke_loss(vertex_features, memory, y_idx, mask=mask_distance_legal, temperature=self.training_params.T,
+                                  chunk_size=self.training_params.get('loss_chunk_size', 4096))
+        else:
+            feature_similarity, noise_similarity = self.memory_bank(features, kpvis, object_labels=labels, vis_mask=kpvis_bool)
+
+            feature_similarity /= self.training_params.T
+            mask_distance_legal, y_idx = self.training_mask_creater(sample_indexs=labels, 
+                                                                    vis_mask=kpvis_bool, 
+                                                                    kps=None if self.training_params.remove_near_mode == 'vert' else kp, 
+                                                                    dtype_template=kpvis_bool)
+            # import ipdb; ipdb.set_trace()
+            loss_main = nn.CrossEntropyLoss(reduction="none").to(self.ext_gpu)(feature_similarity - mask_distance_legal, y_idx)
         loss_main = torch.mean(loss_main)
 
         if self.num_noise > 0:
@@ -247,13 +285,16 @@ class NeMo(BaseModel):
             .numpy()
         )
         self.feature_bank = torch.from_numpy(memory)
-        self.clutter_bank = torch.from_numpy(clutter).to(self.device)
-        self.clutter_bank = normalize_features(
-            torch.mean(self.clutter_bank, dim=0)
-        ).unsqueeze(0)
+        self.clutter_bank = build_clutter_bank(
+            torch.from_numpy(clutter).to(self.device),
+            num_components=self.inference_params.get('clutter_components', 1),
+        )
         self.kp_features = self.checkpoint["memory"][
             0 : self.memory_bank.memory.shape[0]
         ].to(self.device)
+        self.vertex_index = VertexIndex.from_config(
+            self.kp_features, self.inference_params.get('vertex_index', None)
+        )
 
         image_h, image_w = self.dataset_config.image_sizes[self.cate]
         # render_image_size = max(image_h, image_w) // self.down_sample_rate
@@ -300,14 +341,32 @@ class NeMo(BaseModel):
 
         if 'batch' in self.init_mode:
             dof = int(self.init_mode.split('d_')[0])
-            self.feature_pre_rendered, self.cam_pos_pre_rendered, self.theta_pre_rendered = get_pre_render_samples(
+            render_fn = lambda: get_pre_render_samples(
                 self.inter_module,
                 azum_samples=azimuth_samples,
                 elev_samples=elevation_samples,
                 theta_samples=theta_samples,
                 distance_samples=distance_samples,
-                device=self.device
+                device=self.device,
+                batch_size=self.cfg.inference.get('pre_render_batch_size', 36),
             )
+            if self.cfg.inference.get('pre_render_cache', None) is not None:
+                cache_key = get_template_cache_key(
+                    [xvert, xface, self.feature_bank, azimuth_samples, elevation_samples, theta_samples, distance_samples],
+                    dict(
+                        cameras=self.inference_params.cameras,
+                        raster_settings=self.inference_params.raster_settings,
+                        rasterizer=self.inference_params.rasterizer,
+                        map_shape=map_shape,
+                        center_crop=self.inference_params.get('center_crop', False),
+                        convert_percentage=self.inference_params.get('convert_percentage', 0.5),
+                    )
+                )
+                self.feature_pre_rendered, self.cam_pos_pre_rendered, self.theta_pre_rendered = get_pre_render_samples_cached(
+                    get_abs_path(self.cfg.inference.pre_render_cache), cache_key, render_fn, device=self.device
+                )
+            else:
+                self.feature_pre_rendered, self.cam_pos_pre_rendered, self.theta_pre_rendered = render_fn()
             if dof == 3:
                 assert distance_samples.shape[0] == 1
                 self.record_distance = distance_samples[0]
@@ -323,43 +382,39 @@ class NeMo(BaseModel):
                 theta_samples=theta_samples,
                 distance_samples=distance_samples,
             )
+            # Uploaded once, the keypoint correlation runs on the device
+            self.kp_coords = torch.from_numpy(self.kp_coords).to(self.device)
+            self.kp_vis = torch.from_numpy(self.kp_vis).to(self.device)
 
-    def fast_inference(self, sample):
+        # The model state is only read from here on, every request keeps its own pose parameters and optimizer,
+        # so several threads can evaluate with one model at once
         self.net.eval()
-        bbox = sample['bbox']
-        cls_index = self.cate_index
+        self.net.requires_grad_(False)
+        self.kp_features = self.kp_features.detach()
 
-        n_vertice = self.num_verts
+    def fast_inference(self, sample):
+        """
+        return: similarity of each image to the category, averaged over its bbox, [b, ]
+        """
+        self.net.eval()
         img = sample["img"].to(self.device)
-        score = {}
 
         with torch.no_grad():
             all_predicted_map = self.net.module.forward_test(img)
 
-        B, C, H, W = all_predicted_map.shape
-        all_similarity = []
+            B, C, H, W = all_predicted_map.shape
+            predicted_map = all_predicted_map.view(B, C, H * W)
 
-        for i in range(B):
-            object_height = (int(bbox[i][0].item() // 8), int(bbox[i][1].item() // 8))
-            object_width = (int(bbox[i][2].item() // 8), int(bbox[i][3].item() // 8))
-            predicted_map = all_predicted_map[i][..., object_height[0] : object_height[1],object_width[0] : object_width[1],]
-            C, H, W = predicted_map.shape
-            predicted_map = predicted_map.contiguous().view(C, -1)  # [C, H, W] -> [C, HW]
-            
-
-            object_score_per_vertex = torch.matmul(self.feature_bank.to(self.device), predicted_map)  # [N, C] x [C, HW] -> [N, HW]
-            clutter_score = torch.matmul(self.clutter_bank, predicted_map).view(H, W)  # [H, W]
-
-            object_score, vertex_activation_indices = object_score_per_vertex.max(dim=0)
-            similarity = torch.maximum(object_score, clutter_score.view(-1, ))          
-
-            similarity = similarity.view(H, W)  # [HW] -> [H, W]
-            similarity_score = torch.sum(similarity) / (H * W)
-            all_similarity.append(similarity_score)
-
-        return all_similarity
+            if self.vertex_index is not None:
+                object_score = self.vertex_index.max_similarity_map(predicted_map)  # [B, HW]
+            else:
+                object_score = torch.matmul(self.feature_bank.to(self.device), predicted_map).max(dim=1)[0]  # [N, C] x [B, C, HW] -> [B, HW]
+            clutter_score = score_clutter(all_predicted_map, self.clutter_bank).view(B, H * W)  # [B, HW]
+            similarity = torch.maximum(object_score, clutter_score)
 
-            
+            # Mean over the bbox of each image, the bbox is in image pixels
+            mask = get_bbox_mask(sample['bbox'].to(self.device), (H, W), self.down_sample_rate).view(B, H * W)
+            return torch.sum(similarity * mask, dim=1) / torch.sum(mask, dim=1)
 
     def evaluate(self, sample, debug=False):
         self.net.eval()
@@ -431,67 +486,62 @@ class NeMo(BaseModel):
             ckpt[k] = kwargs[k]
         return ckpt
 
-    def predict_inmodal(self, sample, visualize=False):
+    def predict_inmodal(self, sample, visualize=False, chunk_size=128):
+        """
+        chunk_size: number of keypoints scored at a time, bounds the memory to chunk_size x HW per image
+        return: list of preds, one per image
+        """
         self.net.eval()
 
         # sample = self.transforms(sample)
         img = sample["img"].to(self.device)
-        assert len(img) == 1, "The batch size during validation should be 1"
 
         with torch.no_grad():
             feature_map = self.net.module.forward_test(img)
+            B, c, H, W = feature_map.shape
+            predicted_map = feature_map.view(B, c, H * W)
 
-        clutter_score = None
-        if not isinstance(self.clutter_bank, list):
-            clutter_bank = [self.clutter_bank]
-        for cb in clutter_bank:
-            _score = (
-                torch.nn.functional.conv2d(feature_map, cb.unsqueeze(2).unsqueeze(3))
-                .squeeze(0)
-                .squeeze(0)
-            )
-            if clutter_score is None:
-                clutter_score = _score
-            else:
-                clutter_score = torch.max(clutter_score, _score)
-
-        nkpt, c = self.kp_features.shape
-        feature_map_nkpt = feature_map.expand(nkpt, -1, -1, -1)
-        kp_features = self.kp_features.view(nkpt, c, 1, 1)
-        kp_score = torch.sum(feature_map_nkpt * kp_features, dim=1)
-        kp_score, _ = torch.max(kp_score, dim=0)
+            clutter_score = score_clutter(feature_map, self.clutter_bank).view(B, H * W)
 
-        clutter_score = clutter_score.detach().cpu().numpy().astype(np.float32)
-        kp_score = kp_score.detach().cpu().numpy().astype(np.float32)
+            if self.vertex_index is not None:
+                kp_score = self.vertex_index.max_similarity_map(predicted_map)
+            else:
+                # Running max over chunks of keypoints, [chunk, C] x [B, C, HW] -> [B, chunk, HW] -> [B, HW]
+                kp_score = None
+                for i in range(0, self.kp_features.shape[0], chunk_size):
+                    _score = torch.matmul(self.kp_features[i:i + chunk_size], predicted_map).max(dim=1)[0]
+                    kp_score = _score if kp_score is None else torch.maximum(kp_score, _score)
+
+        clutter_score = clutter_score.view(B, H, W).cpu().numpy().astype(np.float32)
+        kp_score = kp_score.view(B, H, W).cpu().numpy().astype(np.float32)
         pred_mask = (kp_score > clutter_score).astype(np.uint8)
-        pred_mask_up = cv2.resize(
-            pred_mask, dsize=(pred_mask.shape[1]*self.down_sample_rate, pred_mask.shape[0]*self.down_sample_rate),
-            interpolation=cv2.INTER_NEAREST)
+        pred_mask_up = resize_masks(pred_mask, (H * self.down_sample_rate, W * self.down_sample_rate))
 
-        pred = {
-            'clutter_score': clutter_score,
-            'kp_score': kp_score,
-            'pred_mask_orig': pred_mask,
-            'pred_mask': pred_mask_up,
-        }
+        preds = []
+        for i in range(B):
+            preds.append({
+                'clutter_score': clutter_score[i],
+                'kp_score': kp_score[i],
+                'pred_mask_orig': pred_mask[i],
+                'pred_mask': pred_mask_up[i],
+            })
 
         if 'inmodal_mask' in sample:
-            gt_mask = sample['inmodal_mask'][0].detach().cpu().numpy()
-            pred['gt_mask'] = gt_mask
-            pred['iou'] = iou(gt_mask, pred_mask_up)
-
-            obj_mask = sample['amodal_mask'][0].detach().cpu().numpy()
-            pred['obj_mask'] = obj_mask
+            gt_mask = sample['inmodal_mask'].detach().cpu().numpy()
+            obj_mask = sample['amodal_mask'].detach().cpu().numpy()
 
             # pred_mask_up[obj_mask == 0] = 0
             thr = 0.8
-            new_mask = (kp_score > thr).astype(np.uint8)
-            new_mask = cv2.resize(new_mask, dsize=(obj_mask.shape[1], obj_mask.shape[0]), interpolation=cv2.INTER_NEAREST)
+            new_mask = resize_masks((kp_score > thr).astype(np.uint8), obj_mask.shape[1:3])
             new_mask[obj_mask == 0] = 0
-            pred['iou'] = iou(gt_mask, new_mask)
-            pred['pred_mask'] = new_mask
 
-        return pred
+            for i, pred in enumerate(preds):
+                pred['gt_mask'] = gt_mask[i]
+                pred['obj_mask'] = obj_mask[i]
+                pred['iou'] = iou(gt_mask[i], new_mask[i])
+                pred['pred_mask'] = new_mask[i]
+
+        return preds
 
     def fix_init(self, sample):
         self.net.train()
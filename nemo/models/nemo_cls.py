@@ -1,16 +1,23 @@
+import time
+from functools import partial
+
 import torch
 import torch.nn as nn
 
 from nemo.models.base_model import BaseModel
+from nemo.models.batch_solve_pose import get_pre_render_samples
+from nemo.models.batch_solve_pose import solve_pose_multi_category
+from nemo.models.clutter import build_clutter_bank
 from nemo.models.feature_banks_cls import mask_remove_near
 from nemo.models.mesh_interpolate_module import MeshInterpolateModule
-from nemo.models.solve_pose import pre_compute_kp_coords
-from nemo.models.solve_pose import solve_pose
+from nemo.models.multi_category import MultiCategoryScorer
+from nemo.models.template_cache import get_template_cache_key
+from nemo.models.template_cache import get_pre_render_samples_cached
 from nemo.utils import center_crop_fun
 from nemo.utils import construct_class_by_name
+from nemo.utils import get_abs_path
 from nemo.utils import get_param_samples
 from nemo.utils import load_off
-from nemo.utils import normalize_features
 from nemo.utils import pose_error
 from nemo.utils.pascal3d_utils import CATEGORIES
 from nemo.utils.pascal3d_utils import IMAGE_SIZES
@@ -112,24 +119,28 @@ class NeMoCls(BaseModel):
 
     def _build_inference(self):
         self.all_num_verts = []
+        all_verts, all_faces = [], []
         assert '{:s}' in self.mesh_path, 'The mesh path should contain {:s} to format paths with categories'
         for cate in CATEGORIES:
-            m_p = self.mesh_path.format(cate)
-            self.all_num_verts.append(load_off(m_p)[0].shape[0])
+            xvert, xface = load_off(self.mesh_path.format(cate), to_torch=True)
+            all_verts.append(xvert)
+            all_faces.append(xface)
+            self.all_num_verts.append(xvert.shape[0])
+        max_verts = max(self.all_num_verts)
 
         net = construct_class_by_name(**self.net_params)
-        self.net = nn.DataParallel(self.net).to(self.device)
+        self.net = nn.DataParallel(net).to(self.device)
         self.net.load_state_dict(self.checkpoint["state"])
 
         self.memory_bank = construct_class_by_name(
             **self.memory_bank_params,
-            output_size=len(CATEGORIES)*max(self.all_num_verts)+self.num_noise*self.max_group,
-            num_pos=len(CATEGORIES)*max(self.all_num_verts),
+            output_size=len(CATEGORIES)*max_verts+self.num_noise*self.max_group,
+            num_pos=len(CATEGORIES)*max_verts,
             n_list_set=self.all_num_verts,
             num_noise=self.num_noise
         ).to(self.device)
         with torch.no_grad():
-            self.memory_bank.memory.copy_(checkpoint['memory'][0:memory_bank.memory.shape[0]])
+            self.memory_bank.memory.copy_(self.checkpoint['memory'][0:self.memory_bank.memory.shape[0]])
 
         image_h, image_w = self.image_sizes['aeroplane']
         render_image_size = max(image_h, image_w) // self.down_sample_rate
@@ -150,22 +161,23 @@ class NeMoCls(BaseModel):
         )
 
         clutter = self.checkpoint["memory"][self.memory_bank.memory.shape[0] :].detach().cpu().numpy()
-        self.clutter_bank = torch.from_numpy(clutter).to(self.device)
-        self.clutter_bank = normalize_features(torch.mean(self.clutter_bank, dim=0)).unsqueeze(0)
+        self.clutter_bank = build_clutter_bank(
+            torch.from_numpy(clutter).to(self.device),
+            num_components=self.inference_params.get('clutter_components', 1),
+        )
 
-        self.inter_module, self.kp_features = {}, {}
-        for idx, cate in enumerate(CATEGORIES):
-            memory = self.checkpoint["memory"][idx*max(self.all_num_verts):(idx+1)*max(self.all_num_verts)].detach().cpu().numpy()
-            feature_bank = torch.from_numpy(memory)
-            self.kp_features[cate] = self.checkpoint["memory"][idx*max(self.all_num_verts):(idx+1)*max(self.all_num_verts)].to(self.device)
-            xvert, xface = load_off(self.mesh_path.format(cate), to_torch=True)
-            self.inter_module[cate] = MeshInterpolateModule(
-                xvert,
-                xface,
-                feature_bank,
-                rasterizer,
-                post_process=center_crop_fun(map_shape, (render_image_size,) * 2),
-            )
+        # The meshes of all categories are held by one module and stay on the device, each pose is rendered with the
+        # mesh of its category through mesh_index
+        memory = self.checkpoint["memory"].detach().cpu()
+        feature_banks = [memory[idx*max_verts:idx*max_verts+self.all_num_verts[idx]] for idx in range(len(CATEGORIES))]
+        self.feature_banks = feature_banks
+        self.inter_module = MeshInterpolateModule(
+            all_verts,
+            all_faces,
+            feature_banks,
+            rasterizer=rasterizer,
+            post_process=center_crop_fun(map_shape, (render_image_size,) * 2),
+        ).to(self.device)
 
         (
             azimuth_samples,
@@ -176,14 +188,61 @@ class NeMoCls(BaseModel):
             py_samples,
         ) = get_param_samples(self.cfg)
 
-        self.poses, self.kp_coords, self.kp_vis = {}, {}, {}
-        for cate in CATEGORIES:
-            self.poses[cate], self.kp_coords[cate], self.kp_vis[cate] = pre_compute_kp_coords(
-                self.mesh_path,
-                azimuth_samples=azimuth_samples,
-                elevation_samples=elevation_samples,
+        # Templates of all categories share the pose grid, they can be kept off the device with inference.template_device
+        template_device = self.inference_params.get('template_device', None) or self.device
+        self.feature_pre_rendered = []
+        for idx, cate in enumerate(CATEGORIES):
+            render_fn = lambda idx=idx: get_pre_render_samples(
+                partial(self.inter_module, mesh_index=idx),
+                azum_samples=azimuth_samples,
+                elev_samples=elevation_samples,
                 theta_samples=theta_samples,
                 distance_samples=distance_samples,
+                device=self.device,
+                batch_size=self.cfg.inference.get('pre_render_batch_size', 36),
+            )
+            if self.cfg.inference.get('pre_render_cache', None) is not None:
+                cache_key = get_template_cache_key(
+                    [all_verts[idx], all_faces[idx], feature_banks[idx], azimuth_samples, elevation_samples, theta_samples, distance_samples],
+                    dict(
+                        cameras=self.inference_params.cameras,
+                        raster_settings=self.inference_params.raster_settings,
+                        rasterizer=self.inference_params.rasterizer,
+                        map_shape=map_shape,
+                        center_crop=True,
+                    )
+                )
+                feature_pre_rendered, self.cam_pos_pre_rendered, self.theta_pre_rendered = get_pre_render_samples_cached(
+                    get_abs_path(self.cfg.inference.pre_render_cache), cache_key, render_fn, device=self.device
+                )
+            else:
+                feature_pre_rendered, self.cam_pos_pre_rendered, self.theta_pre_rendered = render_fn()
+            self.feature_pre_rendered.append(feature_pre_rendered.to(template_device))
+
+        self.build_cascade(self.cfg.inference.get('cascade', None))
+
+        # The model state is only read from here on, so several threads can evaluate with one model at once
+        self.net.eval()
+        self.net.requires_grad_(False)
+
+    def build_cascade(self, cascade):
+        """
+        Early category rejection. Categories are ranked by the initialization loss of their best template ("init") or by
+        the similarity to their feature bank as NeMo.fast_inference ("bank"), only the top_k of each image are refined.
+        cascade: inference.cascade, or None to refine every category
+        """
+        self.cascade_top_k, self.cascade_scorer = None, None
+        if cascade is None or not cascade.get('enabled', True):
+            return
+        self.cascade_top_k = cascade.get('top_k', 3)
+        if cascade.get('score', 'init') == 'bank':
+            # The clutter bank of the refinement, so that both stages score the clutter the same way
+            self.cascade_scorer = MultiCategoryScorer(
+                [f.to(self.device) for f in self.feature_banks],
+                [self.clutter_bank] * len(CATEGORIES),
+                CATEGORIES,
+                down_sample_rate=self.down_sample_rate,
+                index_cfg=self.cfg.inference.get('vertex_index', None),
             )
 
     def step_scheduler(self):
@@ -254,37 +313,44 @@ class NeMoCls(BaseModel):
 
         sample = self.transforms(sample)
         img = sample["img"].to(self.device)
-        assert len(img) == 1, "The batch size during validation should be 1"
 
         with torch.no_grad():
             feature_map = self.net.module.forward_test(img)
 
-        scores, preds = [], []
-        for cate in CATEGORIES:
-            self.inter_module[cate].to(self.device)
-            pred = solve_pose(
-                self.cfg,
-                feature_map,
-                self.inter_module[cate],
-                self.kp_features[cate],
-                self.clutter_bank,
-                self.poses[cate],
-                self.kp_coords[cate],
-                self.kp_vis[cate],
-                debug=debug,
-                device=self.device,
-            )
-            self.inter_module[cate].to('cpu')
-            preds.append(pred)
-            scores.append(pred['final'][0]['score'])
-
-        pred_cate = np.argmin(scores)
-        pred = preds[pred_cate]
+        start_time = time.time()
+        category_prior = None
+        if self.cascade_scorer is not None:
+            if "bbox" in sample:
+                bbox = sample["bbox"]
+            else:
+                bbox = torch.tensor([[0, img.shape[2], 0, img.shape[3]]]).expand(img.shape[0], -1)
+            category_prior = self.cascade_scorer(feature_map, bbox)
+        cascade_time = time.time() - start_time
+
+        # Poses of all categories in one solve, the category of an image is the one with the lowest score
+        preds = solve_pose_multi_category(
+            self.cfg,
+            feature_map,
+            self.inter_module,
+            self.clutter_bank,
+            cam_pos_pre_rendered=self.cam_pos_pre_rendered,
+            theta_pre_rendered=self.theta_pre_rendered,
+            feature_pre_rendered=self.feature_pre_rendered,
+            device=self.device,
+            top_k=self.cascade_top_k,
+            category_prior=category_prior,
+        )
 
-        if "azimuth" in sample and "elevation" in sample and "theta" in sample:
-            pred["pose_error"] = pose_error(sample, pred["final"][0])
+        classification_result = {}
+        for i, pred in enumerate(preds):
+            pred["category"] = CATEGORIES[pred["category_index"]]
+            pred["cascade_time"] = cascade_time / len(preds)
+            if "azimuth" in sample and "elevation" in sample and "theta" in sample:
+                pose_error_ = pose_error({k: sample[k][i] for k in ["azimuth", "elevation", "theta"]}, pred["final"][0])
+                pred["pose_error"] = pose_error_
+                classification_result[sample['this_name'][i]] = (pred["category"], pred['final'][0]['score'], pose_error_)
 
-        return pred
+        return preds, classification_result
 
     def get_ckpt(self, **kwargs):
         ckpt = {}
@@ -91,6 +91,10 @@ class PackedRaster():
         self.cameras = cameras
         self.down_rate = raster_configs.get('down_rate')
 
+        # Cameras of each batch size, built once and never modified afterwards. R, T and the principal point are
+        # passed with every call, so one raster can project for several threads at once
+        self._cameras_cache = {}
+
         if raster_type == 'near' or raster_type == 'triangle':
             raster_setting = RasterizationSettings(image_size=feature_size, blur_radius=raster_configs.get('blur_radius', 0.0), )
             self.raster = MeshRasterizer(raster_settings=raster_setting, cameras=cameras)
@@ -113,6 +117,14 @@ class PackedRaster():
             self.meshes.verts = self.meshes.verts.type(torch.float32)
             self.meshes.sigmas = self.meshes.sigmas.type(torch.float32)
 
+    def get_cameras(self, n):
+        cameras = self._cameras_cache.get(n)
+        if cameras is None:
+            cameras = self.cameras.clone()
+            cameras._N = n
+            self._cameras_cache[n] = cameras
+        return cameras
+
     def step(self):
         if self.raster_type == 'voge' or self.raster_type == 'vogew':
             self.kp_vis_thr -= 0.001 / 5
@@ -132,25 +144,28 @@ class PackedRaster():
             R = torch.bmm(R, rotation_theta(theta, device_=self.cameras.device))
         
         if self.mesh_mode == 'single' and self.raster_type == 'near':
-            this_cameras = self.cameras.clone()
-            this_cameras.R = R
-            this_cameras.T = T
-
             if kwargs.get('principal', None) is not None:
-                this_cameras._N = R.shape[0]
-                this_cameras.principal_point = kwargs.get('principal', None).to(self.cameras.device) / self.down_rate
+                this_cameras = self.get_cameras(R.shape[0])
+                principal_point = kwargs.get('principal', None).to(self.cameras.device) / self.down_rate
+            else:
+                this_cameras = self.cameras
+                principal_point = self.cameras.principal_point
 
-            return get_one_standard(self.raster, this_cameras, self.meshes, **kwargs, **self.kwargs)
+            kwargs = {k: v for k, v in kwargs.items() if k not in ('R', 'T')}
+            return get_one_standard(self.raster, this_cameras, self.meshes, R=R, T=T, principal_point=principal_point, **kwargs, **self.kwargs)
         else:
+            camera_kwargs = {}
             if kwargs.get('principal', None) is not None:
-                self.render.cameras._N = R.shape[0]
-                self.render.cameras.principal_point = kwargs.get('principal', None).to(self.cameras.device) / self.down_rate
+                camera_kwargs = dict(
+                    cameras=self.get_cameras(R.shape[0]),
+                    principal_point=kwargs.get('principal', None).to(self.cameras.device) / self.down_rate,
+                )
 
             n = R.shape[0]
             k = self.meshes.verts.shape[0]
             if self.raster_type == 'voge':
                 # Return voge.fragments
-                frag = self.render(self.meshes, R=R, T=T)
+                frag = self.render(self.meshes, R=R, T=T, **camera_kwargs)
                 get_dict = frag.to_dict()
                 get_dict['start_idx'] = torch.arange(frag.vert_index.shape[0]).to(frag.vert_index.device) 
 
@@ -160,7 +175,7 @@ class PackedRaster():
                 return get_dict, max_weight
             if self.raster_type == 'vogew':
                 # Return voge.fragments
-                frag = self.render(self.meshes, R=R, T=T)
+                frag = self.render(self.meshes, R=R, T=T, **camera_kwargs)
                 get_dict = frag.to_dict()
                 get_dict['start_idx'] = torch.arange(frag.vert_index.shape[0]).to(frag.vert_index.device) 
                 get_weight = torch.zeros((*frag.vert_index.shape[0:-1], self.meshes.verts.shape[0] + 1), device=frag.vert_index.device)
@@ -174,20 +189,20 @@ class PackedRaster():
                 return get_weight[..., 1:]
 
 
-def get_one_standard(raster, camera, mesh, func_of_mesh=func_single, restrict_to_boundary=True, dist_thr=1e-3, **kwargs):
+def get_one_standard(raster, camera, mesh, R, T, principal_point, func_of_mesh=func_single, restrict_to_boundary=True, dist_thr=1e-3, **kwargs):
     # dist_thr => NeMo original repo: cal_occ_one_image: eps
+    # R, T and principal_point are passed to the camera instead of set on it, the camera is shared between calls
     mesh_, verts_ = func_of_mesh(mesh, **kwargs)
 
-    R = camera.R
-    T = camera.T
-
     # Calculate the camera location
     cam_loc = -torch.matmul(torch.inverse(R), T[..., None])[:, :, 0]
     
     # (B, K, 2)
-    project_verts = camera.transform_points(verts_)[..., 0:2].flip(-1)
+    # Composed here as camera.transform_points would, which stores R and T on the shared camera before reading them back
+    world_to_proj = camera.get_world_to_view_transform(R=R, T=T).compose(camera.get_projection_transform(principal_point=principal_point))
+    project_verts = world_to_proj.transform_points(verts_)[..., 0:2].flip(-1)
     # Don't know why, hack. Checked by visualization
-    project_verts = 2 * camera.principal_point[:, None].float().flip(-1) - project_verts
+    project_verts = 2 * principal_point[:, None].float().flip(-1) - project_verts
 
     # (B, K)
     inner_mask = torch.min(camera.image_size.unsqueeze(1) > torch.ones_like(project_verts), dim=-1)[0] & \
@@ -198,8 +213,7 @@ def get_one_standard(raster, camera, mesh, func_of_mesh=func_single, restrict_to
         project_verts = torch.min(project_verts, (camera.image_size.unsqueeze(1) - 1) * torch.ones_like(project_verts))
         project_verts = torch.max(project_verts, torch.zeros_like(project_verts))
 
-    raster.cameras = camera
-    frag = raster(mesh_.extend(R.shape[0]) if mesh_._N == 1 else mesh_, R=R, T=T)
+    frag = raster(mesh_.extend(R.shape[0]) if mesh_._N == 1 else mesh_, R=R, T=T, cameras=camera, principal_point=principal_point)
     true_dist_per_vert = (cam_loc[:, None] - verts_).pow(2).sum(-1).pow(.5)
     face_dist = torch.gather(true_dist_per_vert[:, None].expand(-1, mesh_.faces_padded().shape[1], -1), dim=2, index=mesh_.faces_padded().expand(true_dist_per_vert.shape[0], -1, -1).clamp(min=0))
     
@@ -215,11 +229,6 @@ def get_one_standard(raster, camera, mesh, func_of_mesh=func_single, restrict_to
     sampled_dist_per_vert = torch.nn.functional.grid_sample(depth_, grid.flip(-1), align_corners=False, mode='nearest')[:, 0, 0, :]
 
     vis_mask = torch.abs(sampled_dist_per_vert - true_dist_per_vert) < dist_thr
-    if func_of_mesh is not func_single:
-        with torch.no_grad()
-            for i in range(vis_mask.shape[0]):
-                vis_mask[i, mesh_.num_verts_per_mesh()[i]:] = False
-    
     if func_of_mesh is not func_single:
         with torch.no_grad():
             for i in range(vis_mask.shape[0]):
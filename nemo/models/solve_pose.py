@@ -7,6 +7,7 @@ import torch
 from pytorch3d.renderer import camera_position_from_spherical_angles
 from skimage.feature import peak_local_max
 
+from nemo.models.clutter import score_clutter
 from nemo.utils import call_func_by_name
 from nemo.utils import camera_position_to_spherical_angle
 from nemo.utils import construct_class_by_name
@@ -36,50 +37,45 @@ def get_corr_pytorch(
     batch_size=12,
     device="cuda",
 ):
-    all_corr = []
-
-    begin, end = 0, batch_size
-    while begin < len(px_samples):
-        px_s, py_s = torch.from_numpy(px_samples[begin:end]).to(
-            device
-        ), torch.from_numpy(py_samples).to(device)
-        kpc = torch.from_numpy(kp_coords).to(device)
-        kpv = torch.from_numpy(kp_vis).to(device)
-        kps = torch.from_numpy(kpt_score_map).to(device)
-
-        xv, yv = torch.meshgrid(px_s, py_s)
-        principal_samples = (
-            torch.stack([xv, yv], dim=2).reshape(-1, 1, 2).repeat(1, kpc.shape[1], 1)
-        )
-
-        kpc = kpc.unsqueeze(1).repeat(1, principal_samples.shape[0], 1, 1)
-        kpc += principal_samples
-        kpc = kpc.reshape(-1, kpc.shape[2], 2)
-        kpc = torch.round(kpc / down_sample_rate)
-
-        kpv = kpv.unsqueeze(1).repeat(1, principal_samples.shape[0], 1)
-        kpv = kpv.reshape(-1, kpv.shape[2])
-        kpv[kpc[:, :, 0] < 0] = 0
-        kpv[kpc[:, :, 0] >= hm_w - 1] = 0
-        kpv[kpc[:, :, 1] < 0] = 0
-        kpv[kpc[:, :, 1] >= hm_h - 1] = 0
-
-        kpc[:, :, 0] = torch.clamp(kpc[:, :, 0], min=0, max=hm_w - 1)
-        kpc[:, :, 1] = torch.clamp(kpc[:, :, 1], min=0, max=hm_h - 1)
-        kpc = (kpc[:, :, 1:2] * hm_w + kpc[:, :, 0:1]).long()
+    """
+    Keypoint correlation of every pose at every principal point. The keypoints of all poses are shifted by a chunk
+    of principal points at a time and their scores gathered from the flattened score map.
+    kpt_score_map: [nkpt, hm_h * hm_w], tensor or array
+    kp_coords: [n, nkpt, 2], tensor or array
+    kp_vis: [n, nkpt], tensor or array
+    batch_size: number of principal points evaluated together
+    return: [n, len(px_samples), len(py_samples)]
+    """
+    kps = torch.as_tensor(kpt_score_map, device=device)
+    kpc = torch.as_tensor(kp_coords, device=device)
+    kpv = torch.as_tensor(kp_vis, device=device)
+
+    # Principal points are kept in float64 and added before casting, same rounding as shifting in place
+    xv, yv = torch.meshgrid(
+        torch.as_tensor(px_samples, dtype=torch.float64, device=device),
+        torch.as_tensor(py_samples, dtype=torch.float64, device=device),
+        indexing="ij",
+    )
+    # [p, 2]
+    principal_samples = torch.stack([xv, yv], dim=2).reshape(-1, 2)
+    kpt_index = torch.arange(kps.shape[0], device=device)
 
-        corr = torch.take_along_dim(kps.unsqueeze(0), kpc, dim=2)[:, :, 0]
-        corr = torch.sum(corr * kpv, dim=1)
+    all_corr = []
+    for begin in range(0, principal_samples.shape[0], batch_size):
+        # [n, 1, nkpt, 2] + [1, t, 1, 2] -> [n, t, nkpt, 2]
+        coords = (kpc[:, None] + principal_samples[None, begin:begin + batch_size, None]).to(kpc.dtype)
+        coords = torch.round(coords / down_sample_rate)
+        x, y = coords[..., 0], coords[..., 1]
 
-        all_corr.append(corr.reshape(-1, len(px_s), len(py_s)))
+        # [n, t, nkpt]
+        vis = kpv[:, None] * ((x >= 0) & (x < hm_w - 1) & (y >= 0) & (y < hm_h - 1))
+        index = (torch.clamp(y, min=0, max=hm_h - 1) * hm_w + torch.clamp(x, min=0, max=hm_w - 1)).long()
 
-        begin += batch_size
-        end += batch_size
-        if end > len(px_samples):
-            end = len(px_samples)
+        corr = kps[kpt_index, index]
+        all_corr.append(torch.sum(corr * vis, dim=2))
 
-    corr = torch.cat(all_corr, dim=-2).detach().cpu().numpy()
-    return corr
+    corr = torch.cat(all_corr, dim=1).reshape(-1, len(px_samples), len(py_samples))
+    return corr.detach().cpu().numpy()
 
 
 def solve_pose(
@@ -97,31 +93,16 @@ def solve_pose(
     device="cuda",
 ):
     nkpt, c = kp_features.size()
-    memory = kp_features.view(nkpt, c, 1, 1)
     b, c, hm_h, hm_w = feature_map.size()
     pred = {}
 
     # Step 1: Pre-compute foreground and background features
     start_time = time.time()
-    clutter_score = None
-    if not isinstance(clutter_bank, list):
-        clutter_bank = [clutter_bank]
-    for cb in clutter_bank:
-        _score = (
-            torch.nn.functional.conv2d(feature_map, cb.unsqueeze(2).unsqueeze(3))
-            .squeeze(0)
-            .squeeze(0)
-        )
-        if clutter_score is None:
-            clutter_score = _score
-        else:
-            clutter_score = torch.max(clutter_score, _score)
+    clutter_score = score_clutter(feature_map, clutter_bank).squeeze(0)
 
-    kpt_score_map = torch.sum(
-        feature_map.expand(nkpt, -1, -1, -1) * memory, dim=1
-    )  # (nkpt, H, W)
-    kpt_score_map = kpt_score_map.detach().cpu().numpy()
-    kpt_score_map = kpt_score_map.reshape(nkpt, -1)  # (nkpt, H x W)
+    kpt_score_map = torch.matmul(
+        kp_features, feature_map.view(c, -1)
+    ).detach()  # (nkpt, H x W)
 
     end_time = time.time()
     pred["pre_compute_time"] = end_time - start_time
@@ -218,91 +199,113 @@ def solve_pose(
     pred["pre_rendering_time"] = end_time - start_time
 
     # Step 3: Refine object proposals with pose optimization
+    # All extrema are refined together as one batch of hypotheses
     start_time = end_time
-    refined, object_score_list, seg_map_list = [], [], []
-    for i in range(len(extrema)):
-        C = camera_position_from_spherical_angles(
-            extrema[i]["distance"],
-            extrema[i]["elevation"],
-            extrema[i]["azimuth"],
-            degrees=False,
-            device=device,
-        )
-        C = torch.nn.Parameter(C, requires_grad=True)
-        theta = torch.tensor(extrema[i]["theta"], dtype=torch.float32).to(device)
-        theta = torch.nn.Parameter(theta, requires_grad=True)
-        max_principal = [extrema[i]["px"], extrema[i]["py"]]
-        flow = torch.tensor(
+    n_ext = len(extrema)
+    C = camera_position_from_spherical_angles(
+        torch.tensor([e["distance"] for e in extrema], dtype=torch.float32),
+        torch.tensor([e["elevation"] for e in extrema], dtype=torch.float32),
+        torch.tensor([e["azimuth"] for e in extrema], dtype=torch.float32),
+        degrees=False,
+        device=device,
+    )
+    C = torch.nn.Parameter(C, requires_grad=True)
+    theta = torch.tensor([e["theta"] for e in extrema], dtype=torch.float32).to(device)
+    theta = torch.nn.Parameter(theta, requires_grad=True)
+    flow = torch.tensor(
+        [
             [
-                -(max_principal[0] - hm_w * cfg.model.down_sample_rate / 2)
+                -(e["px"] - hm_w * cfg.model.down_sample_rate / 2)
                 / cfg.model.down_sample_rate
                 * cfg.inference.translation_scale,
-                -(max_principal[1] - hm_h * cfg.model.down_sample_rate / 2)
+                -(e["py"] - hm_h * cfg.model.down_sample_rate / 2)
                 / cfg.model.down_sample_rate
                 * cfg.inference.translation_scale,
-            ],
-            dtype=torch.float32,
-        ).to(device)
-        flow = torch.nn.Parameter(flow, requires_grad=True)
-
-        param_list = [C, theta]
-        if cfg.inference.optimize_translation:
-            param_list.append(flow)
-
-        optim = construct_class_by_name(**cfg.inference.optimizer, params=param_list)
-        scheduler_kwargs = {"optimizer": optim}
-        scheduler = construct_class_by_name(
-            **cfg.inference.scheduler, **scheduler_kwargs
+            ]
+            for e in extrema
+        ],
+        dtype=torch.float32,
+    ).to(device)
+    flow = torch.nn.Parameter(flow, requires_grad=True)
+
+    param_list = [C, theta]
+    if cfg.inference.optimize_translation:
+        param_list.append(flow)
+
+    optim = construct_class_by_name(**cfg.inference.optimizer, params=param_list)
+    scheduler_kwargs = {"optimizer": optim}
+    scheduler = construct_class_by_name(
+        **cfg.inference.scheduler, **scheduler_kwargs
+    )
+
+    def render_score():
+        # [n_ext, c, h, w]
+        projected_map = inter_module(
+            C,
+            theta,
+            mode=cfg.inference.inter_mode,
+            blur_radius=cfg.inference.blur_radius,
+        )
+        flow_map = flow.view(n_ext, 2, 1, 1).expand(-1, -1, hm_h, hm_w)
+        projected_map = flow_warp(
+            projected_map, flow_map / cfg.inference.translation_scale
         )
+        # [n_ext, h, w]
+        return torch.sum(projected_map * feature_map, dim=1)
 
-        for epo in range(cfg.inference.epochs):
-            projected_map = inter_module(
-                C,
-                theta,
-                mode=cfg.inference.inter_mode,
-                blur_radius=cfg.inference.blur_radius,
-            ).squeeze()
-            flow_map = flow.view(1, 2, 1, 1).repeat(1, 1, hm_h, hm_w)
-            projected_map = flow_warp(
-                projected_map.unsqueeze(0), flow_map / cfg.inference.translation_scale
-            )[0]
-            object_score = torch.sum(projected_map * feature_map.squeeze(), dim=0)
-
-            loss = call_func_by_name(
+    def hypothesis_loss(object_score):
+        # [n_ext, ]
+        return torch.cat([
+            call_func_by_name(
                 func_name=cfg.inference.loss,
-                obj_s=object_score,
+                obj_s=object_score[i],
                 clu_s=clutter_score,
                 device=device,
-            )
-
-            loss.backward()
-            optim.step()
-            optim.zero_grad()
+            ).view(1)
+            for i in range(n_ext)
+        ])
+
+    def closure():
+        optim.zero_grad()
+        # The hypotheses do not share parameters, so the summed loss gives each its own gradient
+        loss = hypothesis_loss(render_score())
+        loss.sum().backward()
+        return loss
+
+    for epo in range(cfg.inference.epochs):
+        optim.step(closure)
+
+    # The last closure call may have rendered a rejected line search trial, score the poses that are returned
+    with torch.no_grad():
+        object_score = render_score()
+        loss = hypothesis_loss(object_score)
+
+    (
+        distance_preds,
+        elevation_preds,
+        azimuth_preds,
+    ) = camera_position_to_spherical_angle(C)
 
+    refined, object_score_list, seg_map_list = [], [], []
+    for i in range(n_ext):
         seg_map = (
-            ((object_score > clutter_score) * (object_score > 0.0))
-            .detach()
+            ((object_score[i] > clutter_score) * (object_score[i] > 0.0))
             .cpu()
             .numpy()
             .astype(np.uint8)
         )
         seg_map_list.append(seg_map)
-        object_score_list.append(object_score.squeeze().detach().cpu().numpy())
+        object_score_list.append(object_score[i].cpu().numpy())
 
-        (
-            distance_pred,
-            elevation_pred,
-            azimuth_pred,
-        ) = camera_position_to_spherical_angle(C)
         theta_pred, distance_pred, elevation_pred, azimuth_pred = (
-            theta.item(),
-            distance_pred.item(),
-            elevation_pred.item(),
-            azimuth_pred.item(),
+            theta[i].item(),
+            distance_preds[i].item(),
+            elevation_preds[i].item(),
+            azimuth_preds[i].item(),
         )
         px_pred, py_pred = (
-            -flow[0].item() / cfg.inference.translation_scale,
-            -flow[1].item() / cfg.inference.translation_scale,
+            -flow[i, 0].item() / cfg.inference.translation_scale,
+            -flow[i, 1].item() / cfg.inference.translation_scale,
         )
 
         refined.append(
@@ -319,7 +322,7 @@ def solve_pose(
                     py_pred * cfg.model.down_sample_rate
                     + hm_h * cfg.model.down_sample_rate / 2,
                 ],
-                "score": loss.item(),
+                "score": loss[i].item(),
             }
         )
 
@@ -335,7 +338,7 @@ def solve_pose(
             if result['score'] < min_score:
                 ret = result
                 min_score = result['score']
-        pred['final'] = ret
+        pred['final'] = [ret]
 
     if debug:
         object_score_maps = np.array(object_score_list)
@@ -410,147 +413,60 @@ def pre_compute_kp_coords(
     distance_samples,
     viewport=3000,
 ):
-    """Calculate vertex visibility for cuboid models."""
+    """Project the mesh vertices for every pose of the grid, all poses at once."""
     xvert, _ = load_off(mesh_path)
 
-    xmin, xmax = np.min(xvert[:, 0]), np.max(xvert[:, 0])
-    ymin, ymax = np.min(xvert[:, 1]), np.max(xvert[:, 1])
-    zmin, zmax = np.min(xvert[:, 2]), np.max(xvert[:, 2])
-    xmean = (xmin + xmax) / 2
-    ymean = (ymin + ymax) / 2
-    zmean = (zmin + zmax) / 2
-    pts = [
-        [xmean, ymean, zmin],
-        [xmean, ymean, zmax],
-        [xmean, ymin, zmean],
-        [xmean, ymax, zmean],
-        [xmin, ymean, zmean],
-        [xmax, ymean, zmean],
-    ]
-
-    poses = np.zeros(
-        (
-            len(azimuth_samples)
-            * len(elevation_samples)
-            * len(theta_samples)
-            * len(distance_samples),
-            4,
-        ),
-        dtype=np.float32,
+    # [n, 4], ordered as azimuth -> elevation -> theta -> distance, the last one changes fastest
+    poses = np.stack(
+        np.meshgrid(azimuth_samples, elevation_samples, theta_samples, distance_samples, indexing="ij"),
+        axis=-1,
+    ).reshape(-1, 4).astype(np.float32)
+    azim_, elev_, theta_, dist_ = [poses[:, i].astype(np.float64) for i in range(4)]
+
+    # [n, 3]
+    C = np.stack(
+        [
+            dist_ * np.cos(elev_) * np.sin(azim_),
+            -dist_ * np.cos(elev_) * np.cos(azim_),
+            dist_ * np.sin(elev_),
+        ],
+        axis=1,
     )
-    num_vis_faces = []
-    count = 0
-    for azim_ in azimuth_samples:
-        for elev_ in elevation_samples:
-            for theta_ in theta_samples:
-                for dist_ in distance_samples:
-                    poses[count] = [azim_, elev_, theta_, dist_]
-                    count += 1
-                    if elev_ == 0:
-                        if azim_ in [0, np.pi / 2, np.pi, 3 * np.pi / 2]:
-                            num_vis_faces.append(1)
-                        else:
-                            num_vis_faces.append(2)
-                    else:
-                        if azim_ in [0, np.pi / 2, np.pi, 3 * np.pi / 2]:
-                            num_vis_faces.append(2)
-                        else:
-                            num_vis_faces.append(3)
-
-    kp_coords = np.zeros(
-        (
-            len(azimuth_samples)
-            * len(elevation_samples)
-            * len(theta_samples)
-            * len(distance_samples),
-            len(xvert),
-            2,
-        ),
-        dtype=np.float32,
+    azimuth = -azim_
+    elevation = -(math.pi / 2 - elev_)
+    zeros, ones = np.zeros_like(azimuth), np.ones_like(azimuth)
+
+    # [n, 3, 3], rotation by azimuth and by elevation
+    Rz = np.stack(
+        [
+            np.stack([np.cos(azimuth), -np.sin(azimuth), zeros], axis=1),
+            np.stack([np.sin(azimuth), np.cos(azimuth), zeros], axis=1),
+            np.stack([zeros, zeros, ones], axis=1),
+        ],
+        axis=1,
     )
-    kp_vis = np.ones(
-        (
-            len(azimuth_samples)
-            * len(elevation_samples)
-            * len(theta_samples)
-            * len(distance_samples),
-            len(xvert),
-        ),
-        dtype=np.float32,
+    Rx = np.stack(
+        [
+            np.stack([ones, zeros, zeros], axis=1),
+            np.stack([zeros, np.cos(elevation), -np.sin(elevation)], axis=1),
+            np.stack([zeros, np.sin(elevation), np.cos(elevation)], axis=1),
+        ],
+        axis=1,
     )
-    xvert_ext = np.concatenate((xvert, pts), axis=0)
-    for i, pose_ in enumerate(poses):
-        azim_, elev_, theta_, dist_ = pose_
-
-        C = np.zeros((3, 1))
-        C[0] = dist_ * math.cos(elev_) * math.sin(azim_)
-        C[1] = -dist_ * math.cos(elev_) * math.cos(azim_)
-        C[2] = dist_ * math.sin(elev_)
-        azimuth = -azim_
-        elevation = -(math.pi / 2 - elev_)
-        Rz = np.array(
-            [
-                [math.cos(azimuth), -math.sin(azimuth), 0],
-                [math.sin(azimuth), math.cos(azimuth), 0],
-                [0, 0, 1],
-            ]
-        )  # rotation by azimuth
-        Rx = np.array(
-            [
-                [1, 0, 0],
-                [0, math.cos(elevation), -math.sin(elevation)],
-                [0, math.sin(elevation), math.cos(elevation)],
-            ]
-        )  # rotation by elevation
-        R_rot = np.dot(Rx, Rz)
-        R = np.hstack((R_rot, np.dot(-R_rot, C)))
-        P = np.array([[viewport, 0, 0], [0, viewport, 0], [0, 0, -1]])
-        x3d_ = np.hstack((xvert_ext, np.ones((len(xvert_ext), 1)))).T
-        x3d_ = np.dot(R, x3d_)
-        # x3d_r_ = np.dot(P, x3d_)
-        x2d = np.dot(P, x3d_)
-        x2d[0, :] = x2d[0, :] / x2d[2, :]
-        x2d[1, :] = x2d[1, :] / x2d[2, :]
-        x2d = x2d[0:2, :]
-        R2d = np.array(
-            [
-                [math.cos(theta_), -math.sin(theta_)],
-                [math.sin(theta_), math.cos(theta_)],
-            ]
-        )
-        x2d = np.dot(R2d, x2d).T
-        x2d[:, 1] *= -1
-
-        # principal = np.array([px_, py_], dtype=np.float32)
-        # x2d = x2d + np.repeat(principal[np.newaxis, :], len(x2d), axis=0)
-
-        x2d = x2d[: len(xvert)]
-        kp_coords[i] = x2d
-
-        center3d = x3d_[:, len(xvert) :]
-        face_dist = np.sqrt(
-            np.square(center3d[0, :])
-            + np.square(center3d[1, :])
-            + np.square(center3d[2, :])
-        )
-        ind = np.argsort(face_dist)[: num_vis_faces[i]]
-
-        """
-        # 13 13 5 13x12 + 13x12 + 5x12 + 5x12 + 5x13 + 5x13
-        # 8 17 6 17x8 + 17x8 + 6x8 + 6x8 + 6x17 + 6x17
-        if 0 in ind:
-            kp_vis[i, 0:mesh_face_breaks[0]] = 1
-        if 1 in ind:
-            kp_vis[i, mesh_face_breaks[0]:mesh_face_breaks[1]] = 1
-        if 2 in ind:
-            kp_vis[i, mesh_face_breaks[1]:mesh_face_breaks[2]] = 1
-        if 3 in ind:
-            kp_vis[i, mesh_face_breaks[2]:mesh_face_breaks[3]] = 1
-        if 4 in ind:
-            kp_vis[i, mesh_face_breaks[3]:mesh_face_breaks[4]] = 1
-        if 5 in ind:
-            kp_vis[i, mesh_face_breaks[4]:mesh_face_breaks[5]] = 1
-        """
+    R_rot = np.matmul(Rx, Rz)
+
+    # [n, 3, nkpt]
+    x3d_ = np.matmul(R_rot, xvert.T[None]) - np.matmul(R_rot, C[:, :, None])
+    x2d_x = viewport * x3d_[:, 0] / -x3d_[:, 2]
+    x2d_y = viewport * x3d_[:, 1] / -x3d_[:, 2]
+
+    # [n, nkpt, 2], in-plane rotation by theta, y axis pointing down
+    cos_t, sin_t = np.cos(theta_)[:, None], np.sin(theta_)[:, None]
+    kp_coords = np.stack(
+        [cos_t * x2d_x - sin_t * x2d_y, -(sin_t * x2d_x + cos_t * x2d_y)],
+        axis=2,
+    ).astype(np.float32)
+    kp_vis = np.ones(kp_coords.shape[0:2], dtype=np.float32)
 
     poses = poses.reshape(
         len(azimuth_samples),
@@ -0,0 +1,103 @@
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+import torch
+
+
+def _to_numpy(x):
+    if torch.is_tensor(x):
+        return x.detach().cpu().numpy()
+    return np.asarray(x)
+
+
+def get_template_cache_key(arrays, settings):
+    """
+    Content address of a set of pre-rendered templates.
+
+    arrays: list of tensors / arrays, e.g. mesh vertices, faces, vertex memory and the pose grid
+    settings: dict, camera / rasterization settings, must be json serializable (or str-able)
+    """
+    h = hashlib.sha256()
+    for arr in arrays:
+        arr = np.ascontiguousarray(_to_numpy(arr))
+        h.update(str(arr.dtype).encode())
+        h.update(str(arr.shape).encode())
+        h.update(arr.tobytes())
+    h.update(json.dumps(settings, sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+
+def _cache_paths(cache_dir, key):
+    return os.path.join(cache_dir, f'{key}.npy'), os.path.join(cache_dir, f'{key}.pth')
+
+
+def load_pre_rendered(cache_dir, key, device='cpu'):
+    """
+    Load templates saved by save_pre_rendered. The feature maps are memory-mapped from disk.
+    Return None if the cache is missing, incomplete or does not match the key.
+    """
+    maps_path, meta_path = _cache_paths(cache_dir, key)
+    if not (os.path.isfile(maps_path) and os.path.isfile(meta_path)):
+        return None
+
+    try:
+        meta = torch.load(meta_path, map_location='cpu')
+        # Copy-on-write mapping, pages are only read when the templates are used
+        maps = np.load(maps_path, mmap_mode='c')
+    except Exception as e:
+        logging.warning(f'Failed to load pre-rendered templates from {maps_path}: {e}')
+        return None
+
+    if meta.get('key') != key or tuple(maps.shape) != tuple(meta['shape']) or str(maps.dtype) != meta['dtype']:
+        logging.warning(f'Pre-rendered templates at {maps_path} are stale, rebuilding')
+        return None
+
+    feature_pre_rendered = torch.from_numpy(maps)
+    if torch.device(device).type != 'cpu':
+        feature_pre_rendered = feature_pre_rendered.to(device)
+    return feature_pre_rendered, meta['cam_pos'].to(device), meta['theta'].to(device)
+
+
+def save_pre_rendered(cache_dir, key, feature_pre_rendered, cam_pos_pre_rendered, theta_pre_rendered):
+    os.makedirs(cache_dir, exist_ok=True)
+    maps_path, meta_path = _cache_paths(cache_dir, key)
+    maps = feature_pre_rendered.detach().cpu().numpy()
+
+    # Write to temporary files first, workers started at the same time may share the cache
+    # The meta file is written last, its presence marks a complete entry
+    pid = os.getpid()
+    with open(f'{maps_path}.{pid}.tmp', 'wb') as f:
+        np.save(f, maps)
+    os.replace(f'{maps_path}.{pid}.tmp', maps_path)
+
+    meta = {
+        'key': key,
+        'shape': tuple(maps.shape),
+        'dtype': str(maps.dtype),
+        'cam_pos': cam_pos_pre_rendered.detach().cpu(),
+        'theta': theta_pre_rendered.detach().cpu(),
+    }
+    torch.save(meta, f'{meta_path}.{pid}.tmp')
+    os.replace(f'{meta_path}.{pid}.tmp', meta_path)
+
+
+def get_pre_render_samples_cached(cache_dir, key, render_fn, device='cpu'):
+    """
+    cache_dir: str, directory of the template cache
+    key: str, content address from get_template_cache_key
+    render_fn: callable, () -> (feature_pre_rendered, cam_pos_pre_rendered, theta_pre_rendered), called on cache miss
+    """
+    get = load_pre_rendered(cache_dir, key, device=device)
+    if get is not None:
+        logging.info(f'Loaded pre-rendered templates {key[:12]} from {cache_dir}')
+        return get
+
+    get = render_fn()
+    try:
+        save_pre_rendered(cache_dir, key, *get)
+    except OSError as e:
+        logging.warning(f'Failed to save pre-rendered templates to {cache_dir}: {e}')
+    return get
@@ -0,0 +1,109 @@
+import torch
+
+
+def spherical_kmeans(x, n_clusters, n_iter=10, seed=0):
+    """
+    K-means on the unit sphere, clusters are assigned by inner product.
+
+    x: [n, c]
+    return: centroids [n_clusters, c], assignment of each row [n, ]
+    """
+    generator = torch.Generator().manual_seed(seed)
+    centroids = x[torch.randperm(x.shape[0], generator=generator)[0:n_clusters].to(x.device)].clone()
+    centroids = centroids / centroids.norm(dim=1, keepdim=True).clamp(min=1e-12)
+
+    for _ in range(n_iter):
+        assign = torch.matmul(x, centroids.T).argmax(dim=1)
+        sums = torch.zeros_like(centroids).index_add_(0, assign, x)
+        counts = torch.bincount(assign, minlength=n_clusters)
+        # Empty clusters keep their centroid
+        centroids = torch.where(
+            (counts > 0)[:, None], sums / sums.norm(dim=1, keepdim=True).clamp(min=1e-12), centroids
+        )
+
+    return centroids, torch.matmul(x, centroids.T).argmax(dim=1)
+
+
+class VertexIndex:
+    """
+    Inverted file index over the vertex features of a feature bank, answers which vertex is most similar to each pixel
+    feature and how similar it is.
+
+    The vertex features are clustered into n_lists lists. A query is only compared with the vertices of the n_probe
+    lists whose centroids are most similar to it, about n_probe / n_lists of the cost of the brute-force matmul.
+    Recall grows with n_probe, with exact=True (or n_probe >= n_lists) every vertex is compared as before.
+    """
+
+    def __init__(self, features, n_lists=32, n_probe=4, exact=False, n_iter=10, seed=0):
+        """
+        features: [V, c], vertex features, e.g. the memory of a checkpoint
+        """
+        self.features = features
+        self.n_lists = min(n_lists, features.shape[0])
+        self.n_probe = n_probe
+        self.exact = exact or n_probe >= self.n_lists
+
+        if not self.exact:
+            self.centroids, assign = spherical_kmeans(features, self.n_lists, n_iter=n_iter, seed=seed)
+            self.list_members = [torch.nonzero(assign == l).squeeze(1) for l in range(self.n_lists)]
+            self.list_features = [features[m] for m in self.list_members]
+
+    @classmethod
+    def from_config(cls, features, index_cfg):
+        """
+        index_cfg: inference.vertex_index, or None
+        return: VertexIndex, or None if the index is not enabled
+        """
+        if index_cfg is None or not index_cfg.get('enabled', True):
+            return None
+        return cls(
+            features,
+            n_lists=index_cfg.get('n_lists', 32),
+            n_probe=index_cfg.get('n_probe', 4),
+            exact=index_cfg.get('exact', False),
+            n_iter=index_cfg.get('n_iter', 10),
+            seed=index_cfg.get('seed', 0),
+        )
+
+    def to(self, device):
+        self.features = self.features.to(device)
+        if not self.exact:
+            self.centroids = self.centroids.to(device)
+            self.list_members = [m.to(device) for m in self.list_members]
+            self.list_features = [f.to(device) for f in self.list_features]
+        return self
+
+    @torch.no_grad()
+    def max_similarity(self, queries):
+        """
+        queries: [Q, c]
+        return: similarity to the best vertex found [Q, ], index of that vertex [Q, ]
+        """
+        queries = queries.to(self.features.dtype)
+        if self.exact:
+            return torch.matmul(queries, self.features.T).max(dim=1)
+
+        probe = torch.matmul(queries, self.centroids.T).topk(self.n_probe, dim=1)[1]  # [Q, n_probe]
+        best = torch.full((queries.shape[0], ), float('-inf'), dtype=queries.dtype, device=queries.device)
+        best_index = torch.zeros(queries.shape[0], dtype=torch.long, device=queries.device)
+
+        # Every list is scored with one matmul against the queries that probe it
+        for l in range(self.n_lists):
+            query_index = torch.nonzero((probe == l).any(dim=1)).squeeze(1)
+            if query_index.shape[0] == 0 or self.list_members[l].shape[0] == 0:
+                continue
+            value, index = torch.matmul(queries[query_index], self.list_features[l].T).max(dim=1)
+            better = value > best[query_index]
+            best[query_index] = torch.where(better, value, best[query_index])
+            best_index[query_index] = torch.where(better, self.list_members[l][index], best_index[query_index])
+
+        return best, best_index
+
+    def max_similarity_map(self, feature_map):
+        """
+        feature_map: [b, c, H, W] or [b, c, HW]
+        return: similarity to the best vertex of each pixel, [b, HW]
+        """
+        b, c = feature_map.shape[0:2]
+        queries = feature_map.reshape(b, c, -1).transpose(1, 2).reshape(-1, c)
+        return self.max_similarity(queries)[0].view(b, -1)
@@ -15,6 +15,7 @@ from .features import normalize_features
 from .flow_warp import flow_warp
 from .general import get_abs_path
 from .general import get_param_samples
+from .general import get_param_steps
 from .general import get_pkg_root
 from .general import get_project_root
 from .general import save_src_files
@@ -29,10 +30,12 @@ from .mesh import load_off, rotation_theta
 from .mesh import pre_process_mesh_pascal
 from .mesh import save_off
 from .mesh import vertex_memory_to_face_memory
+from .micro_batcher import MicroBatcher
 from .pose import cal_rotation_matrix
 from .process_camera_parameters import CameraTransformer
 from .process_camera_parameters import Projector2Dto3D
 from .process_camera_parameters import Projector3Dto2D
+from .result_store import ResultStore
 
 
 __all__ = [
@@ -51,6 +54,7 @@ __all__ = [
     "save_src_files",
     "set_seed",
     "get_param_samples",
+    "get_param_steps",
     "Configuration",
     "load_config",
     "prepare_pascal3d_sample",
@@ -69,6 +73,8 @@ __all__ = [
     "flow_warp",
     "normalize_features",
     "cal_rotation_matrix",
+    "MicroBatcher",
+    "ResultStore",
     "pose_error",
     "iou",
     "prepare_pascal3d_sample_det",
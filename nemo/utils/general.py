@@ -143,3 +143,13 @@ def get_param_samples(cfg):
         px_samples,
         py_samples,
     )
+
+
+def get_param_steps(cfg):
+    """
+    Spacing of the azimuth, elevation, theta and distance grid from get_param_samples, 0 for axes with a single sample.
+    """
+    steps = []
+    for samples in get_param_samples(cfg)[0:4]:
+        steps.append(float(samples[1] - samples[0]) if len(samples) > 1 else 0.)
+    return tuple(steps)
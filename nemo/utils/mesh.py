@@ -70,9 +70,10 @@ def set_bary_coords_to_nearest(bary_coords_):
     return (softmax_coords + noise).view(*ori_shape) + exr
 
 
-def rasterize(R, T, meshes, rasterizer, blur_radius=0):
+def rasterize(R, T, meshes, rasterizer, blur_radius=0, **kwargs):
     # It will automatically update the camera settings -> R, T in rasterizer.camera
-    fragments = rasterizer(meshes, R=R, T=T)
+    # kwargs: e.g. cameras and principal_point, used instead of those of the rasterizer
+    fragments = rasterizer(meshes, R=R, T=T, **kwargs)
 
     # Copy from pytorch3D source code, try if it is necessary to do gradient decent
     if blur_radius > 0.0:
@@ -96,9 +97,9 @@ def rasterize(R, T, meshes, rasterizer, blur_radius=0):
 # Calculate interpolated maps -> [n, c, h, w]
 # face_memory.shape: [n_face, 3, c]
 def forward_interpolate(
-    R, T, meshes, face_memory, rasterizer, blur_radius=0, mode="bilinear"
+    R, T, meshes, face_memory, rasterizer, blur_radius=0, mode="bilinear", **kwargs
 ):
-    fragments = rasterize(R, T, meshes, rasterizer, blur_radius=blur_radius)
+    fragments = rasterize(R, T, meshes, rasterizer, blur_radius=blur_radius, **kwargs)
 
     # [n, h, w, 1, d]
     if mode == "nearest":
@@ -148,10 +149,10 @@ def forward_interpolate(
     return out_map
 
 
-def forward_interpolate_voge(R, T, meshes, verts_memory, rasterizer):
+def forward_interpolate_voge(R, T, meshes, verts_memory, rasterizer, **kwargs):
     assert enable_voge
     # pdb.set_trace()
-    fragments = rasterizer(meshes, R=R, T=T)
+    fragments = rasterizer(meshes, R=R, T=T, **kwargs)
 
     out_map = interpolate_attr(fragments, verts_memory)
 
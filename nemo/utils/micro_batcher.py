@@ -0,0 +1,87 @@
+import asyncio
+import collections
+import time
+
+
+class MicroBatcher:
+    """
+    Group requests into batches by key, e.g. (category, image height, image width). A batch is flushed once it holds
+    max_batch_size items, or once its oldest item has waited max_wait seconds.
+    Used from a single asyncio event loop: producers call put, one or more consumers await get.
+    """
+
+    def __init__(self, max_batch_size, max_wait):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+
+        # key -> [(item, enqueue time)], in arrival order of the first item of each key
+        self.pending = collections.OrderedDict()
+        self.ready = collections.deque()
+        self.wakeup = asyncio.Event()
+
+        self.num_items = 0
+        self.num_batches = 0
+        self.max_queue_depth = 0
+        self.total_wait = 0.
+        self.flush_reasons = collections.Counter()
+        self.batch_sizes = collections.Counter()
+
+    @property
+    def queue_depth(self):
+        return sum(len(v) for v in self.pending.values()) + sum(len(b[1]) for b in self.ready)
+
+    def put(self, item, key):
+        group = self.pending.setdefault(key, [])
+        group.append((item, time.time()))
+        if len(group) >= self.max_batch_size:
+            self._flush(key, 'size')
+
+        self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+        self.wakeup.set()
+
+    def _flush(self, key, reason):
+        group = self.pending.pop(key)
+        now = time.time()
+        self.ready.append((key, [item for item, _ in group]))
+
+        self.num_items += len(group)
+        self.num_batches += 1
+        self.total_wait += sum(now - t for _, t in group)
+        self.flush_reasons[reason] += 1
+        self.batch_sizes[len(group)] += 1
+
+    def _flush_expired(self):
+        now = time.time()
+        for key in [k for k, group in self.pending.items() if now - group[0][1] >= self.max_wait]:
+            self._flush(key, 'deadline')
+
+    async def get(self):
+        """
+        return: key, list of items
+        """
+        while True:
+            self._flush_expired()
+            if self.ready:
+                return self.ready.popleft()
+
+            self.wakeup.clear()
+            if self.pending:
+                timeout = min(group[0][1] for group in self.pending.values()) + self.max_wait - time.time()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), max(timeout, 0))
+                except asyncio.TimeoutError:
+                    pass
+            else:
+                await self.wakeup.wait()
+
+    def metrics(self):
+        return {
+            'queue_depth': self.queue_depth,
+            'max_queue_depth': self.max_queue_depth,
+            'num_batches': self.num_batches,
+            'num_items': self.num_items,
+            'batch_fill': self.num_items / max(self.num_batches * self.max_batch_size, 1),
+            'mean_wait': self.total_wait / max(self.num_items, 1),
+            'flush_reasons': dict(self.flush_reasons),
+            'batch_sizes': {str(k): v for k, v in sorted(self.batch_sizes.items())},
+        }
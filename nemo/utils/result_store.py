@@ -0,0 +1,100 @@
+import logging
+import os
+import pickle
+import sqlite3
+
+
+class ResultStore:
+    """
+    Append-only store of per-sample predictions in a SQLite file, keyed by the sample name (this_name).
+    Results are buffered and committed every flush_every batches, so an interrupted evaluation only loses the batches
+    since the last flush and a rerun can skip every sample already in the store.
+
+    fingerprint is a string identifying the run that produced the results, e.g. the checkpoint and the inference
+    config. A store written with a different fingerprint is cleared when it is opened, so results of another run are
+    never mixed in.
+    """
+
+    def __init__(self, path, flush_every=10, fingerprint=None):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.flush_every = max(1, flush_every)
+
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS results (name TEXT PRIMARY KEY, pred BLOB NOT NULL, classification BLOB)"
+        )
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.conn.commit()
+
+        if fingerprint is not None:
+            row = self.conn.execute("SELECT value FROM meta WHERE key = 'fingerprint'").fetchone()
+            if row is not None and row[0] != fingerprint:
+                logging.info(f"Clearing {path}, its results were computed with another checkpoint or config")
+                with self.conn:
+                    self.conn.execute("DELETE FROM results")
+            with self.conn:
+                self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('fingerprint', ?)", (fingerprint, ))
+
+        self.names = set(row[0] for row in self.conn.execute("SELECT name FROM results"))
+        self.pending = []
+        self.num_batches = 0
+
+    def __contains__(self, name):
+        return str(name) in self.names
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, name, pred, classification=None):
+        name = str(name)
+        self.pending.append((
+            name,
+            pickle.dumps(pred),
+            None if classification is None else pickle.dumps(classification),
+        ))
+        self.names.add(name)
+
+    def end_batch(self):
+        self.num_batches += 1
+        if self.num_batches % self.flush_every == 0:
+            self.flush()
+
+    def flush(self):
+        if len(self.pending) == 0:
+            return
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?)", self.pending)
+        self.pending = []
+
+    def load(self, names=None):
+        """
+        names: sample names to load, None for all of them
+        return: dict of name -> pred, dict of name -> classification result of the samples that have one
+        """
+        self.flush()
+        preds, classification = {}, {}
+        for name, pred, cls in self.conn.execute("SELECT name, pred, classification FROM results"):
+            if names is not None and name not in names:
+                continue
+            preds[name] = pickle.loads(pred)
+            if cls is not None:
+                classification[name] = pickle.loads(cls)
+        return preds, classification
+
+    def clear(self):
+        with self.conn:
+            self.conn.execute("DELETE FROM results")
+        self.names = set()
+        self.pending = []
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,111 @@
+import argparse
+import logging
+import time
+
+import numpy as np
+import torch
+
+from nemo.utils import construct_class_by_name
+from nemo.utils import load_config
+from nemo.utils import set_seed
+from nemo.utils import setup_logging
+from nemo.utils.pascal3d_utils import CATEGORIES
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Accuracy and latency of NeMoCls classification with early category rejection")
+    parser.add_argument("--cate", type=str, default=",".join(CATEGORIES), help="comma separated categories of the validation images")
+    parser.add_argument("--config", type=str, required=True)
+    parser.add_argument("--save_dir", type=str, required=True)
+    parser.add_argument("--checkpoint", type=str, required=True)
+    parser.add_argument("--num_batches", type=int, default=5, help="number of validation batches per category")
+    parser.add_argument("--scores", type=str, nargs="+", default=["init", "bank"], help="first stage scores")
+    parser.add_argument("--top_k", type=int, nargs="+", default=[1, 2, 3, 5])
+    parser.add_argument(
+        "--opts", default=None, nargs=argparse.REMAINDER, help="Modify config options"
+    )
+    return parser.parse_args()
+
+
+def run_cascade(cfg, model, samples):
+    correct, kept, thresholds, pose_errors = [], [], [], []
+    torch.cuda.synchronize()
+    start_time = time.time()
+    for label, sample in samples:
+        preds, _ = model.evaluate(dict(sample))
+        for pred in preds:
+            correct.append(pred['category_index'] == label)
+            # The true category survived the first stage if it was refined
+            kept.append(np.isfinite(pred['category_scores'][label]))
+            thresholds.append(pred['cascade_threshold'])
+            if 'pose_error' in pred and correct[-1]:
+                pose_errors.append(pred['pose_error'])
+    torch.cuda.synchronize()
+    total_time = time.time() - start_time
+
+    pose_errors = np.array(pose_errors)
+    return {
+        'accuracy': np.mean(correct),
+        'recall': np.mean(kept),
+        'threshold': np.mean(thresholds),
+        'pi6_acc': np.mean(pose_errors < np.pi / 6) if len(pose_errors) else float('nan'),
+        'time_per_image': total_time / len(correct),
+    }
+
+
+def benchmark(cfg):
+    samples = []
+    for cate in cfg.args.cate.split(','):
+        dataset_kwargs = {"data_type": "val", "category": cate}
+        val_dataset = construct_class_by_name(**cfg.dataset, **dataset_kwargs, training=False)
+        val_dataloader = torch.utils.data.DataLoader(
+            val_dataset, batch_size=cfg.inference.get('batch_size', 1), shuffle=False, num_workers=4
+        )
+        for i, sample in enumerate(val_dataloader):
+            if i >= cfg.args.num_batches:
+                break
+            samples.append((CATEGORIES.index(cate), sample))
+
+    model = construct_class_by_name(
+        **cfg.model,
+        cfg=cfg,
+        cate=CATEGORIES[0],
+        mode="test",
+        checkpoint=cfg.args.checkpoint,
+        device="cuda:0",
+    )
+
+    # Warm up so that the first setting does not pay for cudnn autotuning and allocator growth
+    model.evaluate(dict(samples[0][1]))
+
+    settings = [('full', None)] + [(score, dict(enabled=True, score=score, top_k=k)) for score in cfg.args.scores for k in cfg.args.top_k if k < len(CATEGORIES)]
+    results = {}
+    for score, cascade in settings:
+        model.build_cascade(cascade)
+        results[(score, None if cascade is None else cascade['top_k'])] = run_cascade(cfg, model, samples)
+    model.build_cascade(cfg.inference.get('cascade', None))
+
+    # recall: the true category was among the categories kept by the first stage
+    # threshold: mean first stage score of the last category kept, lower is better for init, higher for bank
+    logging.info(f'{"score":>6s}  {"top_k":>5s}  {"acc":>6s}  {"recall":>6s}  {"thr":>8s}  {"pi/6":>6s}  {"s/img":>7s}  {"speedup":>7s}')
+    full_time = results[('full', None)]['time_per_image']
+    for (score, k), r in results.items():
+        threshold = r['threshold'] if score != 'bank' else -r['threshold']
+        logging.info(f'{score:>6s}  {"-" if k is None else str(k):>5s}  {r["accuracy"]*100:5.1f}%  {r["recall"]*100:5.1f}%  '
+                     f'{threshold:8.4f}  {r["pi6_acc"]*100:5.1f}%  {r["time_per_image"]:7.4f}  {full_time / r["time_per_image"]:7.2f}')
+
+
+def main():
+    args = parse_args()
+
+    setup_logging(args.save_dir)
+    logging.info(args)
+
+    cfg = load_config(args, override=args.opts)
+
+    set_seed(cfg.inference.random_seed)
+    benchmark(cfg)
+
+
+if __name__ == "__main__":
+    main()
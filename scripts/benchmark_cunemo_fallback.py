@@ -0,0 +1,89 @@
+import argparse
+import logging
+import time
+
+import torch
+
+from nemo.models import cunemo_torch
+from nemo.utils import set_seed
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Latency of the PyTorch implementation of the CuNeMo kernels, compared with CuNeMo when it is built")
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--num_meshes", type=int, default=12, help="meshes in the bank")
+    parser.add_argument("--num_verts", type=int, default=1000, help="max verts of a mesh")
+    parser.add_argument("--batch_size", type=int, nargs="+", default=[4, 16, 64])
+    parser.add_argument("--objects_per_image", type=int, default=3)
+    parser.add_argument("--channels", type=int, default=128)
+    parser.add_argument("--n_noise", type=int, default=2560)
+    parser.add_argument("--repeats", type=int, default=5)
+    return parser.parse_args()
+
+
+def timed(fn, repeats, device):
+    fn()
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+    start_time = time.time()
+    for _ in range(repeats):
+        out = fn()
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+    return (time.time() - start_time) / repeats, out
+
+
+def make_inputs(args, batch_size):
+    mesh_n_list = torch.randint(args.num_verts // 2, args.num_verts + 1, (args.num_meshes, )).type(torch.int32).to(args.device)
+    sample_indexs = torch.randint(0, args.num_meshes, (batch_size, args.objects_per_image)).type(torch.int32).to(args.device)
+    # Images with fewer objects are padded with -1
+    sample_indexs[torch.rand(sample_indexs.shape, device=args.device) < 0.3] = -1
+    sample_indexs = torch.sort(sample_indexs, dim=1, descending=True)[0]
+    K_padded = int(args.num_verts * args.objects_per_image)
+
+    verts_dist_weight = (torch.rand((args.num_meshes, args.num_verts, args.num_verts), device=args.device) < 0.01).type(torch.float32) * 1e5
+    features = torch.randn((batch_size, K_padded, args.channels), device=args.device)
+    weights = (torch.rand((batch_size, K_padded), device=args.device) < 0.5).type(torch.float32)
+    mask_sel = weights > 0
+    return mesh_n_list, sample_indexs, K_padded, verts_dist_weight, features, weights, mask_sel
+
+
+def benchmark(args):
+    try:
+        import CuNeMo
+    except ImportError:
+        CuNeMo = None
+    compare = CuNeMo is not None and args.device.startswith("cuda")
+
+    for batch_size in args.batch_size:
+        mesh_n_list, sample_indexs, K_padded, verts_dist_weight, features, weights, mask_sel = make_inputs(args, batch_size)
+        total_size = int(mesh_n_list.sum()) + args.n_noise
+
+        impls = [("torch", cunemo_torch)] + ([("CuNeMo", CuNeMo)] if compare else [])
+        results = {}
+        for name, impl in impls:
+            mask_time, mask = timed(lambda: impl.get_mask(verts_dist_weight, sample_indexs, mesh_n_list, total_size, K_padded, 10., 5., mask_sel=mask_sel, n_noise=args.n_noise), args.repeats, args.device)
+            gather_time, gathered = timed(lambda: impl.gather_features(features, weights, sample_indexs, mesh_n_list), args.repeats, args.device)
+            results[name] = (mask, gathered)
+            logging.info(f"{name:>6s}  batch {batch_size:3d}  get_mask {mask_time * 1000:8.2f} ms  gather_features {gather_time * 1000:8.2f} ms  "
+                         f"mask {tuple(mask[0].shape)}")
+
+        if compare:
+            (mask, gathered), (mask_cuda, gathered_cuda) = results["torch"], results["CuNeMo"]
+            logging.info(f"max difference to CuNeMo: mask {(mask[0] - mask_cuda[0]).abs().max().item():.2e}, "
+                         f"vert_index {(mask[1] - mask_cuda[1]).abs().max().item()}, "
+                         f"features {(gathered[0] - gathered_cuda[0]).abs().max().item():.2e}, "
+                         f"weights {(gathered[1] - gathered_cuda[1]).abs().max().item():.2e}")
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    logging.info(args)
+
+    set_seed(0)
+    benchmark(args)
+
+
+if __name__ == "__main__":
+    main()
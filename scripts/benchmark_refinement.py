@@ -0,0 +1,116 @@
+import argparse
+import logging
+import time
+
+import numpy as np
+import torch
+
+from nemo.utils import construct_class_by_name
+from nemo.utils import load_config
+from nemo.utils import set_seed
+from nemo.utils import setup_logging
+from nemo.utils.configuration import ConfigNode
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Compare pose refinement engines of a NeMo model")
+    parser.add_argument("--cate", type=str, default="aeroplane")
+    parser.add_argument("--config", type=str, required=True)
+    parser.add_argument("--save_dir", type=str, required=True)
+    parser.add_argument("--checkpoint", type=str, required=True)
+    parser.add_argument("--num_batches", type=int, default=10, help="number of validation batches to evaluate")
+    parser.add_argument("--lbfgs_epochs", type=int, default=30)
+    parser.add_argument("--lbfgs_history", type=int, default=10)
+    parser.add_argument(
+        "--opts", default=None, nargs=argparse.REMAINDER, help="Modify config options"
+    )
+    return parser.parse_args()
+
+
+def set_engine(cfg, optimizer, scheduler, epochs):
+    cfg.defrost()
+    cfg.inference.optimizer = ConfigNode(optimizer)
+    cfg.inference.scheduler = ConfigNode(scheduler)
+    cfg.inference.epochs = epochs
+    cfg.freeze()
+
+
+def run_engine(cfg, model, dataloader):
+    pose_errors, iterations, renders = [], [], []
+    torch.cuda.synchronize()
+    start_time = time.time()
+    for i, sample in enumerate(dataloader):
+        if i >= cfg.args.num_batches:
+            break
+        preds, _ = model.evaluate(sample)
+        for pred in preds:
+            pose_errors.append(pred['pose_error'])
+            iterations.append(pred.get('iterations', cfg.inference.epochs))
+            renders.append(pred.get('renders', cfg.inference.epochs))
+    torch.cuda.synchronize()
+    total_time = time.time() - start_time
+
+    pose_errors = np.array(pose_errors)
+    return {
+        'pi6_acc': np.mean(pose_errors < np.pi / 6),
+        'pi18_acc': np.mean(pose_errors < np.pi / 18),
+        'med_err': np.median(pose_errors) / np.pi * 180.0,
+        'iterations': np.mean(iterations),
+        'renders': np.mean(renders),
+        'time_per_image': total_time / len(pose_errors),
+    }
+
+
+def benchmark(cfg):
+    dataset_kwargs = {"data_type": "val", "category": cfg.args.cate}
+    val_dataset = construct_class_by_name(**cfg.dataset, **dataset_kwargs, training=False)
+    val_dataloader = torch.utils.data.DataLoader(
+        val_dataset, batch_size=cfg.inference.get('batch_size', 1), shuffle=False, num_workers=4
+    )
+
+    model = construct_class_by_name(
+        **cfg.model,
+        cfg=cfg,
+        cate=cfg.args.cate,
+        mode="test",
+        checkpoint=cfg.args.checkpoint.format(cfg.args.cate),
+        device="cuda:0",
+    )
+
+    engines = {
+        'config': (dict(cfg.inference.optimizer), dict(cfg.inference.scheduler), cfg.inference.epochs),
+        'lbfgs': (
+            dict(class_name='nemo.models.batch_lbfgs.BatchLBFGS', lr=1.0, history_size=cfg.args.lbfgs_history),
+            dict(class_name='torch.optim.lr_scheduler.ExponentialLR', gamma=1.0),
+            cfg.args.lbfgs_epochs,
+        ),
+    }
+
+    # Warm up so that the first engine does not pay for cudnn autotuning and allocator growth
+    model.evaluate(next(iter(val_dataloader)))
+
+    results = {}
+    for name, (optimizer, scheduler, epochs) in engines.items():
+        set_engine(cfg, optimizer, scheduler, epochs)
+        results[name] = run_engine(cfg, model, val_dataloader)
+
+    # steps: optimizer epochs, renders: closure calls, an L-BFGS epoch renders once per line search trial
+    logging.info(f'{"engine":>8s}  {"pi/6":>6s}  {"pi/18":>6s}  {"med":>6s}  {"steps":>6s}  {"renders":>7s}  {"s/img":>7s}')
+    for name, r in results.items():
+        logging.info(f'{name:>8s}  {r["pi6_acc"]*100:5.1f}%  {r["pi18_acc"]*100:5.1f}%  {r["med_err"]:6.2f}  {r["iterations"]:6.1f}  {r["renders"]:7.1f}  {r["time_per_image"]:7.4f}')
+
+
+def main():
+    args = parse_args()
+
+    setup_logging(args.save_dir.format(args.cate))
+    logging.info(args)
+
+    cfg = load_config(args, override=args.opts)
+
+    set_seed(cfg.inference.random_seed)
+    benchmark(cfg)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+import argparse
+import logging
+import time
+
+import torch
+
+from nemo.models.multi_category import build_shared_backbone
+from nemo.models.multi_category import load_category_bank
+from nemo.models.vertex_index import VertexIndex
+from nemo.utils import construct_class_by_name
+from nemo.utils import load_config
+from nemo.utils import set_seed
+from nemo.utils import setup_logging
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Recall and speed of the vertex feature index against brute force")
+    parser.add_argument("--cate", type=str, default="aeroplane", help="category, or comma separated categories whose banks are stacked")
+    parser.add_argument("--config", type=str, required=True)
+    parser.add_argument("--save_dir", type=str, required=True)
+    parser.add_argument("--checkpoint", type=str, required=True)
+    parser.add_argument("--num_batches", type=int, default=5, help="number of validation batches used as queries")
+    parser.add_argument("--device", type=str, default="cpu", help="device of the index and the queries")
+    parser.add_argument("--n_lists", type=int, nargs="+", default=[16, 32, 64])
+    parser.add_argument("--n_probe", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument(
+        "--opts", default=None, nargs=argparse.REMAINDER, help="Modify config options"
+    )
+    return parser.parse_args()
+
+
+def collect_queries(cfg, categories):
+    net = build_shared_backbone(cfg.model.backbone, cfg.args.checkpoint.format(categories[0]), device="cuda:0")
+    dataset = construct_class_by_name(**cfg.dataset, data_type="val", category=categories[0], training=False)
+    dataloader = torch.utils.data.DataLoader(
+        dataset, batch_size=cfg.inference.get('batch_size', 1), shuffle=False, num_workers=4
+    )
+
+    queries = []
+    for i, sample in enumerate(dataloader):
+        if i >= cfg.args.num_batches:
+            break
+        with torch.no_grad():
+            feature_map = net.module.forward_test(sample["img"].to("cuda:0"))
+        b, c = feature_map.shape[0:2]
+        queries.append(feature_map.view(b, c, -1).transpose(1, 2).reshape(-1, c).cpu())
+    return torch.cat(queries, dim=0)
+
+
+def timed(index, queries):
+    if queries.is_cuda:
+        torch.cuda.synchronize()
+    start_time = time.time()
+    value, vertex = index.max_similarity(queries)
+    if queries.is_cuda:
+        torch.cuda.synchronize()
+    return value, vertex, time.time() - start_time
+
+
+def benchmark(cfg):
+    categories = cfg.args.cate.split(',')
+    device = cfg.args.device
+
+    feature_bank = torch.cat([
+        load_category_bank(cfg.args.checkpoint.format(cate), cfg.model.mesh_path.format(cate) if '{:s}' in cfg.model.mesh_path else cfg.model.mesh_path)[0]
+        for cate in categories
+    ], dim=0).to(device)
+    queries = collect_queries(cfg, categories).to(device)
+    logging.info(f"{feature_bank.shape[0]} vertices of {len(categories)} categories, {queries.shape[0]} pixel queries")
+
+    exact_value, exact_vertex, exact_time = timed(VertexIndex(feature_bank, exact=True), queries)
+
+    logging.info(f'{"n_lists":>8s}  {"n_probe":>8s}  {"recall":>7s}  {"max_gap":>8s}  {"mean_gap":>8s}  {"time":>8s}  {"speedup":>7s}')
+    logging.info(f'{"exact":>8s}  {"-":>8s}  {100.0:6.2f}%  {0.0:8.5f}  {0.0:8.5f}  {exact_time:8.4f}  {1.0:7.2f}')
+    for n_lists in cfg.args.n_lists:
+        for n_probe in cfg.args.n_probe:
+            if n_probe >= n_lists:
+                continue
+            index = VertexIndex(feature_bank, n_lists=n_lists, n_probe=n_probe)
+            value, vertex, index_time = timed(index, queries)
+
+            # Recall is the fraction of pixels whose best vertex is found, the gap is the error of the max similarity
+            recall = torch.mean((vertex == exact_vertex).float()).item()
+            gap = exact_value - value
+            logging.info(f'{n_lists:8d}  {n_probe:8d}  {recall*100:6.2f}%  {gap.max().item():8.5f}  {gap.mean().item():8.5f}  '
+                         f'{index_time:8.4f}  {exact_time / index_time:7.2f}')
+
+
+def main():
+    args = parse_args()
+
+    setup_logging(args.save_dir)
+    logging.info(args)
+
+    cfg = load_config(args, override=args.opts)
+
+    set_seed(cfg.inference.random_seed)
+    benchmark(cfg)
+
+
+if __name__ == "__main__":
+    main()
@@ -26,6 +26,8 @@ import json
 import torch
 from inference_helpers import helper_func_by_task
 
+from nemo.models.multi_category import MultiCategoryScorer
+from nemo.models.multi_category import build_shared_backbone
 from nemo.utils import construct_class_by_name
 from nemo.utils import get_abs_path
 from nemo.utils import load_config
@@ -64,6 +66,11 @@ parser.add_argument('--save_confusion_matrix_path', default=None, type=str)
 parser.add_argument('--visualize_vertex_feat_activation', default=None, type=str)
 parser.add_argument('--data_path', default=None, type=str)
 
+parser.add_argument('--shared_backbone', action='store_true',
+                    help='run the backbone once per image and score all categories together, the categories must share the backbone')
+parser.add_argument('--backbone_checkpoint', default=None, type=str,
+                    help='checkpoint of the shared backbone, defaults to the checkpoint of the first category')
+
 parser.add_argument("--cate", type=str, default="aeroplane")
 parser.add_argument("--config", type=str, required=True)
 parser.add_argument("--save_dir", type=str, required=True)
@@ -110,41 +117,69 @@ if __name__ == '__main__':
         dataset_kwargs = {"data_type": "val", "category": 'all'}
         val_dataset = construct_class_by_name(**cfg.dataset, **dataset_kwargs, training=False)
         
-    for cate in all_categories:
-       
-
-        if not cfg.inference.classification: 
-            dataset_kwargs = {"data_type": "val", "category": cate}
-            val_dataset = construct_class_by_name(**cfg.dataset, **dataset_kwargs, training=False)
-
-        val_dataloader = torch.utils.data.DataLoader(
-            val_dataset, batch_size=cfg.inference.get('batch_size', 1), shuffle=False, num_workers=4
+    if args.shared_backbone:
+        scorer = MultiCategoryScorer.from_checkpoints(
+            all_categories, cfg.args.checkpoint, cfg.model.mesh_path, device=device, down_sample_rate=cfg.model.down_sample_rate,
+            index_cfg=cfg.inference.get('vertex_index', None),
         )
-        print("Finish setting up validation dataloader")
-
-        model = construct_class_by_name(
-            **cfg.model,
-            cfg=cfg,
-            cate=cate,
-            mode="test",
-            checkpoint=cfg.args.checkpoint.format(cate),
-            device="cuda:0",
+        net = build_shared_backbone(
+            cfg.model.backbone, args.backbone_checkpoint or cfg.args.checkpoint.format(all_categories[0]), device=device
         )
+        cls_indices = [ALL_CLASSES.index(cate) for cate in all_categories]
+
+        datasets = [val_dataset] if cfg.inference.classification else [
+            construct_class_by_name(**cfg.dataset, data_type="val", category=cate, training=False) for cate in all_categories
+        ]
+        for dataset in datasets:
+            val_dataloader = torch.utils.data.DataLoader(
+                dataset, batch_size=cfg.inference.get('batch_size', 1), shuffle=False, num_workers=4
+            )
+            for i, sample in enumerate(tqdm(val_dataloader)):
+                with torch.no_grad():
+                    feature_map = net.module.forward_test(sample['img'].to(device))
+                all_similarity = scorer(feature_map, sample['bbox']).cpu().numpy()
+                for image_name, similarity in zip(sample['this_name'], all_similarity):
+                    if image_name not in sim_scores.keys():
+                        sim_scores[image_name] = [0] * len(ALL_CLASSES)
+                        name_list.append(image_name)
+                    for cls_index, similarity_score in zip(cls_indices, similarity):
+                        sim_scores[image_name][cls_index] = float(similarity_score)
 
-        cls_index = ALL_CLASSES.index(cate)
-
-        for i, sample in enumerate(tqdm(val_dataloader)):
-            all_similarity = model.fast_inference(sample)
-            all_image_name = sample['this_name']
-            for j in range(len(all_similarity)):
-                similarity_score = all_similarity[j]
-                image_name = all_image_name[j]
-                if image_name not in sim_scores.keys():
-                    sim_scores[image_name] = [0] * len(ALL_CLASSES)
-                    name_list.append(image_name)
-                    sim_scores[image_name][cls_index] = float(similarity_score)
-                else:
-                    sim_scores[image_name][cls_index] = float(similarity_score)
+    else:
+        # One model per category, each scores the images with its own backbone
+        for cate in all_categories:
+            if not cfg.inference.classification: 
+                dataset_kwargs = {"data_type": "val", "category": cate}
+                val_dataset = construct_class_by_name(**cfg.dataset, **dataset_kwargs, training=False)
+
+            val_dataloader = torch.utils.data.DataLoader(
+                val_dataset, batch_size=cfg.inference.get('batch_size', 1), shuffle=False, num_workers=4
+            )
+            print("Finish setting up validation dataloader")
+
+            model = construct_class_by_name(
+                **cfg.model,
+                cfg=cfg,
+                cate=cate,
+                mode="test",
+                checkpoint=cfg.args.checkpoint.format(cate),
+                device="cuda:0",
+            )
+
+            cls_index = ALL_CLASSES.index(cate)
+
+            for i, sample in enumerate(tqdm(val_dataloader)):
+                all_similarity = model.fast_inference(sample)
+                all_image_name = sample['this_name']
+                for j in range(len(all_similarity)):
+                    similarity_score = all_similarity[j]
+                    image_name = all_image_name[j]
+                    if image_name not in sim_scores.keys():
+                        sim_scores[image_name] = [0] * len(ALL_CLASSES)
+                        name_list.append(image_name)
+                        sim_scores[image_name][cls_index] = float(similarity_score)
+                    else:
+                        sim_scores[image_name][cls_index] = float(similarity_score)
 
     correct = 0
     y_pred = []
@@ -9,6 +9,7 @@ from inference_helpers import helper_func_by_task
 from nemo.utils import construct_class_by_name
 from nemo.utils import get_abs_path
 from nemo.utils import load_config
+from nemo.utils import ResultStore
 from nemo.utils import save_src_files
 from nemo.utils import set_seed
 from nemo.utils import setup_logging
@@ -20,6 +21,7 @@ def parse_args():
     parser.add_argument("--config", type=str, required=True)
     parser.add_argument("--save_dir", type=str, required=True)
     parser.add_argument("--checkpoint", type=str, required=True)
+    parser.add_argument("--fresh", action="store_true", help="discard the results stored by previous runs")
     parser.add_argument(
         "--opts", default=None, nargs=argparse.REMAINDER, help="Modify config options"
     )
@@ -58,28 +60,35 @@ def inference(cfg):
         )
 
         if hasattr(cfg.dataset, 'occ_level'):
-            save_pred_path = os.path.join(get_abs_path(cfg.args.save_dir.format(cate)), f'{cfg.dataset.name}_occ{cfg.dataset.occ_level}_{cate}_val.pth')
-            save_cls_pred_path = os.path.join(get_abs_path(cfg.args.save_dir.format(cate)), f'{cfg.dataset.name}_occ{cfg.dataset.occ_level}_{cate}_cls_val.json')
+            save_name = f'{cfg.dataset.name}_occ{cfg.dataset.occ_level}_{cate}'
         else:
-            save_pred_path = os.path.join(get_abs_path(cfg.args.save_dir.format(cate)), f'{cfg.dataset.name}_{cate}_val.pth')
-            save_cls_pred_path = os.path.join(get_abs_path(cfg.args.save_dir.format(cate)), f'{cfg.dataset.name}_{cate}_cls_val.json')
-        if os.path.isfile(save_pred_path):
-            cached_pred = torch.load(save_pred_path)
+            save_name = f'{cfg.dataset.name}_{cate}'
+        save_pred_path = os.path.join(get_abs_path(cfg.args.save_dir.format(cate)), f'{save_name}_val.pth')
+        save_cls_pred_path = os.path.join(get_abs_path(cfg.args.save_dir.format(cate)), f'{save_name}_cls_val.json')
+        save_store_path = os.path.join(get_abs_path(cfg.args.save_dir.format(cate)), f'{save_name}_val.sqlite')
+
+        # Predictions are appended to the store every few batches, a rerun only evaluates the samples not stored yet.
+        # The stored results are only reused with the same checkpoint and config
+        checkpoint = cfg.args.checkpoint.format(cate)
+        fingerprint = json.dumps({
+            "checkpoint": os.path.abspath(checkpoint),
+            "checkpoint_mtime": os.path.getmtime(checkpoint) if os.path.isfile(checkpoint) else None,
+            "model": str(cfg.model),
+            "inference": str(cfg.inference),
+        }, sort_keys=True)
+        with ResultStore(save_store_path, flush_every=cfg.inference.get('store_flush_batches', 10), fingerprint=fingerprint) as store:
+            if cfg.args.fresh:
+                store.clear()
+            elif len(store) > 0:
+                logging.info(f"Resuming from {len(store)} stored results in {save_store_path}")
             results = helper_func_by_task[cfg.task](
                 cfg,
                 cate,
                 model,
                 val_dataloader,
-                cached_pred=cached_pred
+                store=store,
             )
-        else:
-            results = helper_func_by_task[cfg.task](
-                cfg,
-                cate,
-                model,
-                val_dataloader,
-            )
-            torch.save(results["save_pred"], save_pred_path)
+        torch.save(results["save_pred"], save_pred_path)
 
         if cfg.inference.classification:
             out_file = open(save_cls_pred_path, "w")
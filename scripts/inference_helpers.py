@@ -4,40 +4,77 @@ sys.path.append('./')
 import logging
 
 import numpy as np
+import torch
 from tqdm import tqdm
 
 from nemo.utils import pose_error
 
 
+def select_samples(sample, index):
+    """
+    Samples of a collated batch at the given positions.
+    """
+    b = len(sample['this_name'])
+    selected = {}
+    for k, v in sample.items():
+        if torch.is_tensor(v) and v.dim() > 0 and v.shape[0] == b:
+            selected[k] = v[index]
+        elif isinstance(v, (list, tuple)) and len(v) == b:
+            selected[k] = [v[i] for i in index]
+        else:
+            selected[k] = v
+    return selected
+
+
 def inference_3d_pose_estimation(
     cfg,
     cate,
     model,
     dataloader,
-    cached_pred=None
+    store=None
 ):
+    """
+    store: ResultStore, predictions are appended to it as they are computed, samples already in it are skipped, and the
+        results are computed from it
+    """
+    names = []
     save_pred = {}
     save_classification = {}
+    for i, sample in enumerate(tqdm(dataloader, desc=f"{cfg.task}_{cate}")):
+        batch_names = [str(name_) for name_ in sample['this_name']]
+        names += batch_names
+
+        missing = [j for j, name_ in enumerate(batch_names) if store is None or name_ not in store]
+        if len(missing) == 0:
+            continue
+        if len(missing) < len(batch_names):
+            sample = select_samples(sample, missing)
+
+        preds, classification_result = model.evaluate(sample)
+        for pred, name_ in zip(preds, sample['this_name']):
+            name_ = str(name_)
+            if store is not None:
+                store.add(name_, pred, classification_result.get(name_, None) if classification_result else None)
+            else:
+                save_pred[name_] = pred
+                if classification_result and name_ in classification_result:
+                    save_classification[name_] = classification_result[name_]
+        if store is not None:
+            store.end_batch()
+
+    if store is not None:
+        stored_pred, stored_classification = store.load(set(names))
+        save_pred.update(stored_pred)
+        save_classification.update(stored_classification)
+
     pose_errors = []
     running = []
-    for i, sample in enumerate(tqdm(dataloader, desc=f"{cfg.task}_{cate}")):
-        if cached_pred is None or True:
-            preds, classification_result = model.evaluate(sample)
-            if classification_result:
-                for img_name in classification_result.keys():
-                    save_classification[img_name] = classification_result[img_name]
-            
-            for pred, name_ in zip(preds, sample['this_name']):
-                save_pred[str(name_)] = pred
-        else:
-            for name_ in sample['this_name']:
-                save_pred[str(name_)] = cached_pred[str(name_)]
-        for pred in preds:
-            # _err = pose_error(sample, pred["final"][0])
-            if 'pose_error' in pred.keys():
-                _err = pred['pose_error']
-                pose_errors.append(_err)
-                running.append((cate, _err))
+    for name_ in names:
+        pred = save_pred[name_]
+        if 'pose_error' in pred.keys():
+            _err = pred['pose_error']
+            pose_errors.append(_err)
+            running.append((cate, _err))
     pose_errors = np.array(pose_errors)
 
     results = {}
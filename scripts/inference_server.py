@@ -0,0 +1,238 @@
+# Serve NeMo pose estimation from warmed models kept in memory.
+#
+# Requests and responses are JSON lines over a local socket:
+#   -> {"id": "0", "cate": "car", "image": "<base64 jpeg/png>" or "path": "/path/to/img.JPEG", "distance": 5.0}
+#   <- {"id": "0", "cate": "car", "final": [{"azimuth": ..., ...}], "timings": {...}}
+# {"metrics": true} returns the queue depth and batch fill statistics of the micro-batcher.
+# Images must already be cropped to the image size of their category (dataset.image_sizes), as in the NeMo datasets.
+
+import argparse
+import asyncio
+import base64
+import concurrent.futures
+import io
+import json
+import logging
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+
+from nemo.utils import construct_class_by_name
+from nemo.utils import load_config
+from nemo.utils import MicroBatcher
+from nemo.utils import set_seed
+from nemo.utils import setup_logging
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Serve a NeMo model")
+    parser.add_argument("--cate", type=str, default="aeroplane", help="category, comma separated categories or all")
+    parser.add_argument("--config", type=str, required=True)
+    parser.add_argument("--save_dir", type=str, required=True)
+    parser.add_argument("--checkpoint", type=str, required=True)
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--unix_socket", type=str, default=None, help="serve on a unix socket instead of tcp")
+    parser.add_argument("--max_batch_size", type=int, default=None, help="defaults to inference.batch_size")
+    parser.add_argument("--max_wait_ms", type=float, default=10.0, help="latency budget to fill a batch")
+    parser.add_argument("--gpu_workers", type=int, default=1, help="batches evaluated at once, the models are shared by the workers")
+    parser.add_argument(
+        "--opts", default=None, nargs=argparse.REMAINDER, help="Modify config options"
+    )
+    return parser.parse_args()
+
+
+class Request:
+    def __init__(self, request_id, cate, img, distance, received_time):
+        self.request_id = request_id
+        self.cate = cate
+        self.img = img
+        self.distance = distance
+        self.received_time = received_time
+        self.future = asyncio.get_running_loop().create_future()
+
+
+class PoseServer:
+    def __init__(self, cfg, categories, max_batch_size, max_wait_ms, gpu_workers=1):
+        self.cfg = cfg
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.gpu_workers = gpu_workers
+        self.image_sizes = {cate: tuple(cfg.dataset.image_sizes[cate]) for cate in categories}
+
+        self.models = {}
+        for cate in categories:
+            start_time = time.time()
+            self.models[cate] = construct_class_by_name(
+                **cfg.model,
+                cfg=cfg,
+                cate=cate,
+                mode="test",
+                checkpoint=cfg.args.checkpoint.format(cate),
+                device="cuda:0",
+            )
+            self.warm_up(cate)
+            logging.info(f"Loaded {cate} in {time.time() - start_time:.1f}s")
+
+        # Batches are evaluated off the event loop. Evaluation only reads the model state (see README),
+        # so with several workers batches of the same model overlap on the GPU
+        self.gpu_executor = concurrent.futures.ThreadPoolExecutor(max_workers=gpu_workers)
+        self.batcher = None
+
+    def warm_up(self, cate):
+        h, w = self.image_sizes[cate]
+        for b in {1, self.max_batch_size}:
+            img = torch.zeros((b, 3, h, w))
+            self.models[cate].evaluate(self.build_sample(img, [5.0] * b, [str(i) for i in range(b)]))
+
+    @staticmethod
+    def build_sample(img, distances, names):
+        return {
+            "img": img,
+            "distance": torch.tensor(distances, dtype=torch.float32),
+            "this_name": names,
+        }
+
+    def decode(self, message):
+        cate = message.get("cate")
+        if cate not in self.models:
+            raise ValueError(f"Category {cate} is not served")
+
+        if "image" in message:
+            img = Image.open(io.BytesIO(base64.b64decode(message["image"])))
+        elif "path" in message:
+            img = Image.open(message["path"])
+        else:
+            raise ValueError("Request has neither image nor path")
+        img = np.array(img.convert("RGB"))
+
+        if img.shape[0:2] != self.image_sizes[cate]:
+            raise ValueError(f"Image size {img.shape[0:2]} does not match {self.image_sizes[cate]} of {cate}")
+        return cate, torch.from_numpy(img).permute(2, 0, 1).float() / 255.
+
+    def evaluate(self, cate, batch):
+        start_time = time.time()
+        sample = self.build_sample(
+            torch.stack([r.img for r in batch]),
+            [r.distance for r in batch],
+            [str(r.request_id) for r in batch],
+        )
+        preds, _ = self.models[cate].evaluate(sample)
+        torch.cuda.synchronize()
+        return preds, time.time() - start_time
+
+    async def run_batch(self, cate, batch, workers):
+        dispatch_time = time.time()
+        try:
+            preds, evaluate_time = await asyncio.get_running_loop().run_in_executor(self.gpu_executor, self.evaluate, cate, batch)
+        except Exception as e:
+            logging.exception(f"Failed to evaluate a batch of {cate}")
+            for r in batch:
+                r.future.set_exception(e)
+            return
+        finally:
+            workers.release()
+
+        for r, pred in zip(batch, preds):
+            timings = {
+                "queue_time": dispatch_time - r.received_time,
+                "evaluate_time": evaluate_time,
+                "batch_size": len(batch),
+                "queue_depth": self.batcher.queue_depth,
+            }
+            timings.update({k: v for k, v in pred.items() if k.endswith("_time")})
+            r.future.set_result({"final": pred["final"], "timings": timings})
+
+    async def batch_loop(self):
+        # A batch is only taken from the batcher once a worker is free, so batches keep filling meanwhile
+        workers = asyncio.Semaphore(self.gpu_workers)
+        tasks = set()
+        while True:
+            await workers.acquire()
+            (cate, _, _), batch = await self.batcher.get()
+            task = asyncio.create_task(self.run_batch(cate, batch, workers))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+    async def handle_request(self, line, writer, write_lock):
+        received_time = time.time()
+        message = {}
+        try:
+            message = json.loads(line)
+            if message.get("metrics", False):
+                response = {"id": message.get("id"), "metrics": self.batcher.metrics()}
+            else:
+                cate, img = await asyncio.get_running_loop().run_in_executor(None, self.decode, message)
+                decode_time = time.time() - received_time
+
+                request = Request(message.get("id"), cate, img, float(message.get("distance", 5.0)), time.time())
+                self.batcher.put(request, key=(cate, *img.shape[1:]))
+                result = await request.future
+
+                result["timings"]["decode_time"] = decode_time
+                result["timings"]["total_time"] = time.time() - received_time
+                response = {"id": message.get("id"), "cate": cate, **result}
+        except Exception as e:
+            response = {"id": message.get("id") if isinstance(message, dict) else None, "error": str(e)}
+
+        async with write_lock:
+            writer.write((json.dumps(response) + "\n").encode())
+            await writer.drain()
+
+    async def handle_connection(self, reader, writer):
+        # Requests of a connection are pipelined, responses carry the request id
+        tasks = set()
+        write_lock = asyncio.Lock()
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            task = asyncio.create_task(self.handle_request(line, writer, write_lock))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.gather(*tasks)
+        writer.close()
+
+    async def serve(self, host, port, unix_socket=None):
+        self.batcher = MicroBatcher(self.max_batch_size, self.max_wait)
+        asyncio.create_task(self.batch_loop())
+
+        if unix_socket is not None:
+            server = await asyncio.start_unix_server(self.handle_connection, path=unix_socket)
+            logging.info(f"Serving {list(self.models)} on {unix_socket}")
+        else:
+            server = await asyncio.start_server(self.handle_connection, host=host, port=port)
+            logging.info(f"Serving {list(self.models)} on {host}:{port}")
+        async with server:
+            await server.serve_forever()
+
+
+def main():
+    args = parse_args()
+
+    setup_logging(args.save_dir)
+    logging.info(args)
+
+    cfg = load_config(args, override=args.opts)
+    set_seed(cfg.inference.random_seed)
+
+    if args.cate == 'all':
+        categories = sorted(list(cfg.dataset.image_sizes.keys()))
+    else:
+        categories = args.cate.split(',')
+
+    server = PoseServer(
+        cfg,
+        categories,
+        max_batch_size=args.max_batch_size or cfg.inference.get('batch_size', 1),
+        max_wait_ms=args.max_wait_ms,
+        gpu_workers=args.gpu_workers,
+    )
+    asyncio.run(server.serve(args.host, args.port, args.unix_socket))
+
+
+if __name__ == "__main__":
+    main()
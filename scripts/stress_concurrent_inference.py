@@ -0,0 +1,116 @@
+import argparse
+import concurrent.futures
+import logging
+import time
+
+import numpy as np
+import torch
+
+from nemo.utils import construct_class_by_name
+from nemo.utils import load_config
+from nemo.utils import set_seed
+from nemo.utils import setup_logging
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Evaluate with one NeMo model from many threads and compare with serial evaluation")
+    parser.add_argument("--cate", type=str, default="aeroplane")
+    parser.add_argument("--config", type=str, required=True)
+    parser.add_argument("--save_dir", type=str, required=True)
+    parser.add_argument("--checkpoint", type=str, required=True)
+    parser.add_argument("--num_batches", type=int, default=8, help="number of validation batches")
+    parser.add_argument("--num_threads", type=int, default=8)
+    parser.add_argument("--repeats", type=int, default=4, help="times every batch is evaluated concurrently")
+    parser.add_argument("--angle_tol", type=float, default=1e-2, help="max difference of the predicted angles, in radians")
+    parser.add_argument("--score_tol", type=float, default=1e-3)
+    parser.add_argument(
+        "--opts", default=None, nargs=argparse.REMAINDER, help="Modify config options"
+    )
+    return parser.parse_args()
+
+
+def final_poses(preds):
+    # preds of evaluate, [b, 4] azimuth, elevation, theta, score of the best hypothesis
+    if isinstance(preds, tuple):
+        preds = preds[0]
+    if isinstance(preds, dict):
+        preds = [preds]
+    return np.array([[p['final'][0][k] for k in ['azimuth', 'elevation', 'theta', 'score']] for p in preds])
+
+
+def pose_difference(a, b):
+    angles = np.abs(a[:, 0:3] - b[:, 0:3])
+    angles = np.minimum(angles, 2 * np.pi - angles)
+    return angles.max(), np.abs(a[:, 3] - b[:, 3]).max()
+
+
+def stress(cfg):
+    dataset_kwargs = {"data_type": "val", "category": cfg.args.cate}
+    val_dataset = construct_class_by_name(**cfg.dataset, **dataset_kwargs, training=False)
+    val_dataloader = torch.utils.data.DataLoader(
+        val_dataset, batch_size=cfg.inference.get('batch_size', 1), shuffle=False, num_workers=4
+    )
+    samples = []
+    for i, sample in enumerate(val_dataloader):
+        if i >= cfg.args.num_batches:
+            break
+        samples.append(sample)
+
+    model = construct_class_by_name(
+        **cfg.model,
+        cfg=cfg,
+        cate=cfg.args.cate,
+        mode="test",
+        checkpoint=cfg.args.checkpoint.format(cfg.args.cate),
+        device="cuda:0",
+    )
+
+    # evaluate may apply the transforms to the sample in place, every call gets its own copy
+    def run(i):
+        return final_poses(model.evaluate(dict(samples[i])))
+
+    model.evaluate(dict(samples[0]))
+    torch.cuda.synchronize()
+    start_time = time.time()
+    serial = [run(i) for i in range(len(samples))]
+    torch.cuda.synchronize()
+    serial_time = time.time() - start_time
+
+    jobs = [i for _ in range(cfg.args.repeats) for i in range(len(samples))]
+    np.random.shuffle(jobs)
+    start_time = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=cfg.args.num_threads) as executor:
+        results = list(executor.map(run, jobs))
+    torch.cuda.synchronize()
+    concurrent_time = time.time() - start_time
+
+    max_angle, max_score, failed = 0., 0., 0
+    for i, result in zip(jobs, results):
+        angle, score = pose_difference(result, serial[i])
+        max_angle, max_score = max(max_angle, angle), max(max_score, score)
+        if angle > cfg.args.angle_tol or score > cfg.args.score_tol:
+            failed += 1
+
+    num_images = sum(len(s) for s in serial)
+    logging.info(f"serial: {serial_time / num_images:.4f} s/img, {cfg.args.num_threads} threads: "
+                 f"{concurrent_time / (num_images * cfg.args.repeats):.4f} s/img")
+    logging.info(f"max angle difference {max_angle:.2e}, max score difference {max_score:.2e}, "
+                 f"{failed} of {len(jobs)} concurrent batches differ from serial")
+    if failed > 0:
+        raise RuntimeError(f"{failed} concurrent batches differ from serial evaluation")
+
+
+def main():
+    args = parse_args()
+
+    setup_logging(args.save_dir)
+    logging.info(args)
+
+    cfg = load_config(args, override=args.opts)
+
+    set_seed(cfg.inference.random_seed)
+    stress(cfg)
+
+
+if __name__ == "__main__":
+    main()